@@ -7,7 +7,7 @@ from dotenv import load_dotenv
 from flask import Flask, session
 
 # Import extensions
-from .extensions import db, login_manager, bcrypt, socketio
+from .extensions import db, login_manager, bcrypt, socketio, compress
 
 # Load environment variables
 load_dotenv()
@@ -112,6 +112,49 @@ def create_order_sequences(app):
             logger.error(f"Failed to create order ID sequences: {e}")
             logger.error("This feature is only compatible with PostgreSQL. The app may not function correctly.")
 
+def create_search_indexes(app):
+    """Creates the trigram indexes used by the text searches (PostgreSQL only)."""
+    with app.app_context():
+        from sqlalchemy import text
+        if db.engine.dialect.name != 'postgresql':
+            logger.info("Skipping search index creation for non-PostgreSQL database.")
+            return
+        try:
+            logger.info("Verifying or creating search indexes for PostgreSQL...")
+            db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            # The expression must match routes.PRODUCT_SEARCH_TEXT so the planner can use it for ILIKE '%term%'.
+            db.session.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_product_search_trgm ON product USING gin ("
+                "(coalesce(name, '') || ' ' || coalesce(barcode, '') || ' ' || coalesce(codigo_producto, '') || ' ' || "
+                "coalesce(marca, '') || ' ' || coalesce(size, '')) gin_trgm_ops)"
+            ))
+            # Client searches (client picker, order list) use ILIKE '%term%' on name and cedula/RIF;
+            # the OR of both columns is resolved with a BitmapOr over the two indexes.
+            db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_client_name_trgm ON client USING gin (name gin_trgm_ops)"))
+            db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_client_cedula_rif_trgm ON client USING gin (cedula_rif gin_trgm_ops)"))
+            db.session.commit()
+            logger.info("Search indexes are ready.")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to create search indexes: {e}")
+            logger.error("Product and client searches will fall back to sequential scans.")
+
+def create_model_indexes(app):
+    """
+    Creates the indexes declared on the models that are missing in the database.
+    db.create_all() only creates indexes together with new tables, so indexes added
+    to existing models would otherwise never reach an already deployed database.
+    """
+    with app.app_context():
+        logger.info("Verifying or creating model indexes...")
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(db.engine, checkfirst=True)
+                except Exception as e:
+                    logger.error(f"Failed to create index '{index.name}' on '{table.name}': {e}")
+        logger.info("Model indexes are ready.")
+
 def create_initial_warehouses(app):
     """Creates the default warehouses if they don't exist."""
     with app.app_context():
@@ -154,16 +197,42 @@ def create_app():
     # 'pool_pre_ping': checks if a connection is alive before using it from the pool.
     # 'pool_recycle': recycles connections after a set time (in seconds). This is useful for DBs that time out idle connections.
     # A value of 280 is safe for many default DB timeouts (e.g., 300s).
+    # 'pool_size' / 'max_overflow': con eventlet cada greenlet (ventas, sockets, reportes) toma su propia
+    # conexión; el valor por defecto (5 + 10) se agota con varias cajas vendiendo a la vez.
+    # 20 + 30 = 50 conexiones como máximo, dentro del max_connections=100 por defecto de PostgreSQL.
     app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
         "pool_pre_ping": True,
         "pool_recycle": 280,
+        "pool_size": int(os.environ.get('DB_POOL_SIZE', 20)),
+        "max_overflow": int(os.environ.get('DB_MAX_OVERFLOW', 30)),
+        # LIFO: se reutiliza la conexión devuelta más recientemente (ya validada y caliente); las
+        # que sobran tras un pico quedan ociosas al fondo, donde el servidor puede cerrarlas por
+        # inactividad (pool_pre_ping las detecta si vuelven a usarse).
+        "pool_use_lifo": True,
     }
+    # Response compression (HTML/JSON lists). Brotli when the browser accepts it, gzip otherwise.
+    # Level 4 keeps CPU low; responses under 500 bytes are not worth compressing.
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    app.config['COMPRESS_MIN_SIZE'] = 500
+    app.config['COMPRESS_LEVEL'] = 4
+    app.config['COMPRESS_BR_LEVEL'] = 4
+    # run.py arranca con debug=True, y Flask activa entonces jinja_env.auto_reload: cada
+    # render_template hace stat() del archivo para ver si cambió. Fijarlo en False mantiene las
+    # plantillas compiladas en memoria (el caché de Jinja, 400 entradas, cubre todas).
+    # TEMPLATES_AUTO_RELOAD=1 lo reactiva al editar plantillas.
+    app.config['TEMPLATES_AUTO_RELOAD'] = os.environ.get('TEMPLATES_AUTO_RELOAD') == '1'
+
+    # Directorios de subida (logos, fotos de perfil, imágenes de productos): se crean una vez
+    # al arrancar en vez de en cada POST que guarda un archivo.
+    for upload_subdir in ('uploads/logos', 'profile_pics', 'product_images'):
+        os.makedirs(os.path.join(app.root_path, 'static', upload_subdir), exist_ok=True)
 
     # --- Initialize Extensions ---
     db.init_app(app)
     bcrypt.init_app(app)
     login_manager.init_app(app)
     socketio.init_app(app)
+    compress.init_app(app)
 
     # --- Import and Register Blueprints & Models ---
     with app.app_context():
@@ -216,8 +285,8 @@ def create_app():
                 return ''
             try:
                 # Determine symbol based on session/company settings
-                from .models import CompanyInfo
-                company_info = CompanyInfo.query.first()
+                from .routes import get_company_info
+                company_info = get_company_info()
                 default_currency = company_info.calculation_currency if company_info and company_info.calculation_currency else 'USD'
                 display_currency = session.get('display_currency', default_currency)
                 symbol = '€' if display_currency == 'EUR' else '$'
@@ -286,6 +355,12 @@ def create_app():
     # --- Create order sequences if they don't exist (for PostgreSQL) ---
     create_order_sequences(app)
 
+    # --- Create model indexes missing on existing tables ---
+    create_model_indexes(app)
+
+    # --- Create search indexes if they don't exist (for PostgreSQL) ---
+    create_search_indexes(app)
+
     # --- Create initial warehouses if they don't exist ---
     create_initial_warehouses(app)
 
@@ -4,22 +4,7 @@ from requests.exceptions import ConnectionError # type: ignore
 from flask_login import current_user
 from werkzeug.exceptions import InternalServerError, NotFound, Forbidden
 from .extensions import db
-from .models import ExchangeRate, CompanyInfo, ManualFinancialMovement, Notification
-
-def get_cached_exchange_rate(currency='USD'):
-    """
-    Obtiene la última tasa de cambio guardada en la base de datos para una moneda específica.
-    """
-    try:
-        cached_rate = ExchangeRate.query.filter_by(currency=currency).order_by(ExchangeRate.date_updated.desc()).first()
-        if cached_rate:
-            return cached_rate.rate
-    except Exception as e:
-        current_app.logger.error(f"Error al obtener la tasa de cambio '{currency}' de la base de datos: {e}")
-        db.session.rollback()
-    
-    current_app.logger.warning(f"No se encontró una tasa de cambio para '{currency}' en la base de datos.")
-    return None
+from .models import ManualFinancialMovement, Notification
 
 def register_error_handlers(app):
     """Registra los manejadores de errores en la aplicación Flask."""
@@ -32,7 +17,10 @@ def register_error_handlers(app):
         # --- Replicate context variables needed by base.html ---
         
         # 1. Exchange rate and currency symbol
-        company_info = CompanyInfo.query.first()
+        # Mismos helpers que las vistas: la fila de empresa y la tasa quedan memorizadas en `g`
+        # y los context processors de base.html no las vuelven a consultar.
+        from .routes import get_company_info, get_cached_exchange_rate
+        company_info = get_company_info()
         default_currency = company_info.calculation_currency if company_info and company_info.calculation_currency else 'USD'
         calculation_currency = session.get('display_currency', default_currency)
         current_rate = get_cached_exchange_rate(calculation_currency) or 0.0
@@ -98,6 +98,11 @@ class Product(db.Model):
     movements = db.relationship('Movement', backref='product', lazy='dynamic')
     stock_levels = db.relationship('ProductStock', backref='product', lazy='joined', cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Índice parcial para los conteos y agregados que excluyen el grupo 'Ganchos' (insumos).
+        db.Index('ix_product_non_gancho', id, postgresql_where=grupo.is_distinct_from('Ganchos')),
+    )
+
     @property
     def display_image_url(self):
         """
@@ -241,7 +246,7 @@ class MarketingServiceOrder(db.Model):
 class Order(db.Model):
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
-    date_created = db.Column(db.DateTime(timezone=True), nullable=False, default=get_current_time_ve)
+    date_created = db.Column(db.DateTime(timezone=True), nullable=False, default=get_current_time_ve, index=True)
     order_type = db.Column(db.String(20), nullable=False, default='regular')
     status = db.Column(db.String(20), nullable=False, default='Pendiente')
     total_amount = db.Column(db.Float, nullable=False, default=0.0)
@@ -255,7 +260,11 @@ class Order(db.Model):
     # Relaciones
     items = db.relationship('OrderItem', backref='order', lazy=True, cascade="all, delete-orphan")
     payments = db.relationship('Payment', backref='order', lazy=True, cascade="all, delete-orphan")
-    
+
+    __table_args__ = (
+        # Listado de órdenes por sucursal filtrado por rango de fechas y ordenado por fecha.
+        db.Index('ix_order_store_date_created', store_id, date_created),
+    )
 
     @property
     def paid_amount_usd(self):
@@ -305,6 +314,11 @@ class OrderItem(db.Model):
     cost_at_sale_ves = db.Column(db.Float, nullable=True) # Costo unitario en VES en el momento de la venta
     returned_quantity = db.Column(db.Integer, nullable=False, default=0)
 
+    __table_args__ = (
+        # Items de una orden (carga de order.items) y el join Order -> OrderItem -> Product de estadísticas y reportes.
+        db.Index('ix_order_item_order_product', order_id, product_id),
+    )
+
     def __repr__(self):
         return f"OrderItem('{self.order_id}', '{self.product_id}', '{self.quantity}')"
 
@@ -394,7 +408,7 @@ class CashBox(db.Model):
 class Payment(db.Model):
     __tablename__ = 'payments'
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.BigInteger, db.ForeignKey('order.id'), nullable=True) # Changed to nullable=True
+    order_id = db.Column(db.BigInteger, db.ForeignKey('order.id'), nullable=True, index=True) # Changed to nullable=True
     amount_paid = db.Column(db.Float, nullable=False) # The amount in the currency it was paid
     currency_paid = db.Column(db.String(3), nullable=False) # 'VES', 'USD'
     amount_ves_equivalent = db.Column(db.Float, nullable=False) # The equivalent in VES for the order total
@@ -404,7 +418,7 @@ class Payment(db.Model):
     description = db.Column(db.String(255), nullable=True) # NEW: Add description field
     issuing_bank = db.Column(db.String(100), nullable=True) # Banco emisor
     sender_id = db.Column(db.String(50), nullable=True) # Cédula o teléfono del emisor
-    date = db.Column(db.DateTime(timezone=True), nullable=False, default=get_current_time_ve)
+    date = db.Column(db.DateTime(timezone=True), nullable=False, default=get_current_time_ve, index=True)
     
     exchange_rate_at_payment = db.Column(db.Float, nullable=True) # NEW: Rate used for this specific payment
     # Destination of funds
@@ -412,6 +426,11 @@ class Payment(db.Model):
     pos_id = db.Column(db.Integer, db.ForeignKey('points_of_sale.id'), nullable=True)
     cash_box_id = db.Column(db.Integer, db.ForeignKey('cash_boxes.id'), nullable=True)
 
+    __table_args__ = (
+        # Ingresos por caja en un rango de fechas (reportes mensual y diario).
+        db.Index('ix_payment_cash_box_date', cash_box_id, date),
+    )
+
     def __repr__(self):
         return f"Payment('{self.id}', '{self.method}', '{self.amount_ves_equivalent}')"
 
@@ -442,6 +461,12 @@ class ManualFinancialMovement(db.Model):
     approved_by_user = db.relationship('User', backref=db.backref('financial_movements_approved', lazy='dynamic'), foreign_keys=[approved_by_user_id])
     purchase = db.relationship('Purchase', backref=db.backref('payments', lazy='dynamic'))
 
+    __table_args__ = (
+        # Flujo de fondos por cuenta en un rango de fechas (reportes mensual y diario).
+        db.Index('ix_mfm_date_bank', date, bank_id),
+        db.Index('ix_mfm_date_cash_box', date, cash_box_id),
+    )
+
     def __repr__(self):
         return f"ManualFinancialMovement('{self.description}', '{self.amount} {self.currency}')"
 
@@ -502,6 +527,11 @@ class Movement(db.Model):
     
     warehouse = db.relationship('Warehouse', backref='movements')
 
+    __table_args__ = (
+        # Registro de movimientos filtrado por producto y rango de fechas.
+        db.Index('ix_movement_product_date', product_id, date),
+    )
+
     @property
     def price_at_exchange_usd(self):
         """Propiedad de compatibilidad para mostrar precio en vistas de intercambio (usa precio actual)."""
@@ -567,6 +597,15 @@ class BulkLoadLog(db.Model):
         lazy='dynamic'
     )
 
+class PendingExcelUpload(db.Model):
+    """Carga de Excel ya analizada que espera confirmación; la sesión solo guarda el token."""
+    __tablename__ = 'pending_excel_uploads'
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    payload = db.Column(db.JSON, nullable=False) # {'warehouse_id', 'new_products', 'updates'}
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=get_current_time_ve)
+
 class InventoryAdjustmentItem(db.Model):
     __tablename__ = 'inventory_adjustment_items'
     id = db.Column(db.Integer, primary_key=True)
@@ -5,8 +5,14 @@ import json
 import base64
 import calendar
 import secrets
+import functools
+import contextvars
+from collections import namedtuple
 from pathlib import Path
 import requests
+import threading
+from cachetools import TTLCache, cached
+import orjson
 try:
     import eventlet
     import eventlet.tpool
@@ -15,43 +21,163 @@ except ImportError:
 from pywebpush import webpush, WebPushException
 import firebase_admin
 import re
-from flask import Blueprint, render_template, url_for, flash, redirect, request, jsonify, session, current_app
+from flask import Blueprint, render_template, url_for, flash, redirect, request, jsonify, session, current_app, g
 from flask_login import login_user, current_user, logout_user, login_required
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, SubmitField, SelectField, TextAreaField
 from wtforms.validators import DataRequired, Length, Email, Optional
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func, extract, or_, select, case, text, and_
-import openpyxl
+from sqlalchemy import func, extract, or_, select, case, text, and_, update, union_all, cast, null, literal
 from datetime import datetime, timedelta, date
-from flask import Response
+from flask import Response, abort
 from weasyprint import HTML
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from weasyprint.text.fonts import FontConfiguration
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
+import pandas as pd
 from babel.dates import get_month_names
 from firebase_admin import messaging
-from sqlalchemy.orm import joinedload, subqueryload
+from sqlalchemy.orm import joinedload, subqueryload, selectinload, contains_eager
 from .extensions import db, bcrypt, socketio
 from .models import (User, Product, Client, Provider, Order, OrderItem, Purchase, PurchaseItem, Reception, Movement, 
                     CompanyInfo, CostStructure, Notification, ExchangeRate, get_current_time_ve, Bank, PointOfSale, UserActivityLog, Store, MarketingServiceOrder, ClientCreditMovement,
                     CashBox, Payment, ManualFinancialMovement, InventoryAdjustment, InventoryAdjustmentItem, VE_TIMEZONE, OrderReturn, OrderReturnItem, OrderExchangeItem, HistoricalExchangeRate,
-                    UserDevice, Warehouse, ProductStock, WarehouseTransfer, BulkLoadLog)
+                    UserDevice, Warehouse, ProductStock, WarehouseTransfer, BulkLoadLog, PendingExcelUpload)
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
+from reportlab.lib.units import mm, inch
 from reportlab.pdfgen import canvas
-from reportlab.graphics.barcode import createBarcodeDrawing
-from reportlab.graphics import renderPM
-from reportlab.graphics.shapes import Drawing
+from reportlab.graphics.barcode import code128
+
+def get_company_info():
+    """
+    Returns the CompanyInfo row for the current request.
+    Se consulta una sola vez por request y se reutiliza desde `g` (vistas, context processors y filtros).
+    """
+    if 'company_info' not in g:
+        g.company_info = CompanyInfo.query.first()
+    return g.company_info
+
+def get_cost_structure():
+    """
+    Returns the CostStructure row (or None) for the current request, memorizado en `g`
+    igual que get_company_info(). La vista que la crea debe guardar la nueva fila en `g`.
+    """
+    if 'cost_structure' not in g:
+        g.cost_structure = CostStructure.query.first()
+    return g.cost_structure
+
+def get_fixed_cost_per_unit(cost_structure):
+    """
+    Costo fijo mensual repartido entre las ventas mensuales estimadas (sin 'Ganchos'),
+    memorizado en `g`. Quien modifique estimated_monthly_sales debe quitar
+    'fixed_cost_per_unit' de `g` antes de volver a llamarla.
+    """
+    if 'fixed_cost_per_unit' not in g:
+        total_estimated_sales = db.session.query(func.sum(Product.estimated_monthly_sales)).filter(NON_GANCHO).scalar() or 1
+        total_fixed_costs = (cost_structure.monthly_rent or 0) + \
+                            (cost_structure.monthly_utilities or 0) + \
+                            (cost_structure.monthly_fixed_taxes or 0)
+        g.fixed_cost_per_unit = total_fixed_costs / total_estimated_sales
+    return g.fixed_cost_per_unit
 
 def get_main_calculation_currency_info():
     """Returns the main calculation currency and its symbol."""
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     currency = company_info.calculation_currency if company_info and company_info.calculation_currency else 'USD'
     symbol = '€' if currency == 'EUR' else '$'
     return currency, symbol
 
+@functools.lru_cache(maxsize=32)
+def ve_day_bounds(day):
+    """
+    Retorna (inicio, fin) del día dado como datetimes localizados en la zona horaria de Venezuela.
+    Se cachea por fecha: los límites de un día no cambian y evita repetir localize() en cada request.
+    """
+    start = VE_TIMEZONE.localize(datetime.combine(day, datetime.min.time()))
+    end = VE_TIMEZONE.localize(datetime.combine(day, datetime.max.time()))
+    return start, end
+
+def html_to_pdf(html_string):
+    """
+    Convierte a PDF el HTML ya renderizado de un reporte.
+    Antes de la conversión (WeasyPrint puede tardar varios segundos) cierra la sesión para devolver
+    la conexión al pool: llamar solo después de render_template, sin volver a usar objetos del ORM.
+    """
+    db.session.close()
+    document = HTML(string=html_string, base_url=request.base_url)
+
+    def write_pdf():
+        return document.write_pdf(font_config=get_pdf_font_config())
+
+    if eventlet:
+        return eventlet.tpool.execute(write_pdf)
+    return write_pdf()
+
+@functools.lru_cache(maxsize=4096)
+def render_order_barcode_base64(order_id_str):
+    """
+    Dibuja el Code128 de un número de orden como SVG en base64 y lo memoriza por número.
+    El SVG se arma directamente con la geometría de code128_bar_geometry (un rect por barra,
+    con las mismas medidas y zonas de silencio que createBarcodeDrawing), sin pasar por el
+    Drawing y renderSVG de ReportLab, que generaban ~6 KB de grupos y estilos por código.
+    """
+    bar_width, bar_height = 0.3*mm, 10*mm
+    offsets, widths, bars_width = code128_bar_geometry(order_id_str, bar_width)
+    quiet = max(inch * 0.25, bar_width * 10.0)
+    total_width = bars_width + 2 * quiet
+    rects = ''.join(
+        f'<rect x="{quiet + offset:.3f}" y="0" width="{width:.3f}" height="{bar_height:.3f}"/>'
+        for offset, width in zip(offsets, widths)
+    )
+    svg = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{total_width:.3f}" height="{bar_height:.3f}" '
+        f'viewBox="0 0 {total_width:.3f} {bar_height:.3f}">{rects}</svg>'
+    )
+    return base64.b64encode(svg.encode('ascii')).decode('ascii')
+
+def generate_order_barcode_base64(order_id_str):
+    """
+    Generates a Code128 barcode for an order number and returns it as a base64 SVG string.
+    Los errores quedan fuera del caché: un fallo no se memoriza y el siguiente intento vuelve a dibujar.
+    """
+    if not order_id_str:
+        return None
+    try:
+        return render_order_barcode_base64(order_id_str)
+    except Exception as e:
+        current_app.logger.error(f"Error generating barcode for order ID {order_id_str}: {e}")
+        return None
+
+_pdf_thread_state = threading.local()
+
+def get_pdf_font_config():
+    """
+    FontConfiguration de WeasyPrint para el hilo actual. Crearla carga y escanea todas las fuentes
+    del sistema (fontconfig), cosa que write_pdf hacía en cada reporte; se reutiliza, una por hilo
+    porque las conversiones corren en los hilos de tpool y Pango no es seguro entre hilos.
+    """
+    font_config = getattr(_pdf_thread_state, 'font_config', None)
+    if font_config is None:
+        font_config = _pdf_thread_state.font_config = FontConfiguration()
+    return font_config
+
+# Texto concatenado usado por el buscador de inventario. La expresión debe coincidir
+# exactamente con la del índice trigram 'ix_product_search_trgm' (ver create_search_indexes)
+# para que PostgreSQL pueda resolver el ILIKE '%term%' con el índice en lugar de un seq scan.
+PRODUCT_SEARCH_TEXT = (
+    func.coalesce(Product.name, '') + ' ' +
+    func.coalesce(Product.barcode, '') + ' ' +
+    func.coalesce(Product.codigo_producto, '') + ' ' +
+    func.coalesce(Product.marca, '') + ' ' +
+    func.coalesce(Product.size, '')
+)
+
+# Excluye el grupo 'Ganchos' (insumos). IS DISTINCT FROM también conserva los productos sin grupo
+# y, a diferencia del OR con IS NULL, coincide con el índice parcial 'ix_product_non_gancho'.
+NON_GANCHO = Product.grupo.is_distinct_from('Ganchos')
+
 # --- Helper functions for role-based access control ---
 def is_superuser():
     return current_user.is_authenticated and current_user.role == 'Superusuario'
@@ -65,6 +191,21 @@ def is_administrador():
 def is_vendedor():
     return current_user.is_authenticated and current_user.role in ['Superusuario', 'Gerente', 'Administrador', 'Vendedor']
 
+def role_required(role_check, message='Acceso denegado. Solo los administradores pueden realizar esta acción.'):
+    """
+    Decorador para vistas: si role_check() es falso avisa con `message` y vuelve a la página anterior
+    (o al dashboard). Se aplica debajo de @login_required.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(*args, **kwargs):
+            if not role_check():
+                flash(message, 'danger')
+                return redirect(request.referrer or url_for('main.dashboard'))
+            return view(*args, **kwargs)
+        return wrapped_view
+    return decorator
+
 # --- End Helper functions for role-based access control ---
 
 # --- Helper function for user activity logging ---
@@ -129,9 +270,6 @@ def save_picture(form_picture):
     picture_fn = random_hex + f_ext
     picture_path = os.path.join(current_app.root_path, 'static/profile_pics', picture_fn)
 
-    # Crear el directorio si no existe
-    os.makedirs(os.path.dirname(picture_path), exist_ok=True)
-
     # Redimensionar imagen si es necesario (opcional, pero recomendado)
     # from PIL import Image
     # output_size = (125, 125)
@@ -151,9 +289,6 @@ def save_product_image(form_picture):
     # La ruta donde se guardará el archivo
     picture_path = os.path.join(current_app.root_path, 'static/product_images', picture_fn)
 
-    # Crear el directorio si no existe
-    os.makedirs(os.path.dirname(picture_path), exist_ok=True)
-
     # Guardar la imagen
     form_picture.save(picture_path)
 
@@ -272,14 +407,162 @@ def obtener_tasas_monitor_bcv():
         current_app.logger.warning(f"Fallo pydolarvenezuela-api: {e}")
     return None
 
+# --- Listas de referencia para selectores (bancos, puntos de venta, cajas, productos, clientes) ---
+# Cambian muy poco y se consultan en casi cada formulario; se guardan 60s como tuplas livianas
+# (no objetos ORM, y nunca existencias) y se invalidan al crear o editar el registro correspondiente.
+BankOption = namedtuple('BankOption', 'id name currency')
+PosOption = namedtuple('PosOption', 'id name bank')
+CashBoxOption = namedtuple('CashBoxOption', 'id name')
+ProductOption = namedtuple('ProductOption', 'id name')
+ClientOption = namedtuple('ClientOption', 'id name cedula_rif')
+
+_bank_options_cache = TTLCache(maxsize=1, ttl=60)
+_pos_options_cache = TTLCache(maxsize=1, ttl=60)
+_cash_box_options_cache = TTLCache(maxsize=32, ttl=60)
+_product_options_cache = TTLCache(maxsize=1, ttl=60)
+_client_options_cache = TTLCache(maxsize=1, ttl=60)
+_reference_cache_lock = threading.RLock()
+
+@cached(_bank_options_cache, lock=_reference_cache_lock)
+def get_bank_options():
+    rows = db.session.execute(select(Bank.id, Bank.name, Bank.currency).order_by(Bank.name)).all()
+    return tuple(BankOption(*row) for row in rows)
+
+@cached(_pos_options_cache, lock=_reference_cache_lock)
+def get_pos_options():
+    rows = db.session.execute(
+        select(PointOfSale.id, PointOfSale.name, Bank.id, Bank.name, Bank.currency)
+        .outerjoin(Bank, PointOfSale.bank_id == Bank.id)
+        .order_by(PointOfSale.name)
+    ).all()
+    return tuple(
+        PosOption(pos_id, pos_name, BankOption(bank_id, bank_name, bank_currency) if bank_id else None)
+        for pos_id, pos_name, bank_id, bank_name, bank_currency in rows
+    )
+
+@cached(_cash_box_options_cache, lock=_reference_cache_lock)
+def get_cash_box_options(store_id=None):
+    """Cajas de la sucursal indicada, o todas si store_id es None."""
+    query = select(CashBox.id, CashBox.name).order_by(CashBox.name)
+    if store_id is not None:
+        query = query.where(CashBox.store_id == store_id)
+    return tuple(CashBoxOption(*row) for row in db.session.execute(query).all())
+
+@cached(_product_options_cache, lock=_reference_cache_lock)
+def get_product_options():
+    rows = db.session.execute(select(Product.id, Product.name).order_by(Product.name)).all()
+    return tuple(ProductOption(*row) for row in rows)
+
+@cached(_client_options_cache, lock=_reference_cache_lock)
+def get_client_options():
+    rows = db.session.execute(select(Client.id, Client.name, Client.cedula_rif).order_by(Client.name)).all()
+    return tuple(ClientOption(*row) for row in rows)
+
+def active_store_cash_box_options():
+    active_store_id = session.get('active_store_id')
+    return get_cash_box_options(active_store_id if active_store_id and active_store_id != 'all' else None)
+
+def clear_reference_caches():
+    with _reference_cache_lock:
+        _bank_options_cache.clear()
+        _pos_options_cache.clear()
+        _cash_box_options_cache.clear()
+        _product_options_cache.clear()
+        _client_options_cache.clear()
+
+def parse_abono_payment(payment_data_json):
+    """
+    Lee y valida el primer pago del campo 'payments_data' de un abono (crédito o apartado).
+    Retorna un dict con los tipos ya normalizados; lanza ValueError ante datos incompletos o
+    inválidos, antes de tocar la base de datos.
+    """
+    try:
+        payment_info = orjson.loads(payment_data_json)[0]
+    except (orjson.JSONDecodeError, IndexError, KeyError, TypeError):
+        raise ValueError("Los datos del pago no son válidos.")
+    if not isinstance(payment_info, dict):
+        raise ValueError("Los datos del pago no son válidos.")
+
+    def optional_id(key):
+        value = payment_info.get(key)
+        return int(value) if value not in (None, '') else None
+
+    def optional_text(key):
+        value = payment_info.get(key)
+        return str(value) if value not in (None, '') else None
+
+    try:
+        parsed = {
+            'amount_paid': float(payment_info['amount_paid']),
+            'currency_paid': payment_info['currency_paid'],
+            'amount_ves_equivalent': float(payment_info['amount_ves_equivalent']),
+            'amount_usd_equivalent': float(payment_info.get('amount_usd_equivalent') or 0.0),
+            'method': payment_info['method'],
+            'bank_id': optional_id('bank_id'),
+            'pos_id': optional_id('pos_id'),
+            'cash_box_id': optional_id('cash_box_id'),
+            'reference': optional_text('reference'),
+            'issuing_bank': optional_text('issuing_bank'),
+            'sender_id': optional_text('sender_id'),
+            'date': optional_text('date'),
+        }
+    except KeyError as e:
+        raise ValueError(f"Falta el campo '{e.args[0]}' en los datos del pago.")
+    except (ValueError, TypeError):
+        raise ValueError("Los montos o cuentas del pago no son válidos.")
+
+    if parsed['currency_paid'] not in ('VES', 'USD'):
+        raise ValueError("La moneda del pago debe ser VES o USD.")
+    if not isinstance(parsed['method'], str) or not parsed['method']:
+        raise ValueError("El método de pago es obligatorio.")
+    if parsed['amount_paid'] <= 0:
+        raise ValueError("El monto del abono debe ser mayor que cero.")
+    return parsed
+
+def adjust_bank_balance(bank_id, amount, *criteria):
+    """
+    Suma `amount` (negativo para restar) al saldo del banco con un UPDATE atómico
+    (balance = balance + :amount), así dos cobros simultáneos a la misma cuenta no se pisan.
+    """
+    db.session.execute(update(Bank).where(Bank.id == bank_id, *criteria).values(balance=Bank.balance + amount))
+
+def adjust_cash_box_balance(cash_box_id, currency, amount):
+    """Igual que adjust_bank_balance, sobre el saldo de la caja en la moneda indicada ('VES' o 'USD')."""
+    column = {'VES': 'balance_ves', 'USD': 'balance_usd'}.get(currency)
+    if column:
+        db.session.execute(
+            update(CashBox).where(CashBox.id == cash_box_id)
+            .values({column: getattr(CashBox, column) + amount})
+        )
+
+def apply_payment_to_account(payment):
+    """
+    Suma un abono al saldo de la cuenta destino (banco en VES, banco del punto de venta o caja)
+    con UPDATEs atómicos; el banco del punto de venta se resuelve en el mismo UPDATE.
+    """
+    if payment.bank_id:
+        adjust_bank_balance(payment.bank_id, payment.amount_ves_equivalent, Bank.currency == 'VES')
+    elif payment.pos_id:
+        pos_bank_id = select(PointOfSale.bank_id).where(PointOfSale.id == payment.pos_id).scalar_subquery()
+        adjust_bank_balance(pos_bank_id, payment.amount_ves_equivalent)
+    elif payment.cash_box_id:
+        adjust_cash_box_balance(payment.cash_box_id, payment.currency_paid, payment.amount_paid)
+
 # --- NUEVAS FUNCIONES AUXILIARES ---
 def get_cached_exchange_rate(currency='USD'):
     """
     Obtiene la última tasa de cambio guardada en la base de datos para una moneda específica.
+    El resultado se memoriza en `g` durante el request: la vista y los context processors
+    (inject_current_rate) comparten una sola consulta. Quien modifique la tasa debe llamar
+    a clear_request_exchange_rates().
     """
+    request_rates = g.setdefault('exchange_rates', {})
+    if currency in request_rates:
+        return request_rates[currency]
     try:
         cached_rate = ExchangeRate.query.filter_by(currency=currency).order_by(ExchangeRate.date_updated.desc()).first()
         if cached_rate:
+            request_rates[currency] = cached_rate.rate
             return cached_rate.rate
     except Exception as e:
         current_app.logger.error(f"Error al obtener la tasa de cambio '{currency}' de la base de datos: {e}")
@@ -288,6 +571,10 @@ def get_cached_exchange_rate(currency='USD'):
     current_app.logger.warning(f"No se encontró una tasa de cambio para '{currency}' en la base de datos.")
     return None
 
+def clear_request_exchange_rates():
+    """Descarta las tasas memorizadas en el request actual tras actualizar ExchangeRate."""
+    g.pop('exchange_rates', None)
+
 def get_historical_exchange_rate(target_date, currency='USD'):
     """
     Obtiene la tasa de cambio histórica para una fecha y moneda específicas.
@@ -345,6 +632,7 @@ def fetch_and_update_exchange_rate():
                 else:
                     exchange_rate_entry = ExchangeRate(currency=currency, rate=rate_value)
                     db.session.add(exchange_rate_entry)
+            clear_request_exchange_rates()
             
             # For USD, also update HistoricalExchangeRate
             if 'USD' in rates:
@@ -386,34 +674,26 @@ def create_notification_for_admins(message, link):
     VAPID_CLAIMS = {"sub": "mailto:tiendastoria@gmail.com"}
     current_app.logger.info(f"Attempting to create notification for admins: {message}")
     try:
-        admins = User.query.filter(User.role.in_(['Superusuario', 'Gerente'])).all()
-        if not admins:
+        admin_ids = db.session.scalars(select(User.id).where(User.role.in_(['Superusuario', 'Gerente']))).all()
+        if not admin_ids:
             current_app.logger.warning("No se encontraron usuarios administradores para enviar la notificación.")
             return
 
-        # 1. Guardar notificaciones en la BD y emitir por WebSocket
-        for admin in admins:
-            notification = Notification(
-                user_id=admin.id,
-                message=message,
-                link=link
-            )
-            db.session.add(notification)
-            db.session.flush() # Flush para que la notificación tenga ID y fecha antes de emitir
-
-            # Emitir evento de WebSocket para la UI en tiempo real
-            socketio.emit('new_notification', {
-                'message': notification.message,
-                'link': notification.link,
-                'created_at': notification.created_at.strftime('%d/%m %H:%M')
-            }, room=f'user_{admin.id}')
-            current_app.logger.info(f"Notificación en BD y WebSocket para admin {admin.id}")
-
+        # 1. Guardar las notificaciones en la BD con un solo INSERT multi-fila
+        created_at = get_current_time_ve()
+        db.session.bulk_insert_mappings(Notification, [
+            {'user_id': admin_id, 'message': message, 'link': link, 'is_read': False, 'created_at': created_at}
+            for admin_id in admin_ids
+        ])
         db.session.commit()
-        current_app.logger.info(f"Commit de {len(admins)} notificaciones a la BD.")
+        current_app.logger.info(f"Commit de {len(admin_ids)} notificaciones a la BD.")
+
+        # Emitir evento de WebSocket para la UI en tiempo real, ya fuera de la transacción
+        ws_payload = {'message': message, 'link': link, 'created_at': created_at.strftime('%d/%m %H:%M')}
+        for admin_id in admin_ids:
+            socketio.emit('new_notification', ws_payload, room=f'user_{admin_id}')
 
         # 2. Enviar notificaciones PUSH (Móvil y Web)
-        admin_ids = [admin.id for admin in admins]
         devices = UserDevice.query.filter(UserDevice.user_id.in_(admin_ids)).all()
         
         fcm_tokens = [d.fcm_token for d in devices if d.device_type != 'web']
@@ -506,8 +786,8 @@ def inject_bank_icons():
         '0191': {'name': 'BANCO NACIONAL DE CREDITO', 'icon': '0191.png'},
         '0053': {'name': 'ZELLE', 'icon': '0053.png'}
     }
-    # Obtener los bancos registrados en el sistema para los dropdowns
-    registered_banks = Bank.query.order_by(Bank.name).all()
+    # Obtener los bancos registrados en el sistema para los dropdowns (lista cacheada)
+    registered_banks = get_bank_options() if current_user.is_authenticated else ()
     return dict(BANK_ICONS=BANK_ICONS, REGISTERED_BANKS=registered_banks)
 
 
@@ -596,7 +876,7 @@ def inject_current_rate():
     """
     # 1. Determine the currency to use for display/calculation.
     # Priority: Session > Company Setting > Default 'USD'
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     default_currency = company_info.calculation_currency if company_info and company_info.calculation_currency else 'USD'
     
     # The session stores the user's preference for this session.
@@ -764,12 +1044,12 @@ def dashboard():
 
     # --- General Metrics ---
     # Excluir el grupo 'Ganchos' (insumos) de los conteos del dashboard.
-    product_query = Product.query.filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None)))
+    product_query = Product.query.filter(NON_GANCHO)
     
     stock_query = db.session.query(
         func.sum(ProductStock.quantity),
         func.sum(ProductStock.quantity * Product.price_usd)
-    ).join(Product, ProductStock.product_id == Product.id).join(Warehouse).filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None)))
+    ).join(Product, ProductStock.product_id == Product.id).join(Warehouse).filter(NON_GANCHO)
 
     if active_store_id and active_store_id != 'all':
         product_query = product_query.join(ProductStock).join(Warehouse).filter(Warehouse.store_id == active_store_id)
@@ -787,69 +1067,67 @@ def dashboard():
     current_rate_usd = get_cached_exchange_rate('USD') or 1.0
 
     # Optimized Accounts Receivable Calculation
-    paid_sq = db.session.query(
+    # Consultas Core (select) sin entidades ORM y sin autoflush: solo se leen agregados.
+    paid_sq = select(
         Payment.order_id.label('order_id'),
         func.sum(Payment.amount_usd_equivalent).label('total_paid_usd')
     ).group_by(Payment.order_id).subquery()
 
-    debt_data_query = db.session.query(
+    debt_data_stmt = select(
         Order.client_id,
         (Order.total_amount_usd - func.coalesce(paid_sq.c.total_paid_usd, 0)).label('due_amount_usd')
     ).outerjoin(paid_sq, Order.id == paid_sq.c.order_id)
 
     if active_store_id and active_store_id != 'all':
-        debt_data_query = debt_data_query.filter(Order.store_id == active_store_id)
+        debt_data_stmt = debt_data_stmt.where(Order.store_id == active_store_id)
 
-    debt_data_query = debt_data_query.subquery()
+    debt_data_sq = debt_data_stmt.subquery()
 
-    final_debt_query = db.session.query(
-        func.count(func.distinct(debt_data_query.c.client_id)),
-        func.sum(debt_data_query.c.due_amount_usd)
-    ).filter(debt_data_query.c.due_amount_usd > 0.01)
+    final_debt_stmt = select(
+        func.count(func.distinct(debt_data_sq.c.client_id)),
+        func.sum(debt_data_sq.c.due_amount_usd)
+    ).where(debt_data_sq.c.due_amount_usd > 0.01)
 
-    debt_result = final_debt_query.first()
+    with db.session.no_autoflush:
+        debt_result = db.session.execute(final_debt_stmt).one()
     clients_in_debt_count = debt_result[0] or 0
     total_due_usd = debt_result[1] or 0.0
 
     # --- Order Statistics ---
     today = get_current_time_ve().date()
-    start_of_day = VE_TIMEZONE.localize(datetime.combine(today, datetime.min.time()))
-    end_of_day = VE_TIMEZONE.localize(datetime.combine(today, datetime.max.time()))
+    start_of_day, end_of_day = ve_day_bounds(today)
     start_of_month = today.replace(day=1)
-    start_of_month_dt = VE_TIMEZONE.localize(datetime.combine(start_of_month, datetime.min.time()))
+    start_of_month_dt, _ = ve_day_bounds(start_of_month)
 
     # Optimized Order Statistics Calculation
-    def get_order_stats(start_date, end_date=None):
-        query = db.session.query(
-            func.count(Order.id),
-            func.sum(Order.total_amount / Order.exchange_rate_at_sale)
-        ).filter(
-            Order.exchange_rate_at_sale.isnot(None),
-            Order.exchange_rate_at_sale > 0
-        )
-        if active_store_id and active_store_id != 'all':
-            query = query.filter(Order.store_id == active_store_id)
-        if end_date:
-            query = query.filter(Order.date_created.between(start_date, end_date))
-        else:
-            query = query.filter(Order.date_created >= start_date)
-        
-        count, amount_usd = query.first()
-        return count or 0, float(amount_usd or 0.0)
-
-    orders_today_count, orders_today_amount_usd = get_order_stats(start_of_day, end_of_day)
-    orders_month_count, orders_month_amount_usd = get_order_stats(start_of_month_dt)
-    
-    all_stats_query = db.session.query(
+    # Un solo recorrido de órdenes: día y mes se obtienen con agregados FILTER (WHERE ...)
+    # y el total histórico con los agregados sin filtrar.
+    amount_usd_expr = Order.total_amount / Order.exchange_rate_at_sale
+    today_window = Order.date_created.between(start_of_day, end_of_day)
+    month_window = Order.date_created >= start_of_month_dt
+
+    order_stats_stmt = select(
+        func.count(Order.id).filter(today_window),
+        func.sum(amount_usd_expr).filter(today_window),
+        func.count(Order.id).filter(month_window),
+        func.sum(amount_usd_expr).filter(month_window),
         func.count(Order.id),
-        func.sum(Order.total_amount / Order.exchange_rate_at_sale)
-    ).filter(
+        func.sum(amount_usd_expr)
+    ).where(
         Order.exchange_rate_at_sale.isnot(None),
         Order.exchange_rate_at_sale > 0
     )
     if active_store_id and active_store_id != 'all':
-        all_stats_query = all_stats_query.filter(Order.store_id == active_store_id)
-    all_orders_count, all_orders_amount_usd = all_stats_query.first()
+        order_stats_stmt = order_stats_stmt.where(Order.store_id == active_store_id)
+
+    with db.session.no_autoflush:
+        (orders_today_count, orders_today_amount_usd,
+         orders_month_count, orders_month_amount_usd,
+         all_orders_count, all_orders_amount_usd) = db.session.execute(order_stats_stmt).one()
+    orders_today_count = orders_today_count or 0
+    orders_today_amount_usd = float(orders_today_amount_usd or 0.0)
+    orders_month_count = orders_month_count or 0
+    orders_month_amount_usd = float(orders_month_amount_usd or 0.0)
     all_orders_count = all_orders_count or 0
     all_orders_amount_usd = float(all_orders_amount_usd or 0.0)
 
@@ -921,49 +1199,53 @@ def dashboard():
 
     # --- Accounting Donut Chart Data (Current Month) ---
     def get_accounting_data(start_date, end_date=None):
-        # Sales by status
-        sales_query = db.session.query(
-            Order.status,
+        # Sales by status, agrupadas en la BD directamente en los tres tipos del gráfico
+        sale_bucket = case(
+            (Order.status.in_(('Pagada', 'Completada')), 'contado'),
+            (Order.status == 'Crédito', 'credito'),
+            else_='apartado'
+        )
+        sales_stmt = select(
+            sale_bucket,
             func.sum(Order.total_amount / Order.exchange_rate_at_sale)
-        ).filter(
-            Order.exchange_rate_at_sale.isnot(None), Order.exchange_rate_at_sale > 0
+        ).where(
+            Order.exchange_rate_at_sale.isnot(None), Order.exchange_rate_at_sale > 0,
+            Order.status.in_(('Pagada', 'Completada', 'Crédito', 'Apartado'))
         )
         if active_store_id and active_store_id != 'all':
-            sales_query = sales_query.filter(Order.store_id == active_store_id)
-        if end_date: sales_query = sales_query.filter(Order.date_created.between(start_date, end_date))
-        else: sales_query = sales_query.filter(Order.date_created >= start_date)
+            sales_stmt = sales_stmt.where(Order.store_id == active_store_id)
+        if end_date: sales_stmt = sales_stmt.where(Order.date_created.between(start_date, end_date))
+        else: sales_stmt = sales_stmt.where(Order.date_created >= start_date)
         
-        sales_results = sales_query.group_by(Order.status).all()
         sales = {'contado': 0.0, 'credito': 0.0, 'apartado': 0.0}
-        for status, amount in sales_results:
-            amount = float(amount or 0.0)
-            if status in ['Pagada', 'Completada']: sales['contado'] += amount
-            elif status == 'Crédito': sales['credito'] += amount
-            elif status == 'Apartado': sales['apartado'] += amount
+        with db.session.no_autoflush:
+            for bucket, amount in db.session.execute(sales_stmt.group_by(sale_bucket)):
+                sales[bucket] = float(amount or 0.0)
 
         # Variable Expenses
-        cost_structure = CostStructure.query.first() or CostStructure()
+        cost_structure = get_cost_structure() or CostStructure()
         var_sales_exp_pct = case((Product.variable_selling_expense_percent > 0, Product.variable_selling_expense_percent), else_=(cost_structure.default_sales_commission_percent or 0))
         var_marketing_pct = case((Product.variable_marketing_percent > 0, Product.variable_marketing_percent), else_=(cost_structure.default_marketing_percent or 0))
         
-        expenses_query = db.session.query(func.sum(
+        expenses_stmt = select(func.sum(
             (OrderItem.quantity * (OrderItem.cost_at_sale_ves or 0)) + 
             ((OrderItem.quantity * OrderItem.price) * (var_sales_exp_pct + var_marketing_pct))
-        )).join(Order).join(Product).filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None)))
+        )).select_from(OrderItem).join(Order).join(Product).where(NON_GANCHO)
 
         if active_store_id and active_store_id != 'all':
-            expenses_query = expenses_query.filter(Order.store_id == active_store_id)
+            expenses_stmt = expenses_stmt.where(Order.store_id == active_store_id)
 
-        if end_date: expenses_query = expenses_query.filter(Order.date_created.between(start_date, end_date))
-        else: expenses_query = expenses_query.filter(Order.date_created >= start_date)
+        if end_date: expenses_stmt = expenses_stmt.where(Order.date_created.between(start_date, end_date))
+        else: expenses_stmt = expenses_stmt.where(Order.date_created >= start_date)
 
-        variable_expenses_ves = expenses_query.scalar() or 0.0
+        with db.session.no_autoflush:
+            variable_expenses_ves = db.session.execute(expenses_stmt).scalar() or 0.0
         variable_expenses_usd = variable_expenses_ves / current_rate_usd if current_rate_usd > 0 else 0.0
         
         return sales, variable_expenses_usd
 
     sales_month, variable_expenses_usd_month = get_accounting_data(start_of_month_dt)
-    cost_structure = CostStructure.query.first() or CostStructure()
+    cost_structure = get_cost_structure() or CostStructure()
     fixed_expenses_usd_month = (cost_structure.monthly_rent or 0) + (cost_structure.monthly_utilities or 0) + (cost_structure.monthly_fixed_taxes or 0)
 
     accounting_chart_data = {
@@ -985,7 +1267,7 @@ def dashboard():
     current_month_name = f"{month_names[today.month - 1]} {today.year}"
 
     # --- Recent Activity ---
-    recent_products_query = Product.query.filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None)))
+    recent_products_query = Product.query.filter(NON_GANCHO)
     recent_orders_query = Order.query.options(joinedload(Order.client))
 
     if active_store_id and active_store_id != 'all':
@@ -1108,14 +1390,9 @@ def inventory_list():
 
 
     if search_term:
-        search_pattern = f'%{search_term}%'
-        query = query.filter(or_(
-            Product.name.ilike(search_pattern),
-            Product.barcode.ilike(search_pattern),
-            Product.codigo_producto.ilike(search_pattern),
-            Product.marca.ilike(search_pattern),
-            Product.size.ilike(search_pattern)
-        ))
+        # Un solo ILIKE sobre el texto concatenado (indexado con pg_trgm) en lugar de
+        # cinco ILIKE unidos por OR, que obligaban a recorrer toda la tabla.
+        query = query.filter(PRODUCT_SEARCH_TEXT.ilike(f'%{search_term}%'))
 
     # Lógica de ordenación
     valid_sort_columns = {
@@ -1156,7 +1433,11 @@ def codigos_barra():
     sort_by = request.args.get('sort_by', 'id')
     sort_order = request.args.get('sort_order', 'desc')
 
-    query = Product.query
+    # Solo las columnas que muestra la tabla de etiquetas, sin hidratar objetos Product de todo el catálogo
+    query = select(
+        Product.id, Product.name, Product.barcode, Product.codigo_producto, Product.price_usd,
+        Product.marca, Product.size, Product.color
+    )
 
     # Lógica de ordenación
     valid_sort_columns = {
@@ -1172,10 +1453,10 @@ def codigos_barra():
     else:
         query = query.order_by(sort_column.asc())
 
-    products = query.all()
+    products = db.session.execute(query).all()
     groups = db.session.query(Product.grupo).distinct().order_by(Product.grupo).all()
     product_groups = [g[0] for g in groups if g[0]]
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     _, currency_symbol = get_main_calculation_currency_info()
 
     return render_template('inventario/codigos_barra.html', title='Imprimir Códigos de Barra', 
@@ -1222,23 +1503,102 @@ def codigos_barra_api():
 
     products = query.limit(500).all() # Limitar para no sobrecargar la respuesta
     
-    return jsonify(products=[{
+    response = jsonify(products=[{
         'id': p.id, 'name': p.name, 'barcode': p.barcode,
         'codigo_producto': p.codigo_producto, 'marca': p.marca,
         'size': p.size, 'color': p.color, 'price_usd': p.price_usd
     } for p in products])
 
-def generate_barcode_pdf_reportlab(products, company_info, currency_symbol):
+    # El buscador consulta en cada tecla: el navegador reutiliza la respuesta de la misma
+    # búsqueda durante 30s y, pasado ese tiempo, la revalida con ETag (304 sin cuerpo si no cambió).
+    response.cache_control.private = True
+    response.cache_control.max_age = 30
+    response.add_etag()
+    return make_conditional_compressed(response)
+
+def make_conditional_compressed(response):
+    """
+    Como response.make_conditional(request), pero acepta también los ETag que Flask-Compress
+    entrega al navegador con el sufijo del algoritmo (ej. "abc123:gzip"), de modo que la
+    revalidación siga respondiendo 304 con la compresión activa.
+    """
+    etag, _ = response.get_etag()
+    if etag:
+        for algorithm in current_app.config.get('COMPRESS_ALGORITHM', []):
+            compressed_etag = f'{etag}:{algorithm}'
+            if request.if_none_match.contains(compressed_etag):
+                response.status_code = 304
+                response.set_data(b'')
+                response.set_etag(compressed_etag)
+                return response
+    return response.make_conditional(request)
+
+@functools.lru_cache(maxsize=4096)
+def code128_bar_geometry(value, bar_width):
+    """
+    Calcula una sola vez por valor la geometría de las barras Code128.
+    Usa el codificador de ReportLab (misma selección de juegos de caracteres y mismo ancho
+    que code128.Code128) y obtiene con NumPy las posiciones x y anchos de cada barra.
+    Retorna (offsets, anchos, ancho_total) en puntos, sin zonas de silencio.
+    """
+    barcode_obj = code128.Code128(value, barWidth=bar_width, quiet=0)
+    barcode_obj.validate()
+    barcode_obj.encode()
+    barcode_obj.decompose()
+
+    # 'decomposed' alterna barras (mayúsculas) y espacios (minúsculas); la letra indica los módulos.
+    symbols = np.frombuffer(barcode_obj.decomposed.encode('ascii'), dtype=np.uint8)
+    is_bar = symbols < ord('a')
+    modules = np.where(is_bar, symbols - (ord('A') - 1), symbols - (ord('a') - 1)).astype(np.float64)
+    edges = np.concatenate(([0.0], np.cumsum(modules))) * bar_width
+    offsets = edges[:-1][is_bar]
+    widths = modules[is_bar] * bar_width
+    return tuple(offsets.tolist()), tuple(widths.tolist()), float(edges[-1])
+
+def draw_code128(c, value, x, y, bar_width, bar_height, quiet=True):
+    """
+    Dibuja un Code128 en el lienzo como un único path relleno, en lugar de un rect por barra.
+    Posición y tamaño equivalentes a code128.Code128(...).drawOn(c, x, y).
+    """
+    offsets, widths, _ = code128_bar_geometry(value, bar_width)
+    left = x + (max(inch * 0.25, bar_width * 10.0) if quiet else 0)
+    path = c.beginPath()
+    for offset, width in zip(offsets, widths):
+        path.rect(left + offset, y, width, bar_height)
+    c.drawPath(path, stroke=0, fill=1)
+
+# Una entrada por producto con el número de copias; el PDF repite la etiqueta sin duplicar los datos.
+LabelSpec = namedtuple('LabelSpec', 'id name barcode price_foreign count')
+
+def split_label_name(name):
+    """Divide el nombre del producto en hasta dos líneas de 27 caracteres para la etiqueta."""
+    product_name = name[:54]  # Allow longer names
+    if len(product_name) <= 27:
+        return product_name, ""
+    # Split into two lines
+    words = product_name.split()
+    line1 = ""
+    line2 = ""
+    for word in words:
+        if len(line1 + " " + word) <= 27:
+            line1 += " " + word if line1 else word
+        else:
+            line2 += " " + word if line2 else word
+    if not line2:
+        # If can't split nicely, force split
+        line1 = product_name[:27]
+        line2 = product_name[27:]
+    return line1, line2
+
+def generate_barcode_pdf_reportlab(specs, company_name, currency_symbol):
     """
     Generate PDF with barcodes using ReportLab for better performance.
     Layout: 4 columns x 10 rows = 40 labels per page
+    Recibe una lista de LabelSpec y dibuja `count` etiquetas por cada una.
     """
     # Create PDF buffer
     buffer = io.BytesIO()
 
-    # Importar Code128 aquí para que la función sea autocontenida
-    from reportlab.graphics.barcode import code128
-
     # Page dimensions
     page_width, page_height = A4
     margin = 3 * mm
@@ -1253,112 +1613,95 @@ def generate_barcode_pdf_reportlab(products, company_info, currency_symbol):
     # Create PDF canvas directly for more control
     c.setFont("Helvetica", 6)
 
-    # Process products in batches of 40 (4x10 grid)
-    for i in range(0, len(products), 40):
-        batch = products[i:i+40]
+    company_name = company_name[:20] if company_name else None
+    # Cambiar el símbolo de dólar a 'ref.' para las etiquetas
+    display_symbol = 'REF.' if currency_symbol == '$' else currency_symbol
 
-        for j, product in enumerate(batch):
-            # Calculate position in grid
-            col = j % 4
-            row = j // 4
+    # Posición dentro de la página actual (4x10 grid)
+    j = 0
+    for spec_index, spec in enumerate(specs):
+        if not spec.count or spec.count <= 0:
+            continue
 
-            # Calculate position coordinates
-            x = margin + col * label_width
-            y = page_height - margin - (row + 1) * label_height
+        # La etiqueta se dibuja una sola vez por producto como Form XObject del PDF;
+        # cada copia solo la referencia en su posición (no se reescriben las barras por etiqueta).
+        form_name = f"label{spec_index}"
+        c.beginForm(form_name)
 
-            # Company name (top right)
-            if company_info and company_info.name:
-                c.setFont("Helvetica-Bold", 8)
-                company_name = company_info.name[:20]
-                # Right align company name
-                text_width = c.stringWidth(company_name, "Helvetica-Bold", 8)
-                c.drawString(x + 1*mm, y + label_height - 3*mm, company_name)
-
-            # Product name (centered, allow two lines for long names)
-            c.setFont("Helvetica", 8)
-            product_name = product['name'][:54]  # Allow longer names
-            if len(product_name) > 27:
-                # Split into two lines
-                words = product_name.split()
-                line1 = ""
-                line2 = ""
-                for word in words:
-                    if len(line1 + " " + word) <= 27:
-                        line1 += " " + word if line1 else word
-                    else:
-                        line2 += " " + word if line2 else word
-                if not line2:
-                    # If can't split nicely, force split
-                    line1 = product_name[:27]
-                    line2 = product_name[27:]
-            else:
-                line1 = product_name
-                line2 = ""
-
-            # Draw first line
-            text_width = c.stringWidth(line1, "Helvetica", 8)
-            c.drawString(x + (label_width - text_width) / 2, y + label_height - 6*mm, line1)
-
-            # Draw second line if exists
-            if line2:
-                text_width = c.stringWidth(line2, "Helvetica", 8)
-                c.drawString(x + (label_width - text_width) / 2, y + label_height - 9*mm, line2)
-
-            # Price (below product name, adjust position if two lines)
-            c.setFont("Helvetica-Bold", 9)
-            # Cambiar el símbolo de dólar a 'ref.' para las etiquetas
-            display_symbol = 'REF.' if currency_symbol == '$' else currency_symbol
-            price_text = f"{display_symbol} {product['price_foreign']:.2f}"
-            text_width = c.stringWidth(price_text, "Helvetica-Bold", 9)
-            price_y = y + label_height - 3*mm
-            c.drawString(x + label_width - text_width - 2*mm, price_y, price_text)
-
-            # Barcode (bottom, lowered to make space)
-            if product['barcode']:
-                try:
-                    # Calculate available width for barcode (full label width minus small margins)
-                    available_width = label_width - 4*mm  # Leave 2mm margin on each side
-
-                    # Create barcode using ReportLab with full width
-                    barcode_obj = code128.Code128( # Esta línea estaba fallando por la importación faltante
-                        product['barcode'],
-                        barWidth=0.45*mm,  # Slightly thinner bars to fit more
-                        barHeight=12*mm,    # Taller barcode
-                        quiet=1
-                    )
+        # Company name (top left)
+        if company_name:
+            c.setFont("Helvetica-Bold", 8)
+            c.drawString(1*mm, label_height - 3*mm, company_name)
 
-                    # Position barcode to span full width of label, lowered
-                    barcode_x = x - 4*mm  # 2mm left margin
-                    barcode_y = y + 6*mm  # Lowered from 6mm to 3mm to make space
+        # Product name (centered, allow two lines for long names)
+        line1, line2 = split_label_name(spec.name or "")
+        c.setFont("Helvetica", 8)
+        c.drawString((label_width - c.stringWidth(line1, "Helvetica", 8)) / 2, label_height - 6*mm, line1)
 
-                    # Draw barcode on canvas
-                    barcode_obj.drawOn(c, barcode_x, barcode_y)
+        # Draw second line if exists
+        if line2:
+            c.drawString((label_width - c.stringWidth(line2, "Helvetica", 8)) / 2, label_height - 9*mm, line2)
 
-                    # Add barcode text below the barcode
-                    c.setFont("Helvetica", 12)  # Small font for barcode text
-                    barcode_text = product['barcode']
-                    text_width = c.stringWidth(barcode_text, "Helvetica", 12)
-                    text_x = x + (label_width - text_width) / 2  # Center the text
-                    text_y = barcode_y - 4*mm  # Position below barcode
+        # Price (top right)
+        c.setFont("Helvetica-Bold", 9)
+        price_text = f"{display_symbol} {spec.price_foreign:.2f}"
+        c.drawString(label_width - c.stringWidth(price_text, "Helvetica-Bold", 9) - 2*mm, label_height - 3*mm, price_text)
 
-                    c.drawString(text_x, text_y, barcode_text)
+        # Barcode (bottom, lowered to make space)
+        if spec.barcode:
+            try:
+                # Position barcode to span full width of label, lowered
+                barcode_x = -4*mm  # 2mm left margin
+                barcode_y = 6*mm  # Lowered from 6mm to 3mm to make space
+
+                # Draw barcode on canvas (geometría cacheada por código, un solo path por etiqueta)
+                draw_code128(
+                    c, spec.barcode, barcode_x, barcode_y,
+                    bar_width=0.45*mm,  # Slightly thinner bars to fit more
+                    bar_height=12*mm    # Taller barcode
+                )
 
-                except Exception as e:
-                    current_app.logger.error(f"Error generating barcode for {product['barcode']}: {e}")
-                    # Draw error text instead
-                    c.setFont("Helvetica-Bold", 6)
-                    c.drawString(x + 2*mm, y + 4*mm, "Error")
+                # Add barcode text below the barcode
+                c.setFont("Helvetica", 12)  # Small font for barcode text
+                text_x = (label_width - c.stringWidth(spec.barcode, "Helvetica", 12)) / 2  # Center the text
+                text_y = barcode_y - 4*mm  # Position below barcode
 
-            # Draw dashed border around the label with thinner lines and dash pattern for segmentation
-            c.setLineWidth(0.5)
-            c.setDash(2 * mm, 2 * mm)  # 2mm dash, 2mm gap
-            c.rect(x, y, label_width, label_height, stroke=1, fill=0)
-            c.setDash()  # reset dash pattern to solid
+                c.drawString(text_x, text_y, spec.barcode)
 
-        # Start new page if there are more products
-        if i + 40 < len(products):
-            c.showPage()
-            c.setFont("Helvetica", 6)
+            except Exception as e:
+                current_app.logger.error(f"Error generating barcode for {spec.barcode}: {e}")
+                # Draw error text instead
+                c.setFont("Helvetica-Bold", 6)
+                c.drawString(2*mm, 4*mm, "Error")
+
+        # Draw dashed border around the label with thinner lines and dash pattern for segmentation
+        c.setLineWidth(0.5)
+        c.setDash(2 * mm, 2 * mm)  # 2mm dash, 2mm gap
+        c.rect(0, 0, label_width, label_height, stroke=1, fill=0)
+        c.setDash()  # reset dash pattern to solid
+
+        c.endForm()
+
+        for _ in range(spec.count):
+            # Start new page if the current one is full
+            if j == 40:
+                c.showPage()
+                c.setFont("Helvetica", 6)
+                j = 0
+
+            # Calculate position in grid
+            col = j % 4
+            row = j // 4
+            j += 1
+
+            # Calculate position coordinates
+            x = margin + col * label_width
+            y = page_height - margin - (row + 1) * label_height
+
+            c.saveState()
+            c.translate(x, y)
+            c.doForm(form_name)
+            c.restoreState()
 
     # Save PDF
     c.save()
@@ -1370,6 +1713,48 @@ def generate_barcode_pdf_reportlab(products, company_info, currency_symbol):
     return pdf_data
 
 
+# Trabajos de impresión de etiquetas en segundo plano: {job_id: {...}}.
+# Viven en memoria del proceso (la app corre con un solo worker eventlet por Socket.IO).
+barcode_jobs = {}
+BARCODE_JOB_TTL = 15 * 60  # segundos que se conserva un PDF generado
+
+def _run_barcode_job(app, job_id, specs, company_name, currency_symbol):
+    """Genera el PDF de un trabajo de etiquetas fuera de la petición que lo solicitó."""
+    with app.app_context():
+        job = barcode_jobs[job_id]
+        try:
+            start_time = time.time()
+            if eventlet:
+                # ReportLab es CPU: se ejecuta en un hilo real para no bloquear el hub de eventlet.
+                pdf_data = eventlet.tpool.execute(contextvars.copy_context().run, generate_barcode_pdf_reportlab, specs, company_name, currency_symbol)
+            else:
+                pdf_data = generate_barcode_pdf_reportlab(specs, company_name, currency_symbol)
+            job.update(status='done', pdf=pdf_data)
+            current_app.logger.info(f"Trabajo de etiquetas {job_id} generado en {time.time() - start_time:.2f} segundos.")
+        except Exception as e:
+            current_app.logger.error(f"Error generating barcode PDF for job {job_id}: {e}")
+            job.update(status='error', error=str(e))
+
+def submit_barcode_job(specs, company_name, currency_symbol, filename):
+    """Registra un trabajo de etiquetas, lo lanza en segundo plano y retorna su id."""
+    now = time.time()
+    for expired_id in [jid for jid, job in barcode_jobs.items() if now - job['created'] > BARCODE_JOB_TTL]:
+        barcode_jobs.pop(expired_id, None)
+
+    job_id = secrets.token_urlsafe(16)
+    barcode_jobs[job_id] = {
+        'status': 'pending', 'pdf': None, 'error': None,
+        'created': now, 'user_id': current_user.id, 'filename': filename
+    }
+    socketio.start_background_task(_run_barcode_job, current_app._get_current_object(), job_id, specs, company_name, currency_symbol)
+    return job_id
+
+def get_barcode_job_or_404(job_id):
+    job = barcode_jobs.get(job_id)
+    if not job or job['user_id'] != current_user.id:
+        abort(404)
+    return job
+
 @routes_blueprint.route('/inventario/imprimir_codigos_barra', methods=['POST'])
 @login_required
 def imprimir_codigos_barra():
@@ -1377,52 +1762,75 @@ def imprimir_codigos_barra():
         flash('Acceso denegado. Solo los administradores pueden realizar esta acción.', 'danger')
         return redirect(request.referrer or url_for('main.dashboard'))
 
+    is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
     product_ids = request.form.getlist('product_ids')
     if not product_ids:
+        if is_ajax:
+            return jsonify(error='No se seleccionó ningún producto para imprimir.'), 400
         flash('No se seleccionó ningún producto para imprimir.', 'warning')
         return redirect(url_for('main.codigos_barra'))
 
-    products_to_print = Product.query.filter(Product.id.in_(product_ids)).all()
-    company_info = CompanyInfo.query.first()
-    
-    _, currency_symbol = get_main_calculation_currency_info()
-
-    # Preparar datos de productos para ReportLab, repitiendo por existencia.
-    products_dict = []
-    total_labels = 0
     MAX_LABELS = 10000  # Límite para prevenir sobrecarga del servidor.
 
-    # Primero, calcular el número total de etiquetas para verificar el límite.
-    for p in products_to_print:
-        total_labels += p.stock if p.stock and p.stock > 0 else 0
-    
+    # Existencia total por producto calculada en SQL (Product.stock es una propiedad que suma stock_levels).
+    stock_subquery = select(
+        ProductStock.product_id,
+        func.sum(ProductStock.quantity).label('stock')
+    ).where(ProductStock.product_id.in_(product_ids)).group_by(ProductStock.product_id).subquery()
+
+    # Primero, calcular el número total de etiquetas para verificar el límite, sin cargar los productos.
+    total_labels = db.session.execute(
+        select(func.coalesce(func.sum(stock_subquery.c.stock), 0)).where(stock_subquery.c.stock > 0)
+    ).scalar()
+
     if total_labels > MAX_LABELS:
-        flash(f'Ha intentado imprimir {total_labels} etiquetas, lo cual supera el límite de {MAX_LABELS}. Por favor, seleccione menos productos.', 'danger')
+        message = f'Ha intentado imprimir {total_labels} etiquetas, lo cual supera el límite de {MAX_LABELS}. Por favor, seleccione menos productos.'
+        if is_ajax:
+            return jsonify(error=message), 400
+        flash(message, 'danger')
         return redirect(url_for('main.codigos_barra'))
 
     if total_labels == 0:
-        flash('Los productos seleccionados no tienen existencia. No se generaron códigos de barra.', 'warning')
+        message = 'Los productos seleccionados no tienen existencia. No se generaron códigos de barra.'
+        if is_ajax:
+            return jsonify(error=message), 400
+        flash(message, 'warning')
         return redirect(url_for('main.codigos_barra'))
 
-    # Si estamos dentro del límite, construir la lista de etiquetas.
-    for p in products_to_print:
-        if p.stock and p.stock > 0:
-            price_foreign = p.price_usd if p.price_usd else 0
-            for _ in range(p.stock):
-                products_dict.append({
-                    'id': p.id,
-                    'name': p.name,
-                    'barcode': p.barcode,
-                    'price_foreign': price_foreign
-                })
+    # Si estamos dentro del límite, cargar solo las columnas de la etiqueta y construir las especificaciones.
+    products_to_print = db.session.execute(
+        select(Product.id, Product.name, Product.barcode, Product.price_usd, stock_subquery.c.stock)
+        .join(stock_subquery, Product.id == stock_subquery.c.product_id)
+        .where(stock_subquery.c.stock > 0)
+    ).all()
+    specs = [LabelSpec(p.id, p.name, p.barcode, p.price_usd or 0, p.stock) for p in products_to_print]
+
+    company_info = get_company_info()
+    _, currency_symbol = get_main_calculation_currency_info()
+
+    current_app.logger.info(f"Preparando datos para generación de PDF con {total_labels} etiquetas para {len(products_to_print)} productos distintos.")
+    company_name = company_info.name if company_info else None
 
-    current_app.logger.info(f"Preparando datos para generación de PDF con {len(products_dict)} etiquetas para {len(products_to_print)} productos distintos.")
+    # Desde la pantalla de códigos el PDF se genera en segundo plano y el navegador consulta su estado.
+    if is_ajax:
+        job_id = submit_barcode_job(specs, company_name, currency_symbol, 'codigos_de_barra.pdf')
+        log_user_activity(
+            action="Imprimió códigos de barra",
+            details=f"Generó PDF con {total_labels} etiquetas para {len(products_to_print)} productos.",
+            target_id=None,
+            target_type="BarcodePrinting")
+        return jsonify(
+            job_id=job_id,
+            status_url=url_for('main.barcode_job_status', job_id=job_id),
+            download_url=url_for('main.barcode_job_download', job_id=job_id)
+        ), 202
 
     # Generate PDF with ReportLab (more efficient)
     try:
         start_time = time.time()
 
-        pdf_data = generate_barcode_pdf_reportlab(products_dict, company_info, currency_symbol)
+        pdf_data = generate_barcode_pdf_reportlab(specs, company_name, currency_symbol)
 
         generation_time = time.time() - start_time
         current_app.logger.info(f"PDF generado exitosamente con ReportLab en {generation_time:.2f} segundos")
@@ -1467,6 +1875,20 @@ def imprimir_codigos_barra():
         target_id=None,
         target_type="BarcodePrinting")
 
+@routes_blueprint.route('/inventario/codigos_barra/estado/<job_id>')
+@login_required
+def barcode_job_status(job_id):
+    job = get_barcode_job_or_404(job_id)
+    return jsonify(status=job['status'], error=job['error'])
+
+@routes_blueprint.route('/inventario/codigos_barra/descargar/<job_id>')
+@login_required
+def barcode_job_download(job_id):
+    job = get_barcode_job_or_404(job_id)
+    if job['status'] != 'done':
+        return jsonify(status=job['status'], error=job['error']), 409
+    return Response(job['pdf'], mimetype='application/pdf', headers={'Content-Disposition': f"inline; filename={job['filename']}"})
+
 @routes_blueprint.route('/inventario/carga_masiva/imprimir_codigos/<int:log_id>', methods=['GET'])
 @login_required
 def print_bulk_load_barcodes(log_id):
@@ -1485,26 +1907,18 @@ def print_bulk_load_barcodes(log_id):
         flash('Esta carga masiva no contiene productos para imprimir.', 'warning')
         return redirect(url_for('main.bulk_load_detail', log_id=log_id))
 
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     _, currency_symbol = get_main_calculation_currency_info()
 
-    products_dict = []
-    for movement in movements:
-        product = movement.product
-        price_foreign = product.price_usd if product.price_usd else 0
-        for _ in range(movement.quantity):
-            products_dict.append({
-                'id': product.id,
-                'name': product.name,
-                'barcode': product.barcode,
-                'price_foreign': price_foreign
-            })
+    specs = [LabelSpec(m.product.id, m.product.name, m.product.barcode, m.product.price_usd or 0, m.quantity)
+             for m in movements]
+    total_labels = sum(spec.count for spec in specs if spec.count and spec.count > 0)
 
-    current_app.logger.info(f"Generando PDF con {len(products_dict)} etiquetas para la carga masiva #{log_id}.")
+    current_app.logger.info(f"Generando PDF con {total_labels} etiquetas para la carga masiva #{log_id}.")
 
     try:
         start_time = time.time()
-        pdf_data = generate_barcode_pdf_reportlab(products_dict, company_info, currency_symbol)
+        pdf_data = generate_barcode_pdf_reportlab(specs, company_info.name if company_info else None, currency_symbol)
         generation_time = time.time() - start_time
         current_app.logger.info(f"PDF de carga masiva generado en {generation_time:.2f} segundos.")
         return Response(pdf_data, mimetype='application/pdf', headers={'Content-Disposition': f'inline; filename=codigos_carga_{log_id}.pdf'})
@@ -1521,6 +1935,8 @@ def inventory_stock():
 
     selected_warehouse_id = request.args.get('warehouse_id', type=int)
     show_zero_stock = request.args.get('show_zero_stock') == 'on'
+    search_term = request.args.get('search', '').strip()
+    page = request.args.get('page', 1, type=int)
 
     active_store_id = session.get('active_store_id')
     warehouses_query = Warehouse.query.order_by(Warehouse.id)
@@ -1530,6 +1946,7 @@ def inventory_stock():
 
     products_data = [] # This will hold {'product': Product_obj, 'stock': quantity}
     selected_warehouse_name = None
+    pagination = None
 
     if selected_warehouse_id:
         selected_warehouse_obj = next((wh for wh in warehouses if wh.id == selected_warehouse_id), None)
@@ -1540,13 +1957,15 @@ def inventory_stock():
         query = db.session.query(Product, ProductStock.quantity) \
                           .join(ProductStock, Product.id == ProductStock.product_id) \
                           .filter(ProductStock.warehouse_id == selected_warehouse_id) \
-                          .filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None)))
+                          .filter(NON_GANCHO)
 
         if not show_zero_stock:
             query = query.filter(ProductStock.quantity > 0)
-        
-        products_with_stock_tuples = query.order_by(Product.name).all()
-        products_data = [{'product': p, 'stock': q} for p, q in products_with_stock_tuples]
+        if search_term:
+            query = query.filter(PRODUCT_SEARCH_TEXT.ilike(f'%{search_term}%'))
+
+        pagination = query.order_by(Product.name).paginate(page=page, per_page=50, error_out=False)
+        products_data = [{'product': p, 'stock': q} for p, q in pagination.items]
 
     else:
         # If no specific warehouse is selected, show all products with their total stock
@@ -1566,7 +1985,7 @@ def inventory_stock():
             Product,
             func.coalesce(total_stock_subquery.c.total_quantity, 0).label('total_stock')
         ).outerjoin(total_stock_subquery, Product.id == total_stock_subquery.c.product_id) \
-        .filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None)))
+        .filter(NON_GANCHO)
 
         if active_store_id and active_store_id != 'all':
             # We need to join to filter by store, but only if we are filtering
@@ -1574,13 +1993,17 @@ def inventory_stock():
 
         if not show_zero_stock:
             query = query.filter(func.coalesce(total_stock_subquery.c.total_quantity, 0) > 0)
-        
-        products_with_stock_tuples = query.order_by(Product.name).all()
-        products_data = [{'product': p, 'stock': q} for p, q in products_with_stock_tuples]
+        if search_term:
+            query = query.filter(PRODUCT_SEARCH_TEXT.ilike(f'%{search_term}%'))
+
+        pagination = query.order_by(Product.name).paginate(page=page, per_page=50, error_out=False)
+        products_data = [{'product': p, 'stock': q} for p, q in pagination.items]
 
     return render_template('inventario/existencias.html',
                            title='Existencias por Almacén',
                            products_data=products_data,
+                           pagination=pagination,
+                           search_term=search_term,
                            warehouses=warehouses,
                            selected_warehouse_id=selected_warehouse_id,
                            selected_warehouse_name=selected_warehouse_name,
@@ -1629,9 +2052,12 @@ def inventory_stock_report_pdf():
     for warehouse in warehouses_to_process:
         # Base query for products in the current warehouse
         # We use an outerjoin to be able to include products with zero stock.
-        query = db.session.query(Product, func.coalesce(ProductStock.quantity, 0)) \
-            .outerjoin(ProductStock, (Product.id == ProductStock.product_id) & (ProductStock.warehouse_id == warehouse.id)) \
-            .filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None)))
+        # Solo las columnas del reporte (tuplas, no objetos Product), leídas por lotes con yield_per.
+        query = db.session.query(
+            Product.barcode, Product.codigo_producto, Product.name, Product.marca, Product.color, Product.size,
+            func.coalesce(ProductStock.quantity, 0)
+        ).outerjoin(ProductStock, (Product.id == ProductStock.product_id) & (ProductStock.warehouse_id == warehouse.id)) \
+            .filter(NON_GANCHO)
 
         # Apply group filter if provided
         if group_filter:
@@ -1641,17 +2067,16 @@ def inventory_stock_report_pdf():
         if not show_zero_stock:
             query = query.filter(ProductStock.quantity > 0)
 
-        products_with_stock_tuples = query.order_by(Product.name).all()
+        products_data = [{'product': row, 'stock': row[-1]} for row in query.order_by(Product.name).yield_per(1000)]
         
         # Only add warehouse to report if it has products matching the filter
-        if products_with_stock_tuples:
-            products_data = [{'product': p, 'stock': q} for p, q in products_with_stock_tuples]
+        if products_data:
             report_data.append({
                 'warehouse_name': warehouse.name,
                 'products': products_data
             })
 
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     generation_date = get_current_time_ve().strftime('%d/%m/%Y %H:%M:%S')
 
     html_string = render_template('pdf/inventory_stock_report.html',
@@ -1660,10 +2085,7 @@ def inventory_stock_report_pdf():
                                   generation_date=generation_date,
                                   group_filter=group_filter)
 
-    if eventlet:
-        pdf_file = eventlet.tpool.execute(HTML(string=html_string, base_url=request.base_url).write_pdf)
-    else:
-        pdf_file = HTML(string=html_string, base_url=request.base_url).write_pdf()
+    pdf_file = html_to_pdf(html_string)
 
     response = Response(pdf_file, mimetype='application/pdf', headers={'Content-Disposition': 'inline; filename=reporte_existencias.pdf'})
     return response
@@ -1714,7 +2136,7 @@ def inventory_adjustment():
             total_value_difference = 0.0
             
             for adj_str in adjustments:
-                data = json.loads(adj_str)
+                data = orjson.loads(adj_str)
                 product_id = int(data['product_id'])
                 real_stock = int(data['real_stock'])
                 
@@ -1780,7 +2202,7 @@ def inventory_adjustment():
             return redirect(url_for('main.inventory_adjustment'))
 
     # Cargar productos con su stock en el almacén seleccionado
-    products_with_stock = db.session.query(Product, ProductStock.quantity).outerjoin(ProductStock, (Product.id == ProductStock.product_id) & (ProductStock.warehouse_id == warehouse_id)).filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None))).order_by(Product.name).all()
+    products_with_stock = db.session.query(Product, ProductStock.quantity).outerjoin(ProductStock, (Product.id == ProductStock.product_id) & (ProductStock.warehouse_id == warehouse_id)).filter(NON_GANCHO).order_by(Product.name).all()
     
     active_store_id = session.get('active_store_id')
     warehouses_query = Warehouse.query.order_by(Warehouse.id)
@@ -1830,7 +2252,7 @@ def adjustment_result(adjustment_id):
     # We exclude 'Ganchos' as they are supplies, not for sale.
     total_inventory_value_after_query = db.session.query(
         func.sum(ProductStock.quantity * Product.cost_usd)
-    ).join(Product).filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None))).first()
+    ).join(Product).filter(NON_GANCHO).first()
     value_after = total_inventory_value_after_query[0] or 0.0
 
     # 2. Calculate the value *before* by subtracting the adjustment's impact.
@@ -1860,7 +2282,7 @@ def print_adjustment_report(adjustment_id):
         joinedload(InventoryAdjustment.user)
     ).get_or_404(adjustment_id)
 
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     generation_date = get_current_time_ve().strftime('%d/%m/%Y %H:%M:%S')
     
     html_string = render_template('pdf/adjustment_report.html',
@@ -1868,10 +2290,7 @@ def print_adjustment_report(adjustment_id):
                                   company_info=company_info,
                                   generation_date=generation_date)
 
-    if eventlet:
-        pdf_file = eventlet.tpool.execute(HTML(string=html_string, base_url=request.base_url).write_pdf)
-    else:
-        pdf_file = HTML(string=html_string, base_url=request.base_url).write_pdf()
+    pdf_file = html_to_pdf(html_string)
 
     return Response(pdf_file, mimetype='application/pdf', headers={'Content-Disposition': f'inline; filename=ajuste_{adjustment.id}.pdf'})
 
@@ -1914,6 +2333,7 @@ def new_product():
             )
             db.session.add(new_prod)
             db.session.commit()
+            clear_reference_caches()
 
             log_user_activity(
                 action="Creó nuevo producto",
@@ -1955,6 +2375,7 @@ def edit_product(product_id):
             product.grupo = request.form.get('grupo')
 
             db.session.commit()
+            clear_reference_caches()
             log_user_activity(
                 action="Modificó producto",
                 details=f"Producto: {product.name}",
@@ -1986,8 +2407,9 @@ def client_list():
     if active_store_id and active_store_id != 'all':
         # Mostrar solo clientes que han comprado en la sucursal activa
         clients_query = clients_query.join(Order).filter(Order.store_id == active_store_id).distinct()
-    clients = clients_query.order_by(Client.name).all()
-    return render_template('clientes/lista.html', title='Lista de Clientes', clients=clients)
+    page = request.args.get('page', 1, type=int)
+    pagination = clients_query.order_by(Client.name).paginate(page=page, per_page=50, error_out=False)
+    return render_template('clientes/lista.html', title='Lista de Clientes', clients=pagination.items, pagination=pagination)
 
 @routes_blueprint.route('/clientes/nuevo', methods=['GET', 'POST'])
 @login_required
@@ -2011,6 +2433,7 @@ def new_client():
             new_cli = Client(name=name, cedula_rif=cedula_rif, email=email, phone=phone, address=address)
             db.session.add(new_cli)
             db.session.commit()
+            clear_reference_caches()
 
             log_user_activity(
                 action="Creó nuevo cliente",
@@ -2050,6 +2473,7 @@ def edit_client(client_id):
             client.provider_id = int(provider_id) if provider_id else None
 
             db.session.commit()
+            clear_reference_caches()
 
             log_user_activity(
                 action="Editó cliente",
@@ -2084,7 +2508,7 @@ def client_detail(client_id):
 
         try:
             payment_data_json = request.form.get('payments_data')
-            payment_info = json.loads(payment_data_json)[0]
+            payment_info = orjson.loads(payment_data_json)[0]
 
             payment_date = get_current_time_ve()
             if payment_info.get('date'):
@@ -2132,18 +2556,7 @@ def client_detail(client_id):
                 pos_id=payment_info.get('pos_id'), cash_box_id=payment_info.get('cash_box_id')
             )
             db.session.add(payment)
-
-            if payment.bank_id:
-                bank = Bank.query.get(payment.bank_id)
-                if bank and bank.currency == 'VES': bank.balance += payment.amount_ves_equivalent
-            elif payment.pos_id:
-                pos = PointOfSale.query.get(payment.pos_id)
-                if pos and pos.bank: pos.bank.balance += payment.amount_ves_equivalent
-            elif payment.cash_box_id:
-                cash_box = CashBox.query.get(payment.cash_box_id)
-                if cash_box:
-                    if payment.currency_paid == 'VES': cash_box.balance_ves += payment.amount_paid # type: ignore
-                    elif payment.currency_paid == 'USD': cash_box.balance_usd += payment.amount_paid # type: ignore
+            apply_payment_to_account(payment)
 
             db.session.flush()
             if order.due_amount <= 0.01:
@@ -2165,7 +2578,7 @@ def client_detail(client_id):
 
     # --- GET Request Logic ---
     all_movements = []
-    orders = Order.query.filter_by(client_id=client.id).options(subqueryload(Order.payments)).order_by(Order.date_created.asc()).all()
+    orders = Order.query.filter_by(client_id=client.id).options(selectinload(Order.payments)).order_by(Order.date_created.asc()).all()
 
     # 1. Orders (Sales, Credits, Reservations, Debit Notes)
     for order in orders:
@@ -2194,11 +2607,11 @@ def client_detail(client_id):
         payments = Payment.query.filter(
             Payment.order_id.in_(order_ids),
             Payment.method != 'credito_cliente'
-        ).options(joinedload(Payment.order)).order_by(Payment.date.asc()).all()
+        ).order_by(Payment.date.asc()).all()
         for payment in payments:
             all_movements.append({
                 'date': payment.date, 'type_display': 'Abono', 'type_class': 'pago',
-                'description': f"Abono a Orden #{payment.order.id:09d}", 'debit_usd': 0,
+                'description': f"Abono a Orden #{payment.order_id:09d}", 'debit_usd': 0,
                 'credit_usd': payment.amount_usd_equivalent, 'link': url_for('main.order_detail', order_id=payment.order_id),
                 'raw_obj': payment
             })
@@ -2233,7 +2646,14 @@ def client_detail(client_id):
     all_movements.sort(key=lambda x: x['date'], reverse=True)
 
     # --- Data for Widgets and Modals ---
-    total_due = sum(order.due_amount_usd for order in orders if order.due_amount_usd > 0)
+    # Deuda total calculada en la BD (misma regla que Order.due_amount_usd: solo saldos > 0.01)
+    paid_usd_sq = select(func.coalesce(func.sum(Payment.amount_usd_equivalent), 0)) \
+        .where(Payment.order_id == Order.id).correlate(Order).scalar_subquery()
+    order_due_usd = func.coalesce(Order.total_amount_usd, 0) - paid_usd_sq
+    total_due = db.session.execute(
+        select(func.coalesce(func.sum(order_due_usd), 0.0))
+        .where(Order.client_id == client.id, order_due_usd > 0.01)
+    ).scalar()
     provider_balance_usd = client.associated_provider.get_balance_usd() if client.associated_provider else 0
     client_credit_balance_usd = client.credit_balance_usd or 0.0
     banks = Bank.query.order_by(Bank.name).all()
@@ -2332,6 +2752,7 @@ def new_provider():
             )
 
             db.session.commit()
+            clear_reference_caches()
             flash('Proveedor creado exitosamente!', 'success')
             return redirect(url_for('main.provider_list'))
         except IntegrityError as e:
@@ -2344,7 +2765,7 @@ def new_provider():
             flash(f'Ocurrió un error inesperado: {e}', 'danger')
 
     # Cargar clientes para el dropdown de asociación
-    clients = Client.query.order_by(Client.name).all()
+    clients = get_client_options()
     return render_template('proveedores/nuevo.html', title='Nuevo Proveedor', clients=clients)
 
 @routes_blueprint.route('/proveedores/detalle/<int:provider_id>')
@@ -2367,7 +2788,7 @@ def provider_detail(provider_id):
 def edit_provider(provider_id):
     
     # Cargar clientes para el dropdown de asociación
-    clients = Client.query.order_by(Client.name).all()
+    clients = get_client_options()
     associated_client = Client.query.filter_by(provider_id=provider_id).first()
 
     provider = Provider.query.get_or_404(provider_id)
@@ -2432,8 +2853,9 @@ def purchase_list():
         flash('Acceso denegado. Solo los administradores pueden ver esta sección.', 'danger')
         return redirect(request.referrer or url_for('main.dashboard'))
 
-    purchases = Purchase.query.all()
-    return render_template('compras/lista.html', title='Lista de Compras', purchases=purchases)
+    page = request.args.get('page', 1, type=int)
+    pagination = Purchase.query.order_by(Purchase.id.desc()).paginate(page=page, per_page=50, error_out=False)
+    return render_template('compras/lista.html', title='Lista de Compras', purchases=pagination.items, pagination=pagination)
 
 @routes_blueprint.route('/compras/detalle/<int:purchase_id>')
 @login_required
@@ -2453,26 +2875,27 @@ def new_purchase():
         flash('Acceso denegado. Solo los administradores pueden realizar esta acción.', 'danger')
         return redirect(request.referrer or url_for('main.dashboard'))
 
-    # Convertir proveedores a una lista de diccionarios para que sea serializable a JSON y usable en JS
-    providers_query = Provider.query.order_by(Provider.name).all()
-    providers = [
-        {
-            'id': p.id, 'name': p.name, 'tax_id': p.tax_id,
-            'phone': p.phone, 'email': p.email, 'address': p.address
-        }
-        for p in providers_query
-    ]
-
-    
-    # Convertir productos a una lista de diccionarios para que sea serializable a JSON
-    products_query = Product.query.order_by(Product.name).all()
-    products = [
-        {
-            'id': p.id, 'name': p.name, 'barcode': p.barcode, 
-            'cost_usd': p.cost_usd, 'stock': p.stock
-        } 
-        for p in products_query
-    ]
+    # Convertir proveedores a una lista de diccionarios para que sea serializable a JSON y usable en JS.
+    # Solo se seleccionan las columnas que usa el formulario.
+    providers = [dict(row) for row in db.session.execute(
+        select(Provider.id, Provider.name, Provider.tax_id, Provider.phone, Provider.email, Provider.address)
+        .order_by(Provider.name)
+    ).mappings()]
+
+    # Convertir productos a una lista de diccionarios para que sea serializable a JSON.
+    # Existencia total sumada en SQL en vez de cargar cada Product con todos sus stock_levels.
+    total_stock_subquery = select(
+        ProductStock.product_id,
+        func.sum(ProductStock.quantity).label('total_quantity')
+    ).group_by(ProductStock.product_id).subquery()
+    products = [dict(row) for row in db.session.execute(
+        select(
+            Product.id, Product.name, Product.barcode, Product.cost_usd,
+            func.coalesce(total_stock_subquery.c.total_quantity, 0).label('stock')
+        )
+        .outerjoin(total_stock_subquery, Product.id == total_stock_subquery.c.product_id)
+        .order_by(Product.name)
+    ).mappings()]
 
     active_store_id = session.get('active_store_id')
     banks = Bank.query.order_by(Bank.name).all()
@@ -2517,7 +2940,7 @@ def new_purchase():
         quantities = request.form.getlist('quantity[]')
         costs_usd = request.form.getlist('cost_usd[]')
         payments_data_json = request.form.get('payments_data')
-        payments_data = json.loads(payments_data_json) if payments_data_json else []
+        payments_data = orjson.loads(payments_data_json) if payments_data_json else []
 
         try:
             # Create Purchase and Items
@@ -2526,25 +2949,36 @@ def new_purchase():
             db.session.flush()
             
             total_cost_ves = 0
+            purchase_items = []
+            # Cargar todos los productos de la compra en una sola consulta (evita un SELECT por ítem)
+            product_ids_int = {int(p_id) for p_id in product_ids}
+            products_map = {p.id: p for p in Product.query.filter(Product.id.in_(product_ids_int)).all()} if product_ids_int else {}
             for p_id, q, c_usd in zip(product_ids, quantities, costs_usd):
-                product = Product.query.get(p_id)
+                product = products_map.get(int(p_id))
                 quantity = int(q)
                 cost_usd = float(c_usd)
                 if product and quantity > 0 and cost_usd >= 0:
                     cost_ves = cost_usd * current_rate
-                    item = PurchaseItem(
+                    purchase_items.append(PurchaseItem(
                         purchase_id=new_purchase.id,
-                        product_id=p_id,
+                        product_id=product.id,
                         quantity=quantity,
                         cost=cost_ves
-                    )
-                    db.session.add(item)
+                    ))
                     total_cost_ves += cost_ves * quantity
-            
+
+            # Los items son inserciones puras: un solo INSERT multi-fila sin seguimiento del unit of work
+            db.session.bulk_save_objects(purchase_items)
             new_purchase.total_cost = total_cost_ves
             db.session.flush()
 
             # Process Payments (as ManualFinancialMovement with type 'Egreso')
+            # Precargar los bancos y cajas usados por los pagos (evita un SELECT por pago)
+            bank_ids = {int(p['bank_id']) for p in payments_data if p.get('bank_id')}
+            cash_box_ids = {int(p['cash_box_id']) for p in payments_data if p.get('cash_box_id')}
+            banks_map = {b.id: b for b in Bank.query.filter(Bank.id.in_(bank_ids)).all()} if bank_ids else {}
+            cash_boxes_map = {cb.id: cb for cb in CashBox.query.filter(CashBox.id.in_(cash_box_ids)).all()} if cash_box_ids else {}
+
             total_paid_ves = 0
             for payment_info in payments_data:
                 amount_paid = float(payment_info['amount_paid'])
@@ -2564,13 +2998,13 @@ def new_purchase():
 
                 # Decrease balance of the corresponding account
                 if movement.bank_id:
-                    bank = Bank.query.get(movement.bank_id)
+                    bank = banks_map.get(int(movement.bank_id))
                     if bank:
                         # Payments from banks are always registered as their VES equivalent for accounting
                         # but the balance update must respect the bank's currency.
                         if bank.currency == 'VES': bank.balance -= amount_ves_equivalent
                 elif movement.cash_box_id:
-                    cash_box = CashBox.query.get(movement.cash_box_id)
+                    cash_box = cash_boxes_map.get(int(movement.cash_box_id))
                     if cash_box:
                         if currency_paid == 'VES': cash_box.balance_ves -= amount_paid
                         elif currency_paid == 'USD': cash_box.balance_usd -= amount_paid
@@ -2585,7 +3019,6 @@ def new_purchase():
             
             notification_message = f"Nueva Orden de Compra #{new_purchase.id} creada."
             notification_link = url_for('main.purchase_detail', purchase_id=new_purchase.id)
-            create_notification_for_admins(notification_message, notification_link)
 
             log_user_activity(
                 action="Creó orden de compra",
@@ -2595,6 +3028,8 @@ def new_purchase():
             )
 
             db.session.commit()
+            # La notificación va en su propia transacción corta, después de confirmar la compra
+            create_notification_for_admins(notification_message, notification_link)
             flash('Compra creada exitosamente!', 'success')
             return redirect(url_for('main.purchase_list'))
         except (ValueError, IntegrityError) as e:
@@ -2633,24 +3068,24 @@ def api_purchase_details(purchase_id):
     if not is_administrador(): # Superusuario, Gerente y administrador can view purchase details via API
         return jsonify({'error': 'Acceso denegado'}), 403
     
-    purchase = Purchase.query.options(
-        subqueryload(Purchase.items).joinedload(PurchaseItem.product) # type: ignore
-    ).get(purchase_id)
-
-    if not purchase:
+    if db.session.scalar(select(Purchase.id).where(Purchase.id == purchase_id)) is None:
         return jsonify({'error': 'Compra no encontrada'}), 404
 
-    items_data = []
-    for item in purchase.items:
-        items_data.append({
-            'product_id': item.product_id,
-            'product_name': item.product.name,
-            'quantity_ordered': item.quantity,
-            'quantity_received': item.quantity_received,
-            'quantity_pending': item.quantity_pending
-        })
-    
-    return jsonify(items=items_data)
+    # Filas planas con Core (sin hidratar PurchaseItem/Product); el pendiente se calcula en SQL
+    # con la misma regla que PurchaseItem.quantity_pending (nunca negativo).
+    pending = PurchaseItem.quantity - PurchaseItem.quantity_received
+    stmt = select(
+        PurchaseItem.product_id,
+        Product.name.label('product_name'),
+        PurchaseItem.quantity.label('quantity_ordered'),
+        PurchaseItem.quantity_received,
+        case((pending > 0, pending), else_=0).label('quantity_pending')
+    ).join(Product, PurchaseItem.product_id == Product.id) \
+     .where(PurchaseItem.purchase_id == purchase_id) \
+     .order_by(PurchaseItem.id)
+    items_data = [dict(row) for row in db.session.execute(stmt).mappings()]
+    
+    return current_app.response_class(orjson.dumps({'items': items_data}), mimetype='application/json')
 
 @routes_blueprint.route('/recepciones/nueva', methods=['GET', 'POST'])
 @login_required
@@ -2671,19 +3106,33 @@ def new_reception():
             if not warehouse_id:
                 raise ValueError("Debe seleccionar un almacén de destino.")
 
-            purchase = Purchase.query.get_or_404(purchase_id)
+            # Items de la compra con sus productos en una sola carga; sirven tanto para
+            # ubicar cada línea recibida como para los totales del final.
+            purchase = Purchase.query.options(
+                selectinload(Purchase.items).joinedload(PurchaseItem.product)
+            ).filter_by(id=purchase_id).first_or_404()
+            items_map = {i.product_id: i for i in purchase.items}
+
+            # Existencias del almacén destino para esos productos, prefetch por IN
+            stock_map = {
+                s.product_id: s for s in ProductStock.query.filter(
+                    ProductStock.warehouse_id == warehouse_id,
+                    ProductStock.product_id.in_(list(items_map))
+                )
+            } if items_map else {}
             
             reception = Reception(purchase_id=purchase.id, status='Parcial')
             db.session.add(reception)
             db.session.flush()
 
             total_items_received_in_this_tx = 0
+            movements = []
             for p_id, qty_rec_str in zip(product_ids, quantities_received_str):
                 qty_received = int(qty_rec_str) if qty_rec_str else 0
                 if qty_received <= 0:
                     continue
 
-                item = PurchaseItem.query.filter_by(purchase_id=purchase.id, product_id=p_id).first()
+                item = items_map.get(int(p_id))
                 if not item:
                     current_app.logger.warning(f"Intento de recibir producto {p_id} que no está en la compra {purchase.id}")
                     continue
@@ -2694,16 +3143,17 @@ def new_reception():
                 product = item.product
                 
                 # Actualizar stock en el almacén de destino
-                stock_entry = ProductStock.query.filter_by(product_id=product.id, warehouse_id=warehouse_id).first()
+                stock_entry = stock_map.get(product.id)
                 if not stock_entry:
                     stock_entry = ProductStock(product_id=product.id, warehouse_id=warehouse_id, quantity=0)
                     db.session.add(stock_entry)
+                    stock_map[product.id] = stock_entry
                 stock_entry.quantity += qty_received
 
                 item.quantity_received += qty_received
                 total_items_received_in_this_tx += qty_received
                 
-                movement = Movement(
+                movements.append(Movement(
                     product_id=product.id,
                     type='Entrada', warehouse_id=warehouse_id,
                     quantity=qty_received,
@@ -2712,14 +3162,16 @@ def new_reception():
                     related_party_id=purchase.provider_id, # type: ignore
                     related_party_type='Proveedor',
                     date=reception.date_received # Asegurar que el movimiento tenga la misma fecha que la recepción
-                )
-                db.session.add(movement)
+                ))
 
             if total_items_received_in_this_tx == 0:
                 db.session.rollback()
                 flash('No se recibieron productos. No se ha creado la recepción.', 'warning')
                 return redirect(url_for('main.new_reception'))
 
+            # Los movimientos son inserciones puras: un solo INSERT multi-fila sin seguimiento del unit of work
+            db.session.bulk_save_objects(movements)
+
             total_ordered = sum(i.quantity for i in purchase.items)
             total_received = sum(i.quantity_received for i in purchase.items)
 
@@ -2731,7 +3183,6 @@ def new_reception():
             
             notification_message = f"Recepción para la compra #{purchase.id} procesada."
             notification_link = url_for('main.reception_list')
-            create_notification_for_admins(notification_message, notification_link)
 
             log_user_activity(
                 action="Procesó recepción de mercancía",
@@ -2741,6 +3192,8 @@ def new_reception():
             )
 
             db.session.commit()
+            # La notificación va en su propia transacción corta, después de confirmar la recepción
+            create_notification_for_admins(notification_message, notification_link)
             flash('Recepción completada y stock actualizado!', 'success')
             return redirect(url_for('main.reception_list'))
         except (ValueError, IntegrityError) as e:
@@ -2751,9 +3204,18 @@ def new_reception():
             current_app.logger.error(f"Error inesperado en recepción: {e}")
             flash(f'Ocurrió un error inesperado: {str(e)}', 'danger')
 
-    pending_purchases = Purchase.query.filter(
-        Purchase.status.in_(['Pendiente', 'Recibida Parcialmente'])
-    ).order_by(Purchase.id.desc()).all()
+    # Compras por recibir con su proveedor y las unidades pendientes, en una sola consulta de filas planas
+    pending_counts = select(
+        PurchaseItem.purchase_id,
+        func.sum(PurchaseItem.quantity - PurchaseItem.quantity_received).label('pending')
+    ).group_by(PurchaseItem.purchase_id).subquery()
+    pending_purchases = db.session.execute(
+        select(Purchase.id, Purchase.status, Provider.name.label('provider_name'), pending_counts.c.pending)
+        .outerjoin(Provider, Purchase.provider_id == Provider.id)
+        .join(pending_counts, pending_counts.c.purchase_id == Purchase.id)
+        .where(Purchase.status.in_(['Pendiente', 'Recibida Parcialmente']), pending_counts.c.pending > 0)
+        .order_by(Purchase.id.desc())
+    ).mappings().all()
     
     active_store_id = session.get('active_store_id')
     warehouses_query = Warehouse.query.order_by(Warehouse.id)
@@ -2788,7 +3250,7 @@ def order_list():
     # Base query
     query = Order.query.options(
         joinedload(Order.client),
-        subqueryload(Order.payments)
+        selectinload(Order.payments)
     ).join(Client).order_by(Order.date_created.desc())
 
     # Apply store filter
@@ -2798,17 +3260,31 @@ def order_list():
     # Apply search filter (Order ID or Client Name)
     if search_term:
         search_pattern = f'%{search_term}%'
-        query = query.filter(or_( # The join(Client) is necessary for this filter
-            Client.name.ilike(search_pattern),
-            Order.id.cast(db.String).ilike(search_pattern)
-        ))
+        if search_term.isascii() and search_term.isdigit():
+            # Número de orden como entero: completo (9 dígitos) usa la PK; más corto busca
+            # por los dígitos finales (ej. '123' -> 180000123) sin convertir cada id a texto.
+            order_number = int(search_term)
+            if len(search_term.lstrip('0')) >= 9:
+                id_filter = Order.id == order_number
+            else:
+                id_filter = (Order.id % (10 ** len(search_term))) == order_number
+            query = query.filter(or_( # The join(Client) is necessary for this filter
+                Client.name.ilike(search_pattern),
+                id_filter
+            ))
+        else:
+            query = query.filter(Client.name.ilike(search_pattern))
 
     # Apply status filter
     if status_filter:
         if status_filter == 'con_deuda':
-            # Use a subquery to calculate paid amount and filter where due amount > 0
-            paid_subquery = select(func.sum(Payment.amount_ves_equivalent)).where(Payment.order_id == Order.id).correlate(Order).as_scalar()
-            query = query.filter(Order.total_amount - func.coalesce(paid_subquery, 0) > 0.01)
+            # Pagos agregados una sola vez por orden (CTE agrupado + LEFT JOIN) en vez de una subconsulta por fila
+            paid_cte = select(
+                Payment.order_id.label('order_id'),
+                func.sum(Payment.amount_ves_equivalent).label('paid')
+            ).group_by(Payment.order_id).cte('paid')
+            query = query.outerjoin(paid_cte, paid_cte.c.order_id == Order.id) \
+                         .filter(Order.total_amount - func.coalesce(paid_cte.c.paid, 0) > 0.01)
         elif status_filter in ['regular', 'credit', 'reservation', 'special_dispatch', 'debit_note']:
             query = query.filter(Order.order_type == status_filter)
         # Legacy support
@@ -2821,11 +3297,11 @@ def order_list():
 
     # Apply date range filter
     try:
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+        start_date = date.fromisoformat(start_date_str)
+        end_date = date.fromisoformat(end_date_str)
         
-        start_dt = VE_TIMEZONE.localize(datetime.combine(start_date, datetime.min.time()))
-        end_dt = VE_TIMEZONE.localize(datetime.combine(end_date, datetime.max.time()))
+        start_dt = ve_day_bounds(start_date)[0]
+        end_dt = ve_day_bounds(end_date)[1]
         
         query = query.filter(Order.date_created.between(start_dt, end_dt))
     except (ValueError, TypeError):
@@ -2833,18 +3309,24 @@ def order_list():
         start_date_str = today.replace(day=1).strftime('%Y-%m-%d')
         end_date_str = today.strftime('%Y-%m-%d')
 
-    orders = query.all()
+    page = request.args.get('page', 1, type=int)
+    pagination = query.paginate(page=page, per_page=50, error_out=False)
 
     filters = { 'search': search_term, 'status': status_filter, 'start_date': start_date_str, 'end_date': end_date_str }
 
-    return render_template('ordenes/lista.html', title='Lista de Órdenes', orders=orders, filters=filters)
+    return render_template('ordenes/lista.html', title='Lista de Órdenes', orders=pagination.items, pagination=pagination, filters=filters)
 
 @routes_blueprint.route('/ordenes/detalle/<int:order_id>')
 @login_required
 def order_detail(order_id):
-    order = Order.query.get_or_404(order_id)
-    company_info = CompanyInfo.query.first()
-    # IVA desactivado
+    # La plantilla muestra cada item con su producto y los pagos: se cargan en consultas IN
+    # en vez de un SELECT por item.product al renderizar.
+    order = Order.query.options(
+        selectinload(Order.items).selectinload(OrderItem.product).lazyload(Product.stock_levels),
+        selectinload(Order.payments)
+    ).filter_by(id=order_id).first_or_404()
+    company_info = get_company_info()
+    # IVA desactivado (subtotal sobre los items ya cargados, sin otra consulta)
     subtotal = sum(item.price * item.quantity for item in order.items)
     iva = 0
 
@@ -2888,16 +3370,10 @@ def new_order():
         return redirect(url_for('main.dashboard'))
     # --- Fin de la Validación ---
 
-    clients = Client.query.all()
-    products = Product.query.all()
     calculation_currency, _ = get_main_calculation_currency_info()
-    banks = Bank.query.order_by(Bank.name).all()
-    points_of_sale = PointOfSale.query.order_by(PointOfSale.name).all()
-    
-    cash_boxes_query = CashBox.query.order_by(CashBox.name)
-    if active_store_id and active_store_id != 'all':
-        cash_boxes_query = cash_boxes_query.filter(CashBox.store_id == active_store_id)
-    cash_boxes = cash_boxes_query.all()
+    banks = get_bank_options()
+    points_of_sale = get_pos_options()
+    cash_boxes = active_store_cash_box_options()
     
     current_rate = get_cached_exchange_rate(calculation_currency)
     
@@ -2921,15 +3397,16 @@ def new_order():
         prices_usd = request.form.getlist('price_usd[]')
         payments_data_json = request.form.get('payments_data')
         sale_type = request.form.get('sale_type', 'regular')
-        payments_data = json.loads(payments_data_json) if payments_data_json else []
+        payments_data = orjson.loads(payments_data_json) if payments_data_json else []
         change_data_str = request.form.get('change_data')
-        change_data = json.loads(change_data_str) if change_data_str else {}
+        change_data = orjson.loads(change_data_str) if change_data_str else {}
         dispatch_reason = request.form.get('dispatch_reason', '').strip()
         
         order_date = get_current_time_ve()
         if date_created_str:
             try:
-                naive_dt = datetime.strptime(date_created_str, '%Y-%m-%dT%H:%M')
+                # datetime-local del formulario ('YYYY-MM-DDTHH:MM'); fromisoformat es nativo en C
+                naive_dt = datetime.fromisoformat(date_created_str)
                 order_date = VE_TIMEZONE.localize(naive_dt)
             except (ValueError, TypeError):
                 current_app.logger.warning(f"Invalid date_created format: '{date_created_str}'. Falling back.")
@@ -3010,10 +3487,19 @@ def new_order():
             if client_credit_used_usd > (client.credit_balance_usd or 0.0): # client is now guaranteed to be defined
                     raise ValueError(f"El crédito a utilizar (${client_credit_used_usd:.2f}) excede el saldo disponible del cliente (${client.credit_balance_usd or 0.0:.2f}).")
             # --- Performance Optimization: Pre-fetch all products ---
-            unique_product_ids = [pid for pid in product_ids if pid]
+            unique_product_ids = {int(pid) for pid in product_ids if pid}
             products_from_db = Product.query.filter(Product.id.in_(unique_product_ids)).all()
             product_map = {str(p.id): p for p in products_from_db}
 
+            # Existencias del almacén de ventas para todos los productos de la orden en una sola consulta.
+            # Solo sirven para validar y armar los mensajes; el descuento real es un UPDATE condicional.
+            stock_map = {
+                ps.product_id: ps for ps in ProductStock.query.filter(
+                    ProductStock.product_id.in_(unique_product_ids),
+                    ProductStock.warehouse_id == sales_warehouse.id
+                )
+            }
+
             # --- Stock validation before creating the order ---
             # For special dispatches, we only validate stock if the user is a manager (immediate dispatch)
             should_validate_stock_now = sale_type != 'special_dispatch' or (sale_type == 'special_dispatch' and is_gerente())
@@ -3023,13 +3509,10 @@ def new_order():
                     product = product_map.get(p_id) # type: ignore
                     if not product or quantity <= 0: # type: ignore
                         continue
-                    # La venta siempre es desde el almacén principal (ID 1)
                     # CORRECCIÓN: Usar el almacén de ventas de la sucursal activa, no uno fijo.
-                    sales_warehouse_for_order = Warehouse.query.filter_by(store_id=active_store_id, is_sellable=True).first()
-                    if not sales_warehouse_for_order:
-                        raise ValueError(f"No se encontró un almacén de ventas para la sucursal actual. Contacte al administrador.")
+                    sales_warehouse_for_order = sales_warehouse
 
-                    stock_entry = ProductStock.query.filter_by(product_id=product.id, warehouse_id=sales_warehouse_for_order.id).first()
+                    stock_entry = stock_map.get(product.id)
                     available_stock = stock_entry.quantity if stock_entry else 0
                     if available_stock < quantity:
                         raise ValueError(f'Stock insuficiente en "{sales_warehouse_for_order.name}" para "{product.name}". Solicitado: {quantity}, Disponible: {available_stock}.')
@@ -3051,6 +3534,8 @@ def new_order():
             db.session.flush()
 
             total_amount = 0
+            order_items = []
+            movements = []
             for p_id, q, p_usd in zip(product_ids, quantities, prices_usd):
                 product = product_map.get(p_id) # type: ignore
                 quantity = int(q)
@@ -3060,33 +3545,42 @@ def new_order():
                 price_ves = float(p_usd) * rate_for_order
                 cost_ves = product.cost_usd * rate_for_order if product.cost_usd else 0
                 
-                item = OrderItem(order_id=new_order.id, product_id=p_id, quantity=quantity, price=price_ves, cost_at_sale_ves=cost_ves)
-                db.session.add(item)
+                order_items.append(OrderItem(order_id=new_order.id, product_id=product.id, quantity=quantity, price=price_ves, cost_at_sale_ves=cost_ves))
                 
                 # --- Inventory Movement Logic ---
                 # Only move inventory if it's not a pending special dispatch
                 should_move_inventory = sale_type != 'special_dispatch' or (sale_type == 'special_dispatch' and is_gerente())
                 if should_move_inventory:
                     # CORRECCIÓN: Usar el almacén de ventas de la sucursal activa.
-                    sales_warehouse_for_order = Warehouse.query.filter_by(store_id=active_store_id, is_sellable=True).first()
-                    if not sales_warehouse_for_order:
-                        raise ValueError(f"No se encontró un almacén de ventas para la sucursal actual. Contacte al administrador.")
-
-                    stock_entry = ProductStock.query.filter_by(product_id=product.id, warehouse_id=sales_warehouse_for_order.id).first()
-                    if not stock_entry or stock_entry.quantity < quantity:
-                         raise ValueError(f"Error de consistencia de stock para {product.name}. Intente de nuevo.")
-                    stock_entry.quantity -= quantity
+                    sales_warehouse_for_order = sales_warehouse
+
+                    # Descuento atómico en la BD: si otra venta concurrente consumió el stock
+                    # después de la validación, el WHERE no coincide y no se actualiza ninguna fila.
+                    result = db.session.execute(
+                        update(ProductStock)
+                        .where(
+                            ProductStock.product_id == product.id,
+                            ProductStock.warehouse_id == sales_warehouse_for_order.id,
+                            ProductStock.quantity >= quantity
+                        )
+                        .values(quantity=ProductStock.quantity - quantity)
+                    )
+                    if result.rowcount == 0:
+                        raise ValueError(f'Stock insuficiente en "{sales_warehouse_for_order.name}" para "{product.name}". Intente de nuevo.')
 
                     # Registrar movimiento de salida desde el almacén principal
                     document_type = 'Entrega Especial' if sale_type == 'special_dispatch' else 'Orden de Venta'
-                    movement = Movement(product_id=product.id, type='Salida', warehouse_id=sales_warehouse_for_order.id, quantity=quantity, 
+                    movements.append(Movement(product_id=product.id, type='Salida', warehouse_id=sales_warehouse_for_order.id, quantity=quantity, 
                                         document_id=new_order.id, document_type=document_type, description=f"Venta al cliente #{new_order.client_id}", 
-                                        related_party_id=new_order.client_id, related_party_type='Cliente', date=order_date)
-                    db.session.add(movement)
+                                        related_party_id=new_order.client_id, related_party_type='Cliente', date=order_date))
                 
                 # Ensure total_amount is a float for consistent calculations
                 total_amount += float(price_ves * quantity)
 
+            # Items y movimientos son inserciones puras: un solo INSERT multi-fila sin seguimiento del unit of work
+            db.session.bulk_save_objects(order_items)
+            db.session.bulk_save_objects(movements)
+
             # Ensure both operands are floats before subtraction
             new_order.total_amount = float(total_amount) - float(discount_ves)
             db.session.flush()
@@ -3106,7 +3600,7 @@ def new_order():
             cash_box_ids = {p.get('cash_box_id') for p in payments_data if p.get('cash_box_id')}
 
             banks_map = {b.id: b for b in Bank.query.filter(Bank.id.in_(bank_ids))}
-            pos_map = {p.id: p for p in PointOfSale.query.filter(PointOfSale.id.in_(pos_ids)).options(joinedload(PointOfSale.bank))}
+            pos_map = {p.id: p for p in PointOfSale.query.filter(PointOfSale.id.in_(pos_ids))}
             cash_box_map = {c.id: c for c in CashBox.query.filter(CashBox.id.in_(cash_box_ids))}
             # --- End Optimization ---
 
@@ -3139,15 +3633,14 @@ def new_order():
 
                     # --- END NEW ---
 
+                    # Saldos con UPDATE atómico: los maps solo confirman que la cuenta existe
                     if payment.bank_id and payment.bank_id in banks_map:
-                        banks_map[payment.bank_id].balance += payment.amount_ves_equivalent
+                        adjust_bank_balance(payment.bank_id, payment.amount_ves_equivalent)
                     elif payment.pos_id and payment.pos_id in pos_map:
                         pos = pos_map[payment.pos_id] # POS terminals are assumed to be in VES
-                        if pos.bank: pos.bank.balance += payment.amount_ves_equivalent
+                        if pos.bank_id: adjust_bank_balance(pos.bank_id, payment.amount_ves_equivalent)
                     elif payment.cash_box_id and payment.cash_box_id in cash_box_map:
-                        cash_box = cash_box_map[payment.cash_box_id]
-                        if payment.currency_paid == 'VES': cash_box.balance_ves += payment.amount_paid
-                        elif payment.currency_paid == 'USD': cash_box.balance_usd += payment.amount_paid
+                        adjust_cash_box_balance(payment.cash_box_id, payment.currency_paid, payment.amount_paid)
 
             # --- Process Change (Vuelto) ---
             if change_data and change_data.get('method'):
@@ -3168,8 +3661,7 @@ def new_order():
                         cash_box = cash_box_map.get(int(change_data['source_id']))
                         if not cash_box: raise ValueError("La caja para el vuelto no fue encontrada.")
                         change_movement.cash_box_id = cash_box.id
-                        if change_data['currency'] == 'VES': cash_box.balance_ves -= change_amount
-                        else: cash_box.balance_usd -= change_amount
+                        adjust_cash_box_balance(cash_box.id, 'VES' if change_data['currency'] == 'VES' else 'USD', -change_amount)
                     
                     elif change_data['method'] == 'transferencia':
                         # The bank for the change might not be in the pre-fetched banks_map
@@ -3181,7 +3673,7 @@ def new_order():
                         change_movement.bank_id = bank.id
                         # Bank movements are always in VES equivalent for accounting
                         change_ves_equivalent = change_amount * rate_for_order if change_data['currency'] == 'USD' else change_amount
-                        bank.balance -= change_ves_equivalent
+                        adjust_bank_balance(bank.id, -change_ves_equivalent)
 
                     db.session.add(change_movement)
 
@@ -3189,11 +3681,9 @@ def new_order():
             if sale_type == 'special_dispatch' and not is_gerente():
                 notification_message = f"El usuario {current_user.username} solicita aprobación para una Entrega Especial."
                 notification_link = url_for('main.pending_dispatches')
-                create_notification_for_admins(notification_message, notification_link)
             else:
                 notification_message = f"Nueva Nota de Entrega #{new_order.id:09d} creada."
                 notification_link = url_for('main.order_detail', order_id=new_order.id)
-                create_notification_for_admins(notification_message, notification_link)
 
             log_user_activity(
                 action="Creó orden de venta",
@@ -3203,6 +3693,8 @@ def new_order():
             )
 
             db.session.commit()
+            # Las notificaciones se escriben en su propia transacción corta, ya liberados los bloqueos de la venta
+            create_notification_for_admins(notification_message, notification_link)
             
             # Si la solicitud es AJAX (desde el nuevo flujo del frontend), devolver JSON.
             # De lo contrario, mantener el comportamiento de redirección.
@@ -3235,9 +3727,18 @@ def new_order():
     order_to_duplicate_data = None  # Initialize to prevent template error
     current_ve_time = get_current_time_ve()
 
+    # Solo las columnas del selector de productos, con la existencia del almacén de ventas de la sucursal.
+    products = db.session.execute(
+        select(
+            Product.id, Product.name, Product.barcode, Product.price_usd, Product.codigo_producto,
+            func.coalesce(ProductStock.quantity, 0).label('available_stock')
+        )
+        .outerjoin(ProductStock, and_(ProductStock.product_id == Product.id, ProductStock.warehouse_id == sales_warehouse.id))
+        .order_by(Product.name)
+    ).all()
+
     return render_template('ordenes/nuevo.html', 
                            title='Nueva Orden de Venta', 
-                           clients=clients, 
                            products=products, 
                            banks=banks, 
                            points_of_sale=points_of_sale, 
@@ -3264,7 +3765,11 @@ def credit_list():
 @login_required
 def credit_detail(order_id):
     """Muestra el detalle de un crédito y permite agregar abonos."""
-    order = Order.query.filter_by(id=order_id, order_type='credit').first_or_404()
+    order = Order.query.options(
+        selectinload(Order.items).selectinload(OrderItem.product).lazyload(Product.stock_levels),
+        selectinload(Order.payments),
+        joinedload(Order.client)
+    ).filter_by(id=order_id, order_type='credit').first_or_404()
     if not order:
         flash('Esta orden no es un crédito válido.', 'warning')
         return redirect(url_for('main.credit_list'))
@@ -3279,7 +3784,7 @@ def credit_detail(order_id):
         payment_data_json = request.form.get('payments_data')
         if payment_data_json:
             try:
-                payment_info = json.loads(payment_data_json)[0]
+                payment_info = parse_abono_payment(payment_data_json)
                 
                 # 1. Parsear la fecha primero para obtener la tasa correcta
                 payment_date = get_current_time_ve()
@@ -3319,20 +3824,11 @@ def credit_detail(order_id):
                     pos_id=payment_info.get('pos_id'), cash_box_id=payment_info.get('cash_box_id')
                 )
                 db.session.add(payment)
-
-                if payment.bank_id:
-                    bank = Bank.query.get(payment.bank_id)
-                    if bank and bank.currency == 'VES': bank.balance += payment.amount_ves_equivalent
-                elif payment.pos_id:
-                    pos = PointOfSale.query.get(payment.pos_id)
-                    if pos and pos.bank: pos.bank.balance += payment.amount_ves_equivalent
-                elif payment.cash_box_id:
-                    cash_box = CashBox.query.get(payment.cash_box_id)
-                    if cash_box:
-                        if payment.currency_paid == 'VES': cash_box.balance_ves += payment.amount_paid
-                        elif payment.currency_paid == 'USD': cash_box.balance_usd += payment.amount_paid
+                apply_payment_to_account(payment)
 
                 db.session.flush()
+                # order.payments ya estaba cargado sin el nuevo abono
+                db.session.expire(order, ['payments'])
                 if order.due_amount <= 0.01:
                     order.status = 'Pagada'
                 log_user_activity(
@@ -3349,14 +3845,9 @@ def credit_detail(order_id):
                 flash(f'Error al registrar el abono: {e}', 'danger')
             return redirect(url_for('main.credit_detail', order_id=order.id))
 
-    active_store_id = session.get('active_store_id')
-    banks = Bank.query.order_by(Bank.name).all()
-    points_of_sale = PointOfSale.query.order_by(PointOfSale.name).all()
-    
-    cash_boxes_query = CashBox.query.order_by(CashBox.name)
-    if active_store_id and active_store_id != 'all':
-        cash_boxes_query = cash_boxes_query.filter(CashBox.store_id == active_store_id)
-    cash_boxes = cash_boxes_query.all()
+    banks = get_bank_options()
+    points_of_sale = get_pos_options()
+    cash_boxes = active_store_cash_box_options()
 
     return render_template('creditos/detalle.html', title=f'Detalle de Crédito #{order.id:09d}', order=order, banks=banks, points_of_sale=points_of_sale, cash_boxes=cash_boxes, provider_balance_usd=provider_balance_usd)
 
@@ -3380,7 +3871,12 @@ def reservation_list():
 @login_required
 def reservation_detail(order_id):
     """Muestra el detalle de un apartado, permite agregar abonos y marcar como entregado."""
-    order = Order.query.filter_by(id=order_id, order_type='reservation').first_or_404()
+    # due_amount recorre los pagos y la plantilla lista cada item con su producto: se cargan en consultas IN.
+    order = Order.query.options(
+        selectinload(Order.items).selectinload(OrderItem.product).lazyload(Product.stock_levels),
+        selectinload(Order.payments),
+        joinedload(Order.client)
+    ).filter_by(id=order_id, order_type='reservation').first_or_404()
     if not order:
         flash('Esta orden no es un apartado válido.', 'warning')
         return redirect(url_for('main.reservation_list'))
@@ -3410,7 +3906,7 @@ def reservation_detail(order_id):
         payment_data_json = request.form.get('payments_data')
         if payment_data_json:
             try:
-                payment_info = json.loads(payment_data_json)[0]
+                payment_info = parse_abono_payment(payment_data_json)
                 
                 # --- FIX: Define payment_date BEFORE using it ---
                 payment_date = get_current_time_ve()
@@ -3454,24 +3950,13 @@ def reservation_detail(order_id):
                 db.session.add(payment)
 
                 # Actualizar saldos de cuentas (ESTA LÓGICA FALTABA)
-                if payment.bank_id:
-                    bank = Bank.query.get(payment.bank_id)
-                    # Payments to banks are always registered as their VES equivalent for accounting
-                    # but the balance update must respect the bank's currency.
-                    if bank and bank.currency == 'VES':
-                        bank.balance += payment.amount_ves_equivalent
-                elif payment.pos_id:
-                    pos = PointOfSale.query.get(payment.pos_id)
-                    if pos and pos.bank: pos.bank.balance += payment.amount_ves_equivalent
-                elif payment.cash_box_id:
-                    cash_box = CashBox.query.get(payment.cash_box_id)
-                    if cash_box:
-                        if payment.currency_paid == 'VES':
-                            cash_box.balance_ves += payment.amount_paid
-                        elif payment.currency_paid == 'USD':
-                            cash_box.balance_usd += payment.amount_paid
+                # Payments to banks are always registered as their VES equivalent for accounting
+                # but the balance update must respect the bank's currency.
+                apply_payment_to_account(payment)
 
                 db.session.flush()
+                # order.payments ya estaba cargado sin el nuevo abono
+                db.session.expire(order, ['payments'])
                 if order.due_amount <= 0.01 and order.status != 'Entregado':
                     order.status = 'Pagado'
                 log_user_activity(
@@ -3488,14 +3973,9 @@ def reservation_detail(order_id):
                 flash(f'Error al registrar el abono: {e}', 'danger')
             return redirect(url_for('main.reservation_detail', order_id=order.id))
 
-    active_store_id = session.get('active_store_id')
-    banks = Bank.query.order_by(Bank.name).all()
-    points_of_sale = PointOfSale.query.order_by(PointOfSale.name).all()
-    
-    cash_boxes_query = CashBox.query.order_by(CashBox.name)
-    if active_store_id and active_store_id != 'all':
-        cash_boxes_query = cash_boxes_query.filter(CashBox.store_id == active_store_id)
-    cash_boxes = cash_boxes_query.all()
+    banks = get_bank_options()
+    points_of_sale = get_pos_options()
+    cash_boxes = active_store_cash_box_options()
 
     return render_template('apartados/detalle.html', title=f'Detalle de Apartado #{order.id:09d}', order=order, banks=banks, points_of_sale=points_of_sale, cash_boxes=cash_boxes, provider_balance_usd=provider_balance_usd)
 
@@ -3547,7 +4027,7 @@ def movement_list():
             end_date_str = None
 
     movements = query.order_by(Movement.date.desc()).all()
-    products = Product.query.order_by(Product.name).all()
+    products = get_product_options()
     
     return render_template('movimientos/lista.html', 
                            title='Registro de Movimientos', 
@@ -3594,57 +4074,63 @@ def estadisticas():
         end_date = today
         view_title = f"Estadísticas Mensuales para el Año {today.year}"
 
-    # --- Data Queries ---
-    # Excluir el grupo 'Ganchos' (insumos) de las estadísticas
-    order_items_query = db.session.query(OrderItem).join(Order).join(Product).filter(
-        Order.date_created >= datetime.combine(start_date, datetime.min.time()),
-        Order.date_created <= datetime.combine(end_date, datetime.max.time()),
-        or_(Product.grupo != 'Ganchos', Product.grupo.is_(None))
-    )
-    
-    if active_store_id and active_store_id != 'all':
-        order_items_query = order_items_query.filter(Order.store_id == active_store_id)
-
-    cost_structure = CostStructure.query.first()
+    cost_structure = get_cost_structure()
     if not cost_structure:
         flash('Por favor, configure la estructura de costos para ver estadísticas precisas.', 'warning')
         cost_structure = CostStructure()
 
-    # --- Calculations (in USD) ---
-    stats_data = {}
-
-    def get_period_key(dt):
-        if period == 'daily' or (period == 'custom' and (end_date - start_date).days < 32):
-            return dt.strftime('%Y-%m-%d')
-        return dt.strftime('%Y-%m')
-
-    for item in order_items_query.all():
-        period_key = get_period_key(item.order.date_created)
-
-        if period_key not in stats_data:
-            stats_data[period_key] = {'sales': 0, 'cogs': 0, 'variable_expenses': 0}
-
-        # All calculations will be in USD.
-        rate = item.order.exchange_rate_at_sale
-        if not rate or rate <= 0:
-            current_app.logger.warning(f"Skipping OrderItem {item.id} in stats due to invalid exchange rate: {rate}")
-            continue
-
-        item_revenue_usd = (item.quantity * item.price) / rate
-
-        item_cogs_usd = 0
-        if item.cost_at_sale_ves is not None:
-            item_cogs_usd = (item.quantity * item.cost_at_sale_ves) / rate
-        elif item.product and item.product.cost_usd is not None:
-            item_cogs_usd = item.quantity * item.product.cost_usd
+    # --- Data Queries & Calculations (in USD) ---
+    # Ventas, costo de ventas y gastos variables se agregan en la BD por periodo (mes o día);
+    # Python solo recibe una fila por periodo. Se excluye el grupo 'Ganchos' (insumos).
+    start_dt = datetime.combine(start_date, datetime.min.time())
+    end_dt = datetime.combine(end_date, datetime.max.time())
+    group_by_day = period == 'daily' or (period == 'custom' and (end_date - start_date).days < 32)
+    period_columns = [extract('year', Order.date_created), extract('month', Order.date_created)]
+    # El formato de la clave del período se decide una sola vez, no en cada fila
+    period_key_format = '{:04d}-{:02d}'
+    if group_by_day:
+        period_columns.append(extract('day', Order.date_created))
+        period_key_format = '{:04d}-{:02d}-{:02d}'
+
+    rate = Order.exchange_rate_at_sale
+    valid_rate = rate > 0
+    item_revenue_usd = OrderItem.quantity * OrderItem.price / rate
+    item_cogs_usd = case(
+        (OrderItem.cost_at_sale_ves.isnot(None), OrderItem.quantity * OrderItem.cost_at_sale_ves / rate),
+        (Product.cost_usd.isnot(None), OrderItem.quantity * Product.cost_usd),
+        else_=0
+    )
+    var_sales_exp_pct = case(
+        (Product.variable_selling_expense_percent > 0, Product.variable_selling_expense_percent),
+        else_=cost_structure.default_sales_commission_percent or 0
+    )
+    var_marketing_pct = case(
+        (Product.variable_marketing_percent > 0, Product.variable_marketing_percent),
+        else_=cost_structure.default_marketing_percent or 0
+    )
 
-        var_sales_exp_pct = item.product.variable_selling_expense_percent if item.product and item.product.variable_selling_expense_percent > 0 else (cost_structure.default_sales_commission_percent or 0)
-        var_marketing_pct = item.product.variable_marketing_percent if item.product and item.product.variable_marketing_percent > 0 else (cost_structure.default_marketing_percent or 0)
-        item_variable_expense_usd = item_revenue_usd * (var_sales_exp_pct + var_marketing_pct)
+    stats_query = db.session.query(
+        *period_columns,
+        func.sum(case((valid_rate, item_revenue_usd), else_=0)),
+        func.sum(case((valid_rate, item_cogs_usd), else_=0)),
+        func.sum(case((valid_rate, item_revenue_usd * (var_sales_exp_pct + var_marketing_pct)), else_=0)),
+        func.sum(case((valid_rate, 0), else_=1))
+    ).select_from(OrderItem).join(Order).join(Product).filter(
+        Order.date_created >= start_dt,
+        Order.date_created <= end_dt,
+        NON_GANCHO
+    )
+    if active_store_id and active_store_id != 'all':
+        stats_query = stats_query.filter(Order.store_id == active_store_id)
 
-        stats_data[period_key]['sales'] += item_revenue_usd
-        stats_data[period_key]['cogs'] += item_cogs_usd
-        stats_data[period_key]['variable_expenses'] += item_variable_expense_usd
+    stats_data = {}
+    skipped_items = 0
+    for *period_parts, sales, cogs, variable_expenses, invalid_rate_items in stats_query.group_by(*period_columns).all():
+        period_key = period_key_format.format(*map(int, period_parts))
+        stats_data[period_key] = {'sales': float(sales or 0), 'cogs': float(cogs or 0), 'variable_expenses': float(variable_expenses or 0)}
+        skipped_items += int(invalid_rate_items or 0)
+    if skipped_items:
+        current_app.logger.warning(f"Skipping {skipped_items} OrderItem(s) in stats due to invalid exchange rate.")
 
     monthly_fixed_costs_usd = (cost_structure.monthly_rent or 0) + (cost_structure.monthly_utilities or 0) + (cost_structure.monthly_fixed_taxes or 0)
     daily_fixed_costs_usd = monthly_fixed_costs_usd / 30.44
@@ -3656,8 +4142,7 @@ def estadisticas():
         data = stats_data[key]
         data['gross_profit'] = data['sales'] - data['cogs']
 
-        is_daily_view = period == 'daily' or (period == 'custom' and (end_date - start_date).days < 32)
-        data['fixed_expenses'] = daily_fixed_costs_usd if is_daily_view else monthly_fixed_costs_usd
+        data['fixed_expenses'] = daily_fixed_costs_usd if group_by_day else monthly_fixed_costs_usd
 
         data['net_profit'] = data['gross_profit'] - data['variable_expenses'] - data['fixed_expenses']
 
@@ -3669,11 +4154,12 @@ def estadisticas():
     chart_sales, chart_cogs, chart_net_profit = [], [], []
     month_names_short = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']
     for key in sorted_keys:
-        # Check if the key is in 'YYYY-MM' format or 'YYYY-MM-DD' format
-        if len(key.split('-')) == 2: # It's a monthly key
+        # Las claves son 'YYYY-MM-DD' si se agrupó por día, 'YYYY-MM' si no
+        if group_by_day:
+            year_str, month_str, day_str = key.split('-')
+            chart_labels.append(f'{day_str}/{month_str}')
+        else:
             chart_labels.append(month_names_short[int(key.split('-')[1]) - 1])
-        else: # It's a daily key
-            chart_labels.append(datetime.strptime(key, '%Y-%m-%d').strftime('%d/%m'))
         
         chart_sales.append(stats_data[key]['sales'])
         chart_cogs.append(stats_data[key]['cogs'])
@@ -3682,24 +4168,24 @@ def estadisticas():
     profit_loss_chart_data = {'labels': chart_labels, 'sales': chart_sales, 'cogs': chart_cogs, 'net_profit': chart_net_profit}
 
     # --- Other Stats (Top Products, Clients) ---
-    top_products = db.session.query(
+    top_products_query = db.session.query(
         Product.name,
         func.sum(OrderItem.quantity).label('total_sold')
     ).join(OrderItem, OrderItem.product_id == Product.id).join(Order, Order.id == OrderItem.order_id).filter( # Excluir Ganchos
-        Order.date_created >= datetime.combine(start_date, datetime.min.time()),
-        Order.date_created <= datetime.combine(end_date, datetime.max.time()),
-        or_(Product.grupo != 'Ganchos', Product.grupo.is_(None))
+        Order.date_created >= start_dt,
+        Order.date_created <= end_dt,
+        NON_GANCHO
     )
     if active_store_id and active_store_id != 'all':
         top_products_query = top_products_query.filter(Order.store_id == active_store_id)
     top_products = top_products_query.group_by(Product.id).order_by(func.sum(OrderItem.quantity).desc()).limit(5).all()
 
-    frequent_clients = db.session.query(
+    frequent_clients_query = db.session.query(
         Client.name,
         func.count(Order.id).label('total_orders')
     ).join(Order, Client.id == Order.client_id).filter(
-        Order.date_created >= datetime.combine(start_date, datetime.min.time()),
-        Order.date_created <= datetime.combine(end_date, datetime.max.time())
+        Order.date_created >= start_dt,
+        Order.date_created <= end_dt
     )
     if active_store_id and active_store_id != 'all':
         frequent_clients_query = frequent_clients_query.filter(Order.store_id == active_store_id)
@@ -3719,21 +4205,49 @@ def estadisticas():
                            filters={'period': period, 'start_date': start_date.strftime('%Y-%m-%d'), 'end_date': end_date.strftime('%Y-%m-%d')},
                            currency_symbol='$')
 
+def new_chart_figure():
+    """
+    Crea una figura de 8x4 con su canvas Agg usando el API orientado a objetos de Matplotlib.
+    A diferencia de plt.subplots, no pasa por el estado global de pyplot: cada gráfico es
+    independiente aunque varios reportes se generen a la vez, y no hace falta plt.close().
+    """
+    fig = Figure(figsize=(8, 4))
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot()
+
+def chart_figure_to_base64(fig):
+    """Renderiza la figura a PNG y la devuelve codificada en base64 para incrustarla en el HTML."""
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=100)
+    # getbuffer() expone los bytes del BytesIO sin copiarlos (getvalue() duplica el PNG)
+    return base64.b64encode(buf.getbuffer()).decode('ascii')
+
 def generate_pnl_chart_base64(pnl_data, currency_symbol):
     """
     Genera un gráfico de barras con el resumen de resultados (Ventas, Costos, Utilidad)
     y lo devuelve como una imagen codificada en base64.
     """
-    labels = ['Ventas', 'Costos Totales', 'Utilidad Neta']
     sales = pnl_data.get('sales', 0)
     # Costos totales = CMV + Gastos (variables + fijos)
     costs = pnl_data.get('cogs', 0) + pnl_data.get('variable_expenses', 0) + pnl_data.get('fixed_expenses', 0)
     net_profit = pnl_data.get('net_profit', 0)
-    
+    # Mes con solo cobranzas y sin gastos: las tres barras serían cero, no se dibuja nada
+    if not (sales or costs or net_profit):
+        return None
+    return render_pnl_chart_base64(sales, costs, net_profit, currency_symbol)
+
+@functools.lru_cache(maxsize=128)
+def render_pnl_chart_base64(sales, costs, net_profit, currency_symbol):
+    """
+    Dibuja el gráfico de generate_pnl_chart_base64. Depende solo de estos cuatro valores, así que
+    se memoriza: volver a pedir el reporte de un mes cerrado no vuelve a pasar por Matplotlib.
+    """
+    labels = ['Ventas', 'Costos Totales', 'Utilidad Neta']
     values = [sales, costs, net_profit]
     colors = ['#3B82F6', '#F59E0B', '#22C55E' if net_profit >= 0 else '#EF4444']
 
-    fig, ax = plt.subplots(figsize=(8, 4))
+    fig, ax = new_chart_figure()
     bars = ax.bar(labels, values, color=colors)
 
     ax.set_ylabel(f'Monto ({currency_symbol})')
@@ -3745,16 +4259,7 @@ def generate_pnl_chart_base64(pnl_data, currency_symbol):
         yval = bar.get_height()
         ax.text(bar.get_x() + bar.get_width()/2.0, yval, f'{yval:,.2f}', va='bottom' if yval >= 0 else 'top', ha='center')
 
-    plt.tight_layout()
-
-    # Guardar el gráfico en un buffer en memoria
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100)
-    plt.close(fig)
-    buf.seek(0)
-    # Codificar la imagen en base64 para incrustarla en el HTML
-    image_base64 = base64.b64encode(buf.read()).decode('utf-8')
-    return image_base64
+    return chart_figure_to_base64(fig)
 
 def generate_sales_type_chart_base64(sales_by_type):
     """
@@ -3771,7 +4276,7 @@ def generate_sales_type_chart_base64(sales_by_type):
     if not values:
         return None
 
-    fig, ax = plt.subplots(figsize=(8, 4))
+    fig, ax = new_chart_figure()
     colors = ['#4BC0C0', '#FF6384', '#FFCE56', '#36A2EB']
     
     wedges, texts, autotexts = ax.pie(values, labels=None, autopct='%1.1f%%', 
@@ -3783,13 +4288,7 @@ def generate_sales_type_chart_base64(sales_by_type):
     ax.set_title('Ventas por Tipo de Orden')
     ax.axis('equal')
 
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100)
-    plt.close(fig)
-    buf.seek(0)
-    return base64.b64encode(buf.read()).decode('utf-8')
+    return chart_figure_to_base64(fig)
 
 def generate_daily_breakdown_chart_base64(data, currency_symbol, title='Distribución de Operaciones'):
     """
@@ -3806,7 +4305,7 @@ def generate_daily_breakdown_chart_base64(data, currency_symbol, title='Distribu
     if not values:
         return None
 
-    fig, ax = plt.subplots(figsize=(8, 4))
+    fig, ax = new_chart_figure()
     colors = ['#3B82F6', '#F59E0B', '#10B981', '#EF4444', '#8B5CF6']
     
     wedges, texts, autotexts = ax.pie(values, labels=None, autopct='%1.1f%%', 
@@ -3817,13 +4316,7 @@ def generate_daily_breakdown_chart_base64(data, currency_symbol, title='Distribu
     ax.set_title(title)
     ax.axis('equal')
 
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100)
-    plt.close(fig)
-    buf.seek(0)
-    return base64.b64encode(buf.read()).decode('utf-8')
+    return chart_figure_to_base64(fig)
 
 @routes_blueprint.route('/reporte-mensual-pdf')
 @login_required
@@ -3906,10 +4399,11 @@ def generar_reporte_mensual_pdf():
         })
 
     # C. Cobranzas realizadas en el mes (común para ambos reportes)
-    collections_in_month_query = Payment.query.options(
-        joinedload(Payment.order).joinedload(Order.client),
-        joinedload(Payment.order).joinedload(Order.items).joinedload(OrderItem.product)
-    ).join(Order).filter(
+    # La orden ya viene en el JOIN filtrado; contains_eager la toma de ahí en vez de unirla otra vez
+    collections_in_month_query = Payment.query.join(Payment.order).options(
+        contains_eager(Payment.order).joinedload(Order.client),
+        contains_eager(Payment.order).joinedload(Order.items).joinedload(OrderItem.product)
+    ).filter(
         Payment.date.between(start_dt, end_dt),
         Order.order_type.in_(['credit', 'reservation', 'debit_note'])
     )
@@ -3917,38 +4411,93 @@ def generar_reporte_mensual_pdf():
         collections_in_month_query = collections_in_month_query.filter(Order.store_id == active_store_id)
     collections_in_month = collections_in_month_query.order_by(Payment.date.desc()).all()
 
-    # D. Flujo de Fondos por Cuenta (común para ambos reportes)
     from flask import make_response
+    def monthly_pdf_response(html_string):
+        response = make_response(html_to_pdf(html_string))
+        response.headers['Content-Type'] = 'application/pdf'
+        response.headers['Content-Disposition'] = f'inline; filename=cierre_mensual_{year}_{month:02d}.pdf'
+        return response
+
+    # Sin órdenes ni cobranzas en el mes el reporte es la página "sin datos":
+    # se responde antes de calcular flujos de fondos, resúmenes y gráficos que no se mostrarían
+    if not orders_in_month and not collections_in_month:
+        generation_date_str = get_current_time_ve().strftime("%d/%m/%Y %H:%M:%S")
+        return monthly_pdf_response(render_template('pdf/reporte_mensual_sin_datos.html', report_period=report_period, generation_date=generation_date_str))
+
+    # D. Flujo de Fondos por Cuenta (común para ambos reportes)
     banks = Bank.query.all()
+    # Totales del mes de todos los bancos en dos consultas agrupadas en vez de varias por banco.
+    # Los pagos por punto de venta se abonan al banco del punto.
+    payment_bank_id = func.coalesce(Payment.bank_id, PointOfSale.bank_id)
+    bank_payment_totals = {
+        bank_id: (float(ves or 0.0), float(usd or 0.0))
+        for bank_id, ves, usd in db.session.query(
+            payment_bank_id, func.sum(Payment.amount_ves_equivalent), func.sum(Payment.amount_usd_equivalent)
+        ).outerjoin(PointOfSale, Payment.pos_id == PointOfSale.id).filter(
+            Payment.date.between(start_dt, end_dt), payment_bank_id.isnot(None)
+        ).group_by(payment_bank_id)
+    }
+    bank_movement_totals = {
+        bank_id: (float(inflow or 0.0), float(outflow or 0.0))
+        for bank_id, inflow, outflow in db.session.query(
+            ManualFinancialMovement.bank_id,
+            func.sum(case((ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.amount), else_=0)),
+            func.sum(case((ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.amount), else_=0))
+        ).filter(
+            ManualFinancialMovement.bank_id.isnot(None), ManualFinancialMovement.date.between(start_dt, end_dt),
+            ManualFinancialMovement.status == 'Aprobado', ManualFinancialMovement.currency == 'VES'
+        ).group_by(ManualFinancialMovement.bank_id)
+    }
     bank_balances = []
     for bank in banks:
-        inflows_ves = (db.session.query(func.sum(Payment.amount_ves_equivalent)).filter(or_(Payment.bank_id == bank.id, Payment.pos.has(bank_id=bank.id)), Payment.date.between(start_dt, end_dt)).scalar() or 0.0) + (db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.bank_id == bank.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.currency == 'VES', ManualFinancialMovement.status == 'Aprobado').scalar() or 0.0)
-        outflows_ves = db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.bank_id == bank.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.status == 'Aprobado', ManualFinancialMovement.currency == 'VES').scalar() or 0.0
+        payments_ves, inflows_usd = bank_payment_totals.get(bank.id, (0.0, 0.0))
+        manual_inflows_ves, outflows_ves = bank_movement_totals.get(bank.id, (0.0, 0.0))
+        inflows_ves = payments_ves + manual_inflows_ves
         final_balance_ves = bank.balance
         initial_balance_ves = final_balance_ves - inflows_ves + outflows_ves
         
-        # Calcular ingresos en USD basados en la tasa histórica de cada pago
-        inflows_usd = (db.session.query(func.sum(Payment.amount_usd_equivalent)).filter(or_(Payment.bank_id == bank.id, Payment.pos.has(bank_id=bank.id)), Payment.date.between(start_dt, end_dt)).scalar() or 0.0)
+        # inflows_usd: ingresos en USD basados en la tasa histórica de cada pago
         bank_balances.append({'name': bank.name, 'inflows_ves': inflows_ves, 'outflows_ves': outflows_ves, 'initial_balance_ves': initial_balance_ves, 'final_balance_ves': final_balance_ves, 'inflows_usd': inflows_usd})
 
     cash_boxes_query = CashBox.query
     if active_store_id and active_store_id != 'all':
         cash_boxes_query = cash_boxes_query.filter(CashBox.store_id == active_store_id)
     cash_boxes = cash_boxes_query.all()
+    # Totales del mes de todas las cajas en dos consultas agrupadas por (caja, moneda) en vez de varias por caja
+    cash_box_ids = [box.id for box in cash_boxes]
+    cash_payment_totals = {
+        (box_id, currency): (float(paid or 0.0), float(usd or 0.0))
+        for box_id, currency, paid, usd in db.session.query(
+            Payment.cash_box_id, Payment.currency_paid, func.sum(Payment.amount_paid), func.sum(Payment.amount_usd_equivalent)
+        ).filter(
+            Payment.cash_box_id.in_(cash_box_ids), Payment.date.between(start_dt, end_dt)
+        ).group_by(Payment.cash_box_id, Payment.currency_paid)
+    }
+    cash_movement_totals = {
+        (box_id, currency): (float(inflow or 0.0), float(outflow or 0.0))
+        for box_id, currency, inflow, outflow in db.session.query(
+            ManualFinancialMovement.cash_box_id, ManualFinancialMovement.currency,
+            func.sum(case((ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.amount), else_=0)),
+            func.sum(case((ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.amount), else_=0))
+        ).filter(
+            ManualFinancialMovement.cash_box_id.in_(cash_box_ids), ManualFinancialMovement.date.between(start_dt, end_dt),
+            ManualFinancialMovement.status == 'Aprobado'
+        ).group_by(ManualFinancialMovement.cash_box_id, ManualFinancialMovement.currency)
+    }
     cash_box_balances = []
     for box in cash_boxes:
-        inflows_ves = (db.session.query(func.sum(Payment.amount_paid)).filter(Payment.cash_box_id == box.id, Payment.date.between(start_dt, end_dt), Payment.currency_paid == 'VES').scalar() or 0.0) + (db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.currency == 'VES', ManualFinancialMovement.status == 'Aprobado').scalar() or 0.0)
-        outflows_ves = db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.status == 'Aprobado', ManualFinancialMovement.currency == 'VES').scalar() or 0.0
+        payments_ves, _ = cash_payment_totals.get((box.id, 'VES'), (0.0, 0.0))
+        manual_inflows_ves, outflows_ves = cash_movement_totals.get((box.id, 'VES'), (0.0, 0.0))
+        inflows_ves = payments_ves + manual_inflows_ves
         initial_balance_ves = box.balance_ves - inflows_ves + outflows_ves
 
-        inflows_usd = (db.session.query(func.sum(Payment.amount_paid)).filter(Payment.cash_box_id == box.id, Payment.date.between(start_dt, end_dt), Payment.currency_paid == 'USD').scalar() or 0.0) + (db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.currency == 'USD', ManualFinancialMovement.status == 'Aprobado').scalar() or 0.0)
-        outflows_usd = db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.status == 'Aprobado', ManualFinancialMovement.currency == 'USD').scalar() or 0.0
+        payments_usd, _ = cash_payment_totals.get((box.id, 'USD'), (0.0, 0.0))
+        manual_inflows_usd, outflows_usd = cash_movement_totals.get((box.id, 'USD'), (0.0, 0.0))
+        inflows_usd = payments_usd + manual_inflows_usd
         initial_balance_usd = box.balance_usd - inflows_usd + outflows_usd
 
-        # Calcular ingresos totales en USD (incluyendo pagos en VES convertidos históricamente)
-        total_inflows_usd = (db.session.query(func.sum(Payment.amount_usd_equivalent)).filter(Payment.cash_box_id == box.id, Payment.date.between(start_dt, end_dt)).scalar() or 0.0)
-        # Sumar ingresos manuales en USD
-        total_inflows_usd += (db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.currency == 'USD', ManualFinancialMovement.status == 'Aprobado').scalar() or 0.0)
+        # Calcular ingresos totales en USD (incluyendo pagos en VES convertidos históricamente) más los ingresos manuales en USD
+        total_inflows_usd = sum(usd for (box_id, _), (_, usd) in cash_payment_totals.items() if box_id == box.id) + manual_inflows_usd
 
         cash_box_balances.append({'name': box.name, 'initial_balance_ves': initial_balance_ves, 'inflows_ves': inflows_ves, 'outflows_ves': outflows_ves, 'final_balance_ves': box.balance_ves, 'initial_balance_usd': initial_balance_usd, 'inflows_usd': inflows_usd, 'outflows_usd': outflows_usd, 'final_balance_usd': box.balance_usd, 'total_inflows_usd': total_inflows_usd})
 
@@ -3965,7 +4514,13 @@ def generar_reporte_mensual_pdf():
         'punto_de_venta': {'amount': 0.0, 'amount_usd': 0.0}, 
         'intercambio_comercial': {'amount': 0.0, 'amount_usd': 0.0},
     }
-    for payment in payments_in_month_query.all():
+    # Una sola pasada sobre los pagos del mes: solo las columnas usadas, en lotes del cursor
+    # en vez de materializar todas las instancias de Payment antes de recorrerlas.
+    payments_in_month_rows = payments_in_month_query.with_entities(
+        Payment.method, Payment.currency_paid, Payment.amount_paid,
+        Payment.amount_ves_equivalent, Payment.amount_usd_equivalent
+    ).yield_per(500)
+    for payment in payments_in_month_rows:
         category = None
         if payment.method == 'efectivo_ves': category = 'efectivo_ves'
         elif payment.method == 'efectivo_usd': category = 'efectivo_usd'
@@ -3986,7 +4541,7 @@ def generar_reporte_mensual_pdf():
     # Calcular el total de ingresos en USD sumando los equivalentes históricos
     total_income_usd = sum(cat['amount_usd'] for cat in payments_summary.values())
 
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     
     logo_path = None
     if company_info and company_info.logo_filename:
@@ -4015,7 +4570,10 @@ def generar_reporte_mensual_pdf():
 
     if is_management_report:
         # --- Datos Adicionales para Reporte Gerencial ---
-        cost_structure = CostStructure.query.first() or CostStructure()
+        cost_structure = get_cost_structure() or CostStructure()
+        # Porcentajes por defecto resueltos una vez, fuera del recorrido de items
+        default_sales_exp_pct = cost_structure.default_sales_commission_percent or 0
+        default_marketing_pct = cost_structure.default_marketing_percent or 0
         
         # A. Estado de Resultados (P&L)
         pnl_summary = {'sales': 0, 'cogs': 0, 'variable_expenses': 0, 'fixed_expenses': 0, 'gross_profit': 0, 'net_profit': 0}
@@ -4026,8 +4584,8 @@ def generar_reporte_mensual_pdf():
                 for item in order.items:
                     if item.cost_at_sale_ves is not None: pnl_summary['cogs'] += (item.cost_at_sale_ves * item.quantity) / rate
                     item_revenue_usd = (item.price * item.quantity) / rate
-                    var_sales_exp_pct = item.product.variable_selling_expense_percent if item.product and item.product.variable_selling_expense_percent > 0 else (cost_structure.default_sales_commission_percent or 0)
-                    var_marketing_pct = item.product.variable_marketing_percent if item.product and item.product.variable_marketing_percent > 0 else (cost_structure.default_marketing_percent or 0)
+                    var_sales_exp_pct = item.product.variable_selling_expense_percent if item.product and item.product.variable_selling_expense_percent > 0 else default_sales_exp_pct
+                    var_marketing_pct = item.product.variable_marketing_percent if item.product and item.product.variable_marketing_percent > 0 else default_marketing_pct
                     pnl_summary['variable_expenses'] += item_revenue_usd * (var_sales_exp_pct + var_marketing_pct)
         
         pnl_summary['fixed_expenses'] = (cost_structure.monthly_rent or 0) + (cost_structure.monthly_utilities or 0) + (cost_structure.monthly_fixed_taxes or 0)
@@ -4052,7 +4610,7 @@ def generar_reporte_mensual_pdf():
         
         # D. Cuentas por cobrar pendientes (al final del mes)
         paid_subquery = db.session.query(Payment.order_id, func.sum(Payment.amount_ves_equivalent).label('total_paid')).group_by(Payment.order_id).subquery()
-        pending_accounts_query = Order.query.options(joinedload(Order.client), subqueryload(Order.payments)).outerjoin(paid_subquery, Order.id == paid_subquery.c.order_id).filter(Order.date_created <= end_dt, (Order.total_amount - func.coalesce(paid_subquery.c.total_paid, 0)) > 0.01)
+        pending_accounts_query = Order.query.options(joinedload(Order.client), selectinload(Order.payments)).outerjoin(paid_subquery, Order.id == paid_subquery.c.order_id).filter(Order.date_created <= end_dt, (Order.total_amount - func.coalesce(paid_subquery.c.total_paid, 0)) > 0.01)
         if active_store_id and active_store_id != 'all': pending_accounts_query = pending_accounts_query.filter(Order.store_id == active_store_id)
         pending_accounts_receivable = pending_accounts_query.order_by(Order.date_created.asc()).all()
 
@@ -4076,33 +4634,14 @@ def generar_reporte_mensual_pdf():
         # No se necesitan más datos, solo renderizar con el contexto básico.
         template_name = 'pdf/reporte_mensual_ventas.html'
 
-    # --- 4. Verificación de Datos y Renderizado del Template ---
-    is_data_available = bool(orders_in_month) or bool(collections_in_month)
-    if not is_data_available:
-        html_string = render_template('pdf/reporte_mensual_sin_datos.html', report_period=report_period, generation_date=generation_date_str)
-    else:
-        html_string = render_template(template_name, **context)
-
-    # --- 5. Creación del PDF y Envío de Respuesta ---
-    if eventlet:
-        pdf_file = eventlet.tpool.execute(HTML(string=html_string, base_url=request.base_url).write_pdf)
-    else:
-        pdf_file = HTML(string=html_string, base_url=request.base_url).write_pdf()
-
-    response = make_response(pdf_file)
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'inline; filename=cierre_mensual_{year}_{month:02d}.pdf'
-    
-    return response
+    # --- 4. Renderizado del Template y Creación del PDF ---
+    return monthly_pdf_response(render_template(template_name, **context))
 
 # Nueva ruta para cargar productos desde un archivo de Excel
 @routes_blueprint.route('/inventario/cargar_excel', methods=['GET', 'POST'])
 @login_required
+@role_required(is_gerente) # Superusuario and Gerente can upload excel
 def cargar_excel():
-    if not is_gerente(): # Superusuario and Gerente can upload excel
-        flash('Acceso denegado. Solo los administradores pueden realizar esta acción.', 'danger')
-        return redirect(request.referrer or url_for('main.dashboard'))
-
     if request.method == 'POST':
         if 'file' not in request.files:
             flash('No se ha seleccionado ningún archivo.', 'danger')
@@ -4123,48 +4662,66 @@ def cargar_excel():
             flash('Formato de archivo no válido. Solo se aceptan archivos .xlsx.', 'danger')
             return redirect(request.url)
 
-        # Use a temporary directory within the instance path for cross-platform compatibility
-        upload_dir = os.path.join(current_app.instance_path, 'uploads')
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        filepath = os.path.join(upload_dir, file.filename)
-        file.save(filepath)
-
         try:
-            workbook = openpyxl.load_workbook(filepath, data_only=True)
-            sheet = workbook.active
-            
+            # Se lee desde memoria (sin archivo temporal; pandas abre el libro en modo read_only).
+            # El archivo no tiene encabezados: las 11 columnas se normalizan completas con pandas
+            # y el bucle por fila solo arma los diccionarios.
+            # Sin los NA por defecto de pandas: textos como "NA" o "None" (ej. un color) se guardan
+            # tal cual; solo la celda vacía cuenta como faltante.
+            df = pd.read_excel(
+                io.BytesIO(file.read()), header=None, dtype=object, keep_default_na=False, na_values=['']
+            ).reindex(columns=range(11))
+            df = df[df[0].notna() & df[0].astype(bool)]
+
+            def text_column(col):
+                values = df[col]
+                return values.where(values.notna(), '').astype(str).str.strip().tolist()
+
+            def number_column(col, dtype, rows_mask=None):
+                # Un valor no numérico lanza ValueError y aborta la carga, como antes.
+                # Con rows_mask solo se leen esas filas; las demás quedan en 0.
+                values = df[col] if rows_mask is None else df[col].where(rows_mask, 0)
+                return pd.to_numeric(values).fillna(0).astype(dtype).tolist()
+
+            barcodes = text_column(0)
             new_products = []
             updates = []
-            all_barcodes_in_file = {str(row[0]).strip() for row in sheet.iter_rows(min_row=1, values_only=True) if row and row[0]}
+            all_barcodes_in_file = set(barcodes)
+            # Productos existentes y su stock en el almacén destino en dos consultas, no una por fila
+            existing_products = {
+                barcode: (product_id, name)
+                for product_id, name, barcode in db.session.execute(
+                    select(Product.id, Product.name, Product.barcode).where(Product.barcode.in_(all_barcodes_in_file))
+                )
+            }
+            stock_in_warehouse = dict(db.session.execute(
+                select(ProductStock.product_id, ProductStock.quantity).where(
+                    ProductStock.warehouse_id == warehouse_id,
+                    ProductStock.product_id.in_([product_id for product_id, _ in existing_products.values()])
+                )
+            ).all())
+
+            # Costo y precio solo se usan en productos nuevos: en las filas de productos existentes
+            # no se leen, así que un texto suelto ahí no aborta la carga.
+            is_new_product = ~pd.Series(barcodes, index=df.index).isin(existing_products.keys())
+            rows = zip(
+                barcodes, text_column(1), text_column(2),
+                number_column(3, float, is_new_product), number_column(4, float, is_new_product),
+                number_column(5, int),
+                df[6].where(df[6].notna(), '').tolist(),
+                text_column(7), text_column(8), text_column(9), text_column(10)
+            )
             
-            for row in sheet.iter_rows(min_row=1, values_only=True):
-                if not row[0]:
-                    continue
-                
-                barcode = str(row[0]).strip()
-                codigo_producto = str(row[1]).strip() if len(row) > 1 and row[1] is not None else ''
-                name = str(row[2]).strip()
-                cost_usd = row[3] if row[3] is not None else 0
-                price_usd = row[4] if row[4] is not None else 0
-                stock_to_add = int(row[5]) if row[5] is not None else 0
-                image_url = row[6] if row[6] is not None else ''
-                marca = str(row[7]).strip() if len(row) > 7 and row[7] is not None else ''
-                color = str(row[8]).strip() if len(row) > 8 and row[8] is not None else ''
-                talla = str(row[9]).strip() if len(row) > 9 and row[9] is not None else ''
-                grupo = str(row[10]).strip() if len(row) > 10 and row[10] is not None else ''
-
-                product = Product.query.filter_by(barcode=barcode).first()
-                current_stock_in_warehouse = 0
+            for barcode, codigo_producto, name, cost_usd, price_usd, stock_to_add, image_url, marca, color, talla, grupo in rows:
+                product = existing_products.get(barcode)
 
                 if product:
-                    stock_entry = ProductStock.query.filter_by(product_id=product.id, warehouse_id=warehouse_id).first()
-                    if stock_entry:
-                        current_stock_in_warehouse = stock_entry.quantity
+                    product_id, product_name = product
+                    current_stock_in_warehouse = stock_in_warehouse.get(product_id, 0)
 
                     updates.append({
-                        'id': product.id,
-                        'name': product.name,
+                        'id': product_id,
+                        'name': product_name,
                         'barcode': barcode,
                         'stock_to_add': stock_to_add,
                         'old_stock': current_stock_in_warehouse,
@@ -4175,8 +4732,8 @@ def cargar_excel():
                         'barcode': barcode,
                         'codigo_producto': codigo_producto,
                         'name': name,
-                        'cost_usd': float(cost_usd),
-                        'price_usd': float(price_usd),
+                        'cost_usd': cost_usd,
+                        'price_usd': price_usd,
                         'stock_to_add': stock_to_add,
                         'image_url': image_url,
                         'marca': marca,
@@ -4186,12 +4743,21 @@ def cargar_excel():
                     })
 
             if updates:
-                # Guardar en sesión para la página de confirmación
-                session['excel_upload_data'] = {
+                # Guardar en BD para la página de confirmación; la cookie de sesión solo lleva el token.
+                # Una carga previa sin confirmar del mismo usuario queda descartada, y también las de
+                # cualquier usuario con más de 6 horas (abandonadas o cuyo token se perdió al fallar).
+                PendingExcelUpload.query.filter(or_(
+                    PendingExcelUpload.user_id == current_user.id,
+                    PendingExcelUpload.created_at < get_current_time_ve() - timedelta(hours=6)
+                )).delete(synchronize_session=False)
+                token = secrets.token_urlsafe(16)
+                db.session.add(PendingExcelUpload(token=token, user_id=current_user.id, payload={
                     'warehouse_id': warehouse_id,
                     'new_products': new_products,
                     'updates': updates
-                }
+                }))
+                db.session.commit()
+                session['excel_upload_token'] = token
                 return redirect(url_for('main.cargar_excel_confirmar'))
             
             # Si solo hay productos nuevos, los procesamos directamente
@@ -4201,16 +4767,11 @@ def cargar_excel():
                 db.session.add(load_log)
                 db.session.flush()
 
-                for prod_data in new_products:
-                    stock_to_add = prod_data.pop('stock_to_add')
-                    new_prod = Product(**prod_data)
-                    db.session.add(new_prod)
-                    db.session.flush() # Para obtener el ID del nuevo producto
-                    
-                    # Añadir stock y movimiento
-                    add_stock_and_movement(new_prod.id, warehouse_id, stock_to_add, load_log.id, f"Carga Masiva #{load_log.id}")
+                # Añadir productos, stock y movimientos
+                add_excel_products(warehouse_id, new_products, load_log)
 
             db.session.commit()
+            clear_reference_caches()
 
             log_user_activity(
                 action="Realizó carga masiva de productos",
@@ -4225,9 +4786,6 @@ def cargar_excel():
             db.session.rollback()
             flash(f'Ocurrió un error al procesar el archivo: {str(e)}', 'danger')
             return redirect(request.url)
-        finally:
-            if os.path.exists(filepath):
-                os.remove(filepath)
     
     warehouses = Warehouse.query.order_by(Warehouse.id).all()
     # Cargar el historial de cargas masivas para mostrarlo en la página
@@ -4239,39 +4797,65 @@ def cargar_excel():
     return render_template('inventario/cargar_excel.html', title='Cargar Inventario desde Excel', 
                            warehouses=warehouses, load_history=load_history)
 
-def add_stock_and_movement(product_id, warehouse_id, quantity, document_id, document_type):
-    """Función auxiliar para añadir stock y registrar el movimiento."""
-    if quantity <= 0:
+def add_excel_products(warehouse_id, new_products, load_log):
+    """Crea los productos nuevos de una carga Excel (un solo flush para todos) y les suma su stock inicial."""
+    products_with_stock = []
+    for prod_data in new_products:
+        stock_to_add = prod_data.pop('stock_to_add')
+        products_with_stock.append((Product(**prod_data), stock_to_add))
+    db.session.add_all([product for product, _ in products_with_stock])
+    db.session.flush() # Para obtener los IDs de los productos nuevos
+
+    add_stock_and_movements(warehouse_id, [
+        (product.id, stock_to_add, f"Carga Masiva #{load_log.id}") for product, stock_to_add in products_with_stock
+    ], load_log.id)
+
+def add_stock_and_movements(warehouse_id, entries, document_id):
+    """
+    Función auxiliar para añadir stock y registrar los movimientos de una carga masiva.
+    `entries` es una lista de (product_id, quantity, document_type). El stock existente del almacén
+    se lee en una sola consulta y los movimientos se insertan en bloque.
+    """
+    entries = [entry for entry in entries if entry[1] > 0]
+    if not entries:
         return
 
-    # Actualizar o crear el registro de stock
-    stock_entry = ProductStock.query.filter_by(product_id=product_id, warehouse_id=warehouse_id).first()
-    if stock_entry:
-        stock_entry.quantity += quantity
-    else:
-        stock_entry = ProductStock(product_id=product_id, warehouse_id=warehouse_id, quantity=quantity)
-        db.session.add(stock_entry)
-
-    # Crear el movimiento de inventario
-    movement = Movement(
-        product_id=product_id,
-        type='Entrada',
-        warehouse_id=warehouse_id,
-        quantity=quantity,
-        document_id=document_id,
-        document_type=document_type,
-        description="Cargado mediante Excel"
-    )
-    db.session.add(movement)
+    # Actualizar o crear los registros de stock
+    stock_entries = {
+        stock.product_id: stock
+        for stock in ProductStock.query.filter(
+            ProductStock.warehouse_id == warehouse_id,
+            ProductStock.product_id.in_({product_id for product_id, _, _ in entries})
+        )
+    }
+    movements = []
+    for product_id, quantity, document_type in entries:
+        stock_entry = stock_entries.get(product_id)
+        if stock_entry:
+            stock_entry.quantity += quantity
+        else:
+            stock_entry = stock_entries[product_id] = ProductStock(product_id=product_id, warehouse_id=warehouse_id, quantity=quantity)
+            db.session.add(stock_entry)
+
+        # Crear el movimiento de inventario
+        movements.append(Movement(
+            product_id=product_id,
+            type='Entrada',
+            warehouse_id=warehouse_id,
+            quantity=quantity,
+            document_id=document_id,
+            document_type=document_type,
+            description="Cargado mediante Excel"
+        ))
+    db.session.bulk_save_objects(movements)
 
 @routes_blueprint.route('/inventario/cargar_excel_confirmar', methods=['GET', 'POST'])
 @login_required
+@role_required(is_gerente) # Superusuario and Gerente can confirm excel upload
 def cargar_excel_confirmar():
-    if not is_gerente(): # Superusuario and Gerente can confirm excel upload
-        flash('Acceso denegado. Solo los administradores pueden realizar esta acción.', 'danger')
-        return redirect(request.referrer or url_for('main.dashboard'))
-        
-    upload_data = session.get('excel_upload_data', {})
+    token = session.get('excel_upload_token')
+    pending_upload = PendingExcelUpload.query.filter_by(token=token, user_id=current_user.id).first() if token else None
+    upload_data = pending_upload.payload if pending_upload else {}
     if not upload_data:
         flash('No hay datos de carga para confirmar.', 'warning')
         return redirect(url_for('main.cargar_excel'))
@@ -4286,18 +4870,16 @@ def cargar_excel_confirmar():
             db.session.flush()
 
             # Procesar productos nuevos
-            for prod_data in upload_data.get('new_products', []):
-                stock_to_add = prod_data.pop('stock_to_add')
-                new_prod = Product(**prod_data)
-                db.session.add(new_prod)
-                db.session.flush()
-                add_stock_and_movement(new_prod.id, warehouse_id, stock_to_add, load_log.id, f"Carga Masiva #{load_log.id}")
+            add_excel_products(warehouse_id, upload_data.get('new_products', []), load_log)
 
             # Procesar actualizaciones de stock para productos existentes
-            for update_data in upload_data.get('updates', []):
-                add_stock_and_movement(update_data['id'], warehouse_id, update_data['stock_to_add'], load_log.id, "Carga Masiva Excel")
+            add_stock_and_movements(warehouse_id, [
+                (update_data['id'], update_data['stock_to_add'], "Carga Masiva Excel") for update_data in upload_data.get('updates', [])
+            ], load_log.id)
 
+            db.session.delete(pending_upload)
             db.session.commit()
+            clear_reference_caches()
             log_user_activity(
                 action="Confirmó carga masiva de productos",
                 details=f"Carga desde Excel al almacén ID {warehouse_id}. {len(upload_data.get('new_products', []))} nuevos, {len(upload_data.get('updates', []))} actualizados.",
@@ -4310,7 +4892,7 @@ def cargar_excel_confirmar():
             db.session.rollback()
             flash(f'Ocurrió un error al confirmar la actualización: {str(e)}', 'danger')
         finally:
-            session.pop('excel_upload_data', None)
+            session.pop('excel_upload_token', None)
         
         return redirect(url_for('main.inventory_list'))
 
@@ -4353,7 +4935,7 @@ def company_settings():
         flash('Acceso denegado. Solo el administrador del sistema puede realizar esta acción.', 'danger')
         return redirect(url_for('main.dashboard'))
 
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     form = CompanyInfoForm(obj=company_info)
 
     if form.validate_on_submit():
@@ -4374,7 +4956,6 @@ def company_settings():
             if logo_file:
                 pass
                 upload_dir = os.path.join(current_app.root_path, 'static', 'uploads', 'logos')
-                os.makedirs(upload_dir, exist_ok=True)
                 
                 filename = f"logo_{company_info.id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{os.path.splitext(logo_file.filename)[1]}"
                 filepath = os.path.join(upload_dir, filename)
@@ -4383,6 +4964,7 @@ def company_settings():
                 company_info.logo_filename = f"uploads/logos/{filename}"
             
             db.session.commit()
+            g.company_info = company_info
             flash('Información de la empresa guardada exitosamente.', 'success')
             return redirect(url_for('main.company_settings'))
         except Exception as e:
@@ -4394,56 +4976,52 @@ def company_settings():
 # Rutas de Estructura de Costos
 @routes_blueprint.route('/costos/lista')
 @login_required
+@role_required(is_gerente, 'Acceso denegado. Solo los administradores pueden ver esta sección.') # Superusuario and Gerente can view cost list
 def cost_list():
-    if not is_gerente(): # Superusuario and Gerente can view cost list
-        flash('Acceso denegado. Solo los administradores pueden ver esta sección.', 'danger')
-        return redirect(request.referrer or url_for('main.dashboard'))
-
-    cost_structure = CostStructure.query.first()
+    cost_structure = get_cost_structure()
     if not cost_structure:
         flash('Por favor, configure la estructura de costos generales primero.', 'info')
         return redirect(url_for('main.cost_structure_config'))
 
-    # Excluir el grupo 'Ganchos' (insumos) de la estructura de costos
-    products = Product.query.filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None))).all()
+    # Excluir el grupo 'Ganchos' (insumos) de la estructura de costos.
+    # Solo las columnas que usan el cálculo y la tabla (nombre, costo, id), no el objeto Product completo.
+    products = db.session.execute(
+        select(
+            Product.id, Product.name, Product.cost_usd, Product.specific_freight_cost, Product.price_usd,
+            Product.variable_selling_expense_percent, Product.variable_marketing_percent
+        ).where(NON_GANCHO)
+    ).all()
     
-    total_estimated_sales = db.session.query(func.sum(Product.estimated_monthly_sales)).filter(or_(Product.grupo != 'Ganchos', Product.grupo.is_(None))).scalar() or 1
-    if total_estimated_sales == 0:
-        total_estimated_sales = 1
+    fixed_cost_per_unit = get_fixed_cost_per_unit(cost_structure)
 
-    total_fixed_costs = (cost_structure.monthly_rent or 0) + \
-                        (cost_structure.monthly_utilities or 0) + \
-                        (cost_structure.monthly_fixed_taxes or 0)
-    
-    fixed_cost_per_unit = total_fixed_costs / total_estimated_sales
+    # Costos de todos los productos calculados por columnas con NumPy
+    def column_array(name):
+        return np.array([getattr(row, name) or 0 for row in products], dtype=np.float64)
 
-    products_with_costs = []
-    for product in products:
-        # El precio de venta final es el que está guardado en el producto.
-        selling_price = product.price_usd or 0
+    cost = column_array('cost_usd')
+    freight = column_array('specific_freight_cost')
+    selling_price = column_array('price_usd')
+    sales_exp_pct = column_array('variable_selling_expense_percent')
+    marketing_pct = column_array('variable_marketing_percent')
+    # Usar gastos variables específicos o los por defecto.
+    sales_exp_pct = np.where(sales_exp_pct > 0, sales_exp_pct, cost_structure.default_sales_commission_percent or 0)
+    marketing_pct = np.where(marketing_pct > 0, marketing_pct, cost_structure.default_marketing_percent or 0)
 
-        # Usar gastos variables específicos o los por defecto.
-        var_sales_exp_pct = product.variable_selling_expense_percent if product.variable_selling_expense_percent > 0 else cost_structure.default_sales_commission_percent
-        var_marketing_pct = product.variable_marketing_percent if product.variable_marketing_percent > 0 else cost_structure.default_marketing_percent
+    # El precio de venta final es el que está guardado en el producto; la utilidad es la diferencia
+    # entre ese precio y el costo total por unidad.
+    total_cost_per_unit = cost + freight + fixed_cost_per_unit + selling_price * sales_exp_pct + selling_price * marketing_pct
+    profit = selling_price - total_cost_per_unit
+    has_loss = (profit < 0) & (selling_price > 0)
 
-        # Calcular el costo total por unidad basado en el precio de venta final.
-        total_cost_per_unit = (product.cost_usd or 0) + \
-                              (product.specific_freight_cost or 0) + \
-                              fixed_cost_per_unit + \
-                              (selling_price * (var_sales_exp_pct or 0)) + \
-                              (selling_price * (var_marketing_pct or 0))
-        
-        # La utilidad es la diferencia entre el precio de venta y el costo total.
-        profit = selling_price - total_cost_per_unit
-
-        error = "El producto genera pérdidas." if profit < 0 and selling_price > 0 else None
-
-        products_with_costs.append({
+    products_with_costs = [
+        {
             'product': product,
-            'profit': profit,
-            'selling_price': selling_price,
-            'error': error
-        })
+            'profit': product_profit,
+            'selling_price': product_price,
+            'error': "El producto genera pérdidas." if loss else None
+        }
+        for product, product_profit, product_price, loss in zip(products, profit.tolist(), selling_price.tolist(), has_loss.tolist())
+    ]
 
     return render_template('costos/lista.html',
                            title='Estructura de Costos',
@@ -4452,16 +5030,14 @@ def cost_list():
 
 @routes_blueprint.route('/costos/configuracion', methods=['GET', 'POST'])
 @login_required
+@role_required(is_superuser) # Only Superuser can configure cost structure
 def cost_structure_config():
-    if not is_superuser(): # Only Superuser can configure cost structure
-        flash('Acceso denegado. Solo los administradores pueden realizar esta acción.', 'danger')
-        return redirect(request.referrer or url_for('main.dashboard'))
-
-    cost_structure = CostStructure.query.first()
+    cost_structure = get_cost_structure()
     if not cost_structure:
         cost_structure = CostStructure()
         db.session.add(cost_structure)
         db.session.commit()
+        g.cost_structure = cost_structure
 
     if request.method == 'POST':
         try:
@@ -4478,8 +5054,16 @@ def cost_structure_config():
             db.session.rollback()
             flash(f'Error al guardar la configuración. Verifique que los valores sean números. Error: {e}', 'danger')
 
-    usd_rate = get_cached_exchange_rate('USD')
-    eur_rate = get_cached_exchange_rate('EUR')
+    # Una sola consulta para ambas monedas; las filas alimentan la plantilla y se siembran
+    # en g para que get_cached_exchange_rate (context processors) no vuelva a consultar.
+    exchange_rate_rows = {}
+    for rate_row in ExchangeRate.query.filter(ExchangeRate.currency.in_(['USD', 'EUR'])).order_by(ExchangeRate.date_updated.asc()).all():
+        exchange_rate_rows[rate_row.currency] = rate_row
+    request_rates = g.setdefault('exchange_rates', {})
+    for currency, rate_row in exchange_rate_rows.items():
+        request_rates[currency] = rate_row.rate
+    usd_rate = request_rates.get('USD')
+    eur_rate = request_rates.get('EUR')
     manual_rate_required = usd_rate is None or eur_rate is None
     if manual_rate_required:
         flash('No se pudo obtener la tasa de cambio de las APIs. Por favor, ingrese un valor manualmente.', 'warning')
@@ -4490,8 +5074,8 @@ def cost_structure_config():
                            usd_rate=usd_rate or 0.0,
                            eur_rate=eur_rate or 0.0,
                            manual_rate_required=manual_rate_required,
-                           exchange_rate_info_usd=ExchangeRate.query.filter_by(currency='USD').first(),
-                           exchange_rate_info_eur=ExchangeRate.query.filter_by(currency='EUR').first())
+                           exchange_rate_info_usd=exchange_rate_rows.get('USD'),
+                           exchange_rate_info_eur=exchange_rate_rows.get('EUR'))
 
 
 @routes_blueprint.route('/costos/update_rate', methods=['POST'])
@@ -4525,6 +5109,7 @@ def update_exchange_rate():
             else:
                 exchange_rate_entry = ExchangeRate(currency=currency, rate=manual_rate)
                 db.session.add(exchange_rate_entry)
+            clear_request_exchange_rates()
 
             # Also record in HistoricalExchangeRate for USD
             if currency == 'USD':
@@ -4558,13 +5143,10 @@ def update_exchange_rate():
 
 @routes_blueprint.route('/costos/editar/<int:product_id>', methods=['GET', 'POST'])
 @login_required
+@role_required(is_gerente) # Superusuario and Gerente can edit product costs
 def edit_product_cost(product_id):
-    if not is_gerente(): # Superusuario and Gerente can edit product costs
-        flash('Acceso denegado. Solo los administradores pueden realizar esta acción.', 'danger')
-        return redirect(request.referrer or url_for('main.dashboard'))
-
     product = Product.query.get_or_404(product_id)
-    cost_structure = CostStructure.query.first()
+    cost_structure = get_cost_structure()
     
     # Calcular punto de equilibrio financiero
     break_even_data = None
@@ -4574,13 +5156,8 @@ def edit_product_cost(product_id):
                            (cost_structure.monthly_utilities or 0) + \
                            (cost_structure.monthly_fixed_taxes or 0)
         
-        # Calcular ventas mensuales estimadas totales
-        total_estimated_sales = db.session.query(func.sum(Product.estimated_monthly_sales)).scalar() or 1
-        if total_estimated_sales == 0:
-            total_estimated_sales = 1
-        
         # Calcular costos fijos por unidad
-        fixed_cost_per_unit = total_fixed_costs / total_estimated_sales
+        fixed_cost_per_unit = get_fixed_cost_per_unit(cost_structure)
         
         # Usar gastos variables específicos o los valores por defecto (asegurando que no sean None)
         var_sales_exp_pct = product.variable_selling_expense_percent if product.variable_selling_expense_percent > 0 else (cost_structure.default_sales_commission_percent or 0)
@@ -4629,12 +5206,9 @@ def edit_product_cost(product_id):
                 flash('La configuración de costos generales no existe. No se puede calcular la utilidad.', 'danger')
                 return redirect(url_for('main.cost_structure_config'))
 
-            # Recalcular componentes de costo con los nuevos datos
-            total_estimated_sales = db.session.query(func.sum(Product.estimated_monthly_sales)).scalar() or 1
-            if total_estimated_sales == 0: total_estimated_sales = 1
-
-            total_fixed_costs = (cost_structure.monthly_rent or 0) + (cost_structure.monthly_utilities or 0) + (cost_structure.monthly_fixed_taxes or 0)
-            fixed_cost_per_unit = total_fixed_costs / total_estimated_sales
+            # Recalcular componentes de costo con los nuevos datos (las ventas estimadas del producto cambiaron)
+            g.pop('fixed_cost_per_unit', None)
+            fixed_cost_per_unit = get_fixed_cost_per_unit(cost_structure)
             base_cost = (product.cost_usd or 0) + product.specific_freight_cost + fixed_cost_per_unit
             
             # Recalcular y guardar el nuevo margen de utilidad
@@ -4675,45 +5249,28 @@ def edit_product_cost(product_id):
 @routes_blueprint.route('/ordenes/imprimir/<int:order_id>')
 @login_required
 def print_delivery_note(order_id):
-    order = Order.query.get_or_404(order_id)
-    company_info = CompanyInfo.query.first()
+    # La nota lista cada item con su producto, el cliente y los pagos: todo en consultas IN.
+    order = Order.query.options(
+        selectinload(Order.items).selectinload(OrderItem.product).lazyload(Product.stock_levels),
+        selectinload(Order.payments),
+        joinedload(Order.client)
+    ).filter_by(id=order_id).first_or_404()
+    company_info = get_company_info()
 
-    # El subtotal y el IVA se calculan directamente en la plantilla para manejar devoluciones.
+    # Subtotal neto de devoluciones, sobre los items ya cargados (la plantilla solo lo muestra).
+    subtotal = sum(item.price * (item.quantity - (item.returned_quantity or 0)) for item in order.items)
     order_total_with_iva = order.total_amount # This is the final amount after discount
 
     # Calculate total paid and change
     total_paid = sum(p.amount_ves_equivalent for p in order.payments)
     change = total_paid - order_total_with_iva if total_paid > order_total_with_iva else 0.0
 
-    # Helper function to generate barcode
-    def generate_order_barcode_base64(order_id_str):
-        """Generates a Code128 barcode image and returns it as a base64 string."""
-        if not order_id_str:
-            return None
-        try:
-            barcode = createBarcodeDrawing('Code128', value=order_id_str, barHeight=10*mm, barWidth=0.3*mm)
-            drawing = Drawing(barcode.width, barcode.height)
-            drawing.add(barcode)
-            buffer = io.BytesIO()
-            try:
-                # First, try the C-based backend which is faster
-                from reportlab.graphics import renderPM
-                renderPM.drawToFile(drawing, buffer, fmt='PNG')
-            except ImportError:
-                # Fallback to the pure Python backend if the C-backend is not available
-                from reportlab.graphics.renderPM import draw_to_file
-                draw_to_file(drawing, buffer, fmt='PNG')
-            buffer.seek(0)
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
-        except Exception as e:
-            current_app.logger.error(f"Error generating barcode for order ID {order_id_str}: {e}")
-            return None
-
     barcode_base64 = generate_order_barcode_base64(f"{order.id:09d}")
 
     return render_template('ordenes/imprimir_nota.html',
                            order=order,
                            company_info=company_info,
+                           subtotal=subtotal,
                            change=change,
                            barcode_base64=barcode_base64)
 
@@ -4721,36 +5278,16 @@ def print_delivery_note(order_id):
 @login_required
 def print_reservation_receipt(order_id):
     """Genera e imprime un recibo para un apartado."""
-    order = Order.query.get_or_404(order_id)
+    order = Order.query.options(
+        selectinload(Order.items).selectinload(OrderItem.product).lazyload(Product.stock_levels),
+        selectinload(Order.payments),
+        joinedload(Order.client)
+    ).filter_by(id=order_id).first_or_404()
     if order.status not in ['Apartado', 'Pagada']:
         flash('Esta orden no es un apartado y no se puede imprimir un recibo.', 'warning')
         return redirect(url_for('main.order_detail', order_id=order.id))
     
-    company_info = CompanyInfo.query.first()
-
-    # Helper function to generate barcode
-    def generate_order_barcode_base64(order_id_str):
-        """Generates a Code128 barcode image and returns it as a base64 string."""
-        if not order_id_str:
-            return None
-        try:
-            barcode = createBarcodeDrawing('Code128', value=order_id_str, barHeight=10*mm, barWidth=0.3*mm)
-            drawing = Drawing(barcode.width, barcode.height)
-            drawing.add(barcode)
-            buffer = io.BytesIO()
-            try:
-                # First, try the C-based backend which is faster
-                from reportlab.graphics import renderPM
-                renderPM.drawToFile(drawing, buffer, fmt='PNG')
-            except ImportError:
-                # Fallback to the pure Python backend if the C-backend is not available
-                from reportlab.graphics.renderPM import draw_to_file
-                draw_to_file(drawing, buffer, fmt='PNG')
-            buffer.seek(0)
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
-        except Exception as e:
-            current_app.logger.error(f"Error generating barcode for order ID {order_id_str}: {e}")
-            return None
+    company_info = get_company_info()
 
     barcode_base64 = generate_order_barcode_base64(f"{order.id:09d}")
 
@@ -4810,7 +5347,13 @@ def api_exchange_rate():
     # CORRECCIÓN: Usar la nueva función para obtener la tasa en USD
     rate = get_cached_exchange_rate('USD') # type: ignore
     if rate:
-        return jsonify(rate=rate)
+        response = jsonify(rate=rate)
+        # La tasa fija precios en las ventas: el navegador siempre revalida (no-cache), pero
+        # si no cambió recibe un 304 sin cuerpo gracias al ETag.
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.add_etag()
+        return make_conditional_compressed(response)
     else:
         return jsonify(error="No se pudo obtener la tasa de cambio"), 500
 
@@ -4884,26 +5427,20 @@ def api_search_clients():
     if not query:
         return jsonify(clients=[])
 
-    # Search by cedula_rif or name (case insensitive, partial match)
-    clients = Client.query.filter(
-        or_(
-            Client.cedula_rif.ilike(f'%{query}%'),
-            Client.name.ilike(f'%{query}%')
-        )
-    ).limit(10).all()
-
-    clients_data = []
-    for client in clients:
-        clients_data.append({
-            'id': client.id,
-            'name': client.name,
-            'cedula_rif': client.cedula_rif,
-            'email': client.email,
-            'phone': client.phone,
-            'address': client.address
-        })
+    # Search by cedula_rif or name (case insensitive, partial match).
+    # En PostgreSQL los dos ILIKE usan los índices trigram ix_client_*_trgm (ver create_search_indexes).
+    # Solo las columnas que devuelve la API, como diccionarios: sin instanciar objetos Client.
+    clients_data = [dict(row) for row in db.session.execute(
+        select(Client.id, Client.name, Client.cedula_rif, Client.email, Client.phone, Client.address).where(
+            or_(
+                Client.cedula_rif.ilike(f'%{query}%'),
+                Client.name.ilike(f'%{query}%')
+            )
+        ).limit(10)
+    ).mappings()]
 
-    return jsonify(clients=clients_data)
+    # Solo str/int: orjson los serializa directo, como en api_purchase_details
+    return current_app.response_class(orjson.dumps({'clients': clients_data}), mimetype='application/json')
 
 @routes_blueprint.route('/api/clientes/nuevo', methods=['POST'])
 @login_required
@@ -4925,12 +5462,16 @@ def api_new_client():
         email = None
 
     try:
-        # Check for duplicates
-        if cedula_rif and cedula_rif.strip() and Client.query.filter_by(cedula_rif=cedula_rif).first():
-            return jsonify({'error': f'La Cédula/RIF "{cedula_rif}" ya está registrada.'}), 409
-        
-        if email and Client.query.filter_by(email=email).first():
-            return jsonify({'error': f'El email "{email}" ya está registrado.'}), 409
+        # Check for duplicates: ambas columnas en una sola consulta (no tienen restricción UNIQUE)
+        if cedula_rif or email:
+            cedula_taken, email_taken = db.session.query(
+                select(Client.id).where(Client.cedula_rif == cedula_rif).exists() if cedula_rif else literal(False),
+                select(Client.id).where(Client.email == email).exists() if email else literal(False)
+            ).one()
+            if cedula_taken:
+                return jsonify({'error': f'La Cédula/RIF "{cedula_rif}" ya está registrada.'}), 409
+            if email_taken:
+                return jsonify({'error': f'El email "{email}" ya está registrado.'}), 409
 
         new_client = Client(
             name=name,
@@ -4941,6 +5482,7 @@ def api_new_client():
         )
         db.session.add(new_client)
         db.session.commit()
+        clear_reference_caches()
 
         client_data = { 'id': new_client.id, 'name': new_client.name, 'cedula_rif': new_client.cedula_rif, 'email': new_client.email, 'phone': new_client.phone, 'address': new_client.address }
         return jsonify(client_data), 201
@@ -5096,6 +5638,7 @@ def api_new_product():
         )
         db.session.add(new_prod)
         db.session.commit()
+        clear_reference_caches()
 
         return jsonify(id=new_prod.id, name=new_prod.name, barcode=new_prod.barcode, cost_usd=new_prod.cost_usd, stock=0), 201
     except Exception as e:
@@ -5190,6 +5733,7 @@ def new_bank():
             new_bank = Bank(name=name, account_number=account_number, balance=initial_balance)
             db.session.add(new_bank)
             db.session.commit()
+            clear_reference_caches()
             flash('Banco creado exitosamente!', 'success')
             return redirect(url_for('main.bank_list'))
         except (ValueError, IntegrityError):
@@ -5223,62 +5767,66 @@ def bank_movement_detail(bank_id):
 
     bank = Bank.query.get_or_404(bank_id)
     
-    # Get payments related to this bank (direct transfers and POS terminals)
-    pos_ids = [pos.id for pos in bank.pos_terminals]
-    payments_query = Payment.query.filter(or_(Payment.bank_id == bank_id, Payment.pos_id.in_(pos_ids)))
-    
-    # Get manual movements
-    manual_movements_query = ManualFinancialMovement.query.filter_by(bank_id=bank_id).options(joinedload(ManualFinancialMovement.order_return))
-    
-    # Combine and prepare for sorting
+    # Pagos (transferencias directas y puntos de venta del banco, siempre ingresos en VES) y
+    # movimientos manuales en VES en un solo UNION ALL ordenado por fecha en la base de datos.
+    # Solo columnas: el estado de la orden sale del JOIN, sin cargar cada orden por separado.
+    payments_select = select(
+        Payment.date.label('date'),
+        Payment.order_id.label('order_id'),
+        Payment.method.label('method'),
+        Payment.reference.label('reference'),
+        Payment.issuing_bank.label('issuing_bank'),
+        Payment.sender_id.label('sender_id'),
+        cast(null(), db.String).label('description'),
+        Payment.amount_ves_equivalent.label('income'),
+        literal(0.0).label('expense'),
+        case((Order.status == 'Anulada', True), else_=False).label('is_cancelled')
+    ).outerjoin(Order, Payment.order_id == Order.id).where(or_(
+        Payment.bank_id == bank_id,
+        Payment.pos_id.in_(select(PointOfSale.id).where(PointOfSale.bank_id == bank_id))
+    ))
+    # Se ocultan los reversos por anulación total para no duplicar visualmente la anulación
+    manual_movements_select = select(
+        ManualFinancialMovement.date,
+        cast(null(), db.BigInteger),
+        cast(null(), db.String),
+        cast(null(), db.String),
+        cast(null(), db.String),
+        cast(null(), db.String),
+        ManualFinancialMovement.description,
+        case((ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.amount), else_=0.0),
+        case((ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.amount), else_=0.0),
+        literal(False)
+    ).outerjoin(OrderReturn, ManualFinancialMovement.order_return_id == OrderReturn.id).where(
+        ManualFinancialMovement.bank_id == bank_id,
+        ManualFinancialMovement.currency == 'VES',
+        OrderReturn.return_type.is_distinct_from('Anulación Total')
+    )
+    movements_union = union_all(payments_select, manual_movements_select).subquery()
+
     combined_movements = []
-    
-    # Process payments (always income in VES)
-    for p in payments_query.all():
-        is_cancelled = False
-        if p.order and p.order.status == 'Anulada':
-            is_cancelled = True
-
-        if p.order_id is not None:
-            description_parts = [f"Pago de Orden #{p.order_id:09d}"]
+    for row in db.session.execute(select(movements_union).order_by(movements_union.c.date.desc())):
+        if row.description is not None:
+            description = row.description
         else:
-            description_parts = ["Pago"]
-        if p.method == 'transferencia':
-            if p.reference:
-                description_parts.append(f"Ref: {p.reference}")
-            if p.issuing_bank:
-                description_parts.append(f"Bco: {p.issuing_bank}")
-            if p.sender_id:
-                description_parts.append(f"CI/Tlf: {p.sender_id}")
+            description_parts = [f"Pago de Orden #{row.order_id:09d}" if row.order_id is not None else "Pago"]
+            if row.method == 'transferencia':
+                if row.reference:
+                    description_parts.append(f"Ref: {row.reference}")
+                if row.issuing_bank:
+                    description_parts.append(f"Bco: {row.issuing_bank}")
+                if row.sender_id:
+                    description_parts.append(f"CI/Tlf: {row.sender_id}")
+            description = ". ".join(description_parts)
 
         combined_movements.append({
-            'date': p.date,
-            'description': ". ".join(description_parts),
-            'income': p.amount_ves_equivalent,
-            'expense': 0,
+            'date': row.date,
+            'description': description,
+            'income': row.income,
+            'expense': row.expense,
             'currency': 'VES',
-            'is_cancelled': is_cancelled
+            'is_cancelled': bool(row.is_cancelled)
         })
-        
-    # Process manual movements
-    for m in manual_movements_query.all():
-        if m.currency != 'VES': continue
-        
-        # Ocultar movimientos de reverso por anulación total para no duplicar visualmente la anulación
-        if m.order_return and m.order_return.return_type == 'Anulación Total':
-            continue
-
-        combined_movements.append({
-            'date': m.date,
-            'description': m.description,
-            'income': m.amount if m.movement_type == 'Ingreso' else 0,
-            'expense': m.amount if m.movement_type == 'Egreso' else 0,
-            'currency': m.currency,
-            'is_cancelled': False
-        })
-        
-    # Sort all movements by date (newest first)
-    combined_movements.sort(key=lambda x: x['date'], reverse=True)
 
     return render_template('finanzas/movimientos_bancarios.html', 
                            title=f'Movimientos de {bank.name}', 
@@ -5314,6 +5862,7 @@ def new_pos():
                 new_pos = PointOfSale(name=name, bank_id=bank_id)
                 db.session.add(new_pos)
                 db.session.commit()
+                clear_reference_caches()
                 flash('Punto de Venta creado exitosamente!', 'success')
                 return redirect(url_for('main.pos_list'))
         except IntegrityError:
@@ -5354,6 +5903,7 @@ def new_cashbox():
             new_box = CashBox(name=name, balance_ves=balance_ves, balance_usd=balance_usd, store_id=active_store_id)
             db.session.add(new_box)
             db.session.commit()
+            clear_reference_caches()
             flash('Caja creada exitosamente!', 'success')
             return redirect(url_for('main.cashbox_list'))
         except (ValueError, IntegrityError):
@@ -5391,45 +5941,54 @@ def cashbox_movement_detail(cash_box_id):
 
     cash_box = CashBox.query.get_or_404(cash_box_id)
     
-    payments_query = Payment.query.filter_by(cash_box_id=cash_box_id)
-    manual_movements_query = ManualFinancialMovement.query.filter_by(cash_box_id=cash_box_id)
-    
-    movements_ves = []
-    for p in payments_query.filter_by(currency_paid='VES').all():
-        movements_ves.append({
-            'id': f'P-{p.id}', 'type': 'payment', 'obj': p,
-            'date': p.date, 'description': f"Pago de Orden #{p.order.id:09d}",
-            'income': p.amount_paid, 'expense': 0, 'status': 'Aprobado'
-        })
-    for m in manual_movements_query.filter_by(currency='VES').all():
-        desc = f"{m.description} (Por: {m.created_by_user.username if m.created_by_user else 'N/A'}, Recibe: {m.received_by or 'N/A'})"
-        movements_ves.append({
-            'id': f'M-{m.id}', 'type': 'manual', 'obj': m,
-            'date': m.date, 'description': desc,
-            'income': m.amount if m.movement_type == 'Ingreso' else 0,
-            'expense': m.amount if m.movement_type == 'Egreso' else 0,
-            'status': m.status
-        })
-    
-    movements_usd = []
-    for p in payments_query.filter_by(currency_paid='USD').all():
-        movements_usd.append({
-            'id': f'P-{p.id}', 'type': 'payment', 'obj': p,
-            'date': p.date, 'description': f"Pago de Orden #{p.order.id:09d}",
-            'income': p.amount_paid, 'expense': 0, 'status': 'Aprobado'
-        })
-    for m in manual_movements_query.filter_by(currency='USD').all():
-        desc = f"{m.description} (Por: {m.created_by_user.username if m.created_by_user else 'N/A'}, Recibe: {m.received_by or 'N/A'})"
-        movements_usd.append({
-            'id': f'M-{m.id}', 'type': 'manual', 'obj': m,
-            'date': m.date, 'description': desc,
-            'income': m.amount if m.movement_type == 'Ingreso' else 0,
-            'expense': m.amount if m.movement_type == 'Egreso' else 0,
-            'status': m.status
+    # Pagos y movimientos manuales de ambas monedas en un solo UNION ALL ordenado por fecha; las
+    # filas se reparten por moneda en una pasada. Solo columnas: ni órdenes ni usuarios se cargan uno a uno.
+    payments_select = select(
+        literal('payment').label('type'),
+        Payment.id.label('id'),
+        Payment.date.label('date'),
+        Payment.currency_paid.label('currency'),
+        Payment.order_id.label('order_id'),
+        cast(null(), db.String).label('description'),
+        cast(null(), db.String).label('created_by'),
+        cast(null(), db.String).label('received_by'),
+        Payment.amount_paid.label('income'),
+        literal(0.0).label('expense'),
+        literal('Aprobado').label('status'),
+        cast(null(), db.String).label('movement_type')
+    ).where(Payment.cash_box_id == cash_box_id, Payment.currency_paid.in_(['VES', 'USD']))
+    manual_movements_select = select(
+        literal('manual'),
+        ManualFinancialMovement.id,
+        ManualFinancialMovement.date,
+        ManualFinancialMovement.currency,
+        cast(null(), db.BigInteger),
+        ManualFinancialMovement.description,
+        User.username,
+        ManualFinancialMovement.received_by,
+        case((ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.amount), else_=0.0),
+        case((ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.amount), else_=0.0),
+        ManualFinancialMovement.status,
+        ManualFinancialMovement.movement_type
+    ).outerjoin(User, ManualFinancialMovement.created_by_user_id == User.id).where(
+        ManualFinancialMovement.cash_box_id == cash_box_id, ManualFinancialMovement.currency.in_(['VES', 'USD'])
+    )
+    movements_union = union_all(payments_select, manual_movements_select).subquery()
+
+    movements_by_currency = {'VES': [], 'USD': []}
+    for row in db.session.execute(select(movements_union).order_by(movements_union.c.date.desc())):
+        if row.type == 'payment':
+            description = f"Pago de Orden #{row.order_id:09d}" if row.order_id is not None else "Pago"
+        else:
+            description = f"{row.description} (Por: {row.created_by or 'N/A'}, Recibe: {row.received_by or 'N/A'})"
+        movements_by_currency[row.currency].append({
+            'id': f"{'P' if row.type == 'payment' else 'M'}-{row.id}", 'type': row.type,
+            'movement_id': row.id, 'movement_type': row.movement_type,
+            'date': row.date, 'description': description,
+            'income': row.income, 'expense': row.expense, 'status': row.status
         })
-        
-    movements_ves.sort(key=lambda x: x['date'], reverse=True)
-    movements_usd.sort(key=lambda x: x['date'], reverse=True)
+    movements_ves = movements_by_currency['VES']
+    movements_usd = movements_by_currency['USD']
 
     return render_template('finanzas/movimientos_caja.html', 
                            title=f'Movimientos de {cash_box.name}', 
@@ -5626,7 +6185,7 @@ def new_cash_withdrawal():
 @login_required
 def print_withdrawal_receipt(movement_id):
     movement = ManualFinancialMovement.query.get_or_404(movement_id)
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     if movement.movement_type != 'Egreso' or not movement.cash_box_id:
         flash('Movimiento no válido para generar recibo de retiro.', 'danger')
         return redirect(request.referrer or url_for('main.dashboard'))
@@ -5660,7 +6219,10 @@ def pending_withdrawals():
         return redirect(request.referrer or url_for('main.dashboard'))
     
     active_store_id = session.get('active_store_id')
-    pending_query = ManualFinancialMovement.query.filter_by(status='Pendiente', movement_type='Egreso')
+    # Quién solicita y la caja se muestran por fila: se cargan en la misma consulta
+    pending_query = ManualFinancialMovement.query.filter_by(status='Pendiente', movement_type='Egreso').options(
+        joinedload(ManualFinancialMovement.created_by_user), joinedload(ManualFinancialMovement.cash_box)
+    )
     if active_store_id and active_store_id != 'all':
         pending_query = pending_query.join(CashBox).filter(CashBox.store_id == active_store_id)
 
@@ -5793,61 +6355,51 @@ def print_daily_closing_report():
     start_of_day = VE_TIMEZONE.localize(datetime.combine(report_date, datetime.min.time()))
     end_of_day = VE_TIMEZONE.localize(datetime.combine(report_date, datetime.max.time()))
     
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     current_rate_usd = get_cached_exchange_rate('USD') or 1.0
 
     # --- 1. Sales Summary ---
     # Se incluyen todas las órdenes (contado, crédito, apartado) para el total de ventas y CMV.
-    orders_today_query = Order.query.filter(Order.date_created.between(start_of_day, end_of_day)).options(joinedload(Order.items))
+    # Totales por tipo de orden y CMV en dos consultas agregadas, sin cargar órdenes ni items.
+    orders_today_filters = [Order.date_created.between(start_of_day, end_of_day)]
     if active_store_id and active_store_id != 'all':
-        orders_today_query = orders_today_query.filter(Order.store_id == active_store_id)
-    orders_today = orders_today_query.all()
-    
+        orders_today_filters.append(Order.store_id == active_store_id)
+    sales_by_type_today = db.session.query(
+        Order.order_type, func.count(Order.id), func.sum(Order.total_amount), func.sum(Order.total_amount_usd)
+    ).filter(*orders_today_filters).group_by(Order.order_type).all()
+
+    # La tasa de cada orden es la de la venta o, si no tiene, la actual; sin tasa positiva no suma CMV
+    order_rate = func.coalesce(func.nullif(Order.exchange_rate_at_sale, 0), current_rate_usd)
+    item_cost_ves = OrderItem.cost_at_sale_ves * OrderItem.quantity
+    cogs_ves, cogs_usd = db.session.query(
+        func.sum(item_cost_ves), func.sum(item_cost_ves / order_rate)
+    ).join(Order, OrderItem.order_id == Order.id).filter(
+        *orders_today_filters, OrderItem.cost_at_sale_ves.isnot(None), order_rate > 0
+    ).one()
+
     sales_summary = {
         'contado': {'count': 0, 'amount_ves': 0.0, 'amount_usd': 0.0},
         'credito': {'count': 0, 'amount_ves': 0.0, 'amount_usd': 0.0},
         'apartado': {'count': 0, 'amount_ves': 0.0, 'amount_usd': 0.0},
-        'total': {'count': 0, 'amount_ves': 0.0, 'amount_usd': 0.0, 'cogs_ves': 0.0, 'cogs_usd': 0.0}
+        'total': {'count': 0, 'amount_ves': 0.0, 'amount_usd': 0.0, 'cogs_ves': cogs_ves or 0.0, 'cogs_usd': cogs_usd or 0.0}
     }
-    for order in orders_today:
-        sales_summary['total']['count'] += 1
-        sales_summary['total']['amount_ves'] += order.total_amount
-        sales_summary['total']['amount_usd'] += order.total_amount_usd
-        
-        # Calcular el costo de la mercancía vendida (CMV) para esta orden
-        order_cogs_ves = 0
-        order_cogs_usd = 0
-        rate = order.exchange_rate_at_sale or current_rate_usd
-        if rate > 0:
-            for item in order.items:
-                if item.cost_at_sale_ves is not None:
-                    cost_item_ves = item.cost_at_sale_ves * item.quantity
-                    order_cogs_ves += cost_item_ves
-                    order_cogs_usd += cost_item_ves / rate
-
-        sales_summary['total']['cogs_ves'] += order_cogs_ves
-        sales_summary['total']['cogs_usd'] += order_cogs_usd
-
-        # Clasificar por tipo de orden para el desglose
-        if order.order_type == 'regular':
-            sales_summary['contado']['count'] += 1
-            sales_summary['contado']['amount_ves'] += order.total_amount
-            sales_summary['contado']['amount_usd'] += order.total_amount_usd
-        elif order.order_type == 'credit':
-            sales_summary['credito']['count'] += 1
-            sales_summary['credito']['amount_ves'] += order.total_amount
-            sales_summary['credito']['amount_usd'] += order.total_amount_usd
-        elif order.order_type == 'reservation':
-            sales_summary['apartado']['count'] += 1
-            sales_summary['apartado']['amount_ves'] += order.total_amount
-            sales_summary['apartado']['amount_usd'] += order.total_amount_usd
+    # Clasificar por tipo de orden para el desglose
+    summary_keys = {'regular': 'contado', 'credit': 'credito', 'reservation': 'apartado'}
+    for order_type, count, amount_ves, amount_usd in sales_by_type_today:
+        for key in ('total', summary_keys.get(order_type)):
+            if key:
+                sales_summary[key]['count'] += count
+                sales_summary[key]['amount_ves'] += amount_ves or 0.0
+                sales_summary[key]['amount_usd'] += amount_usd or 0.0
 
     # --- 2. Payments Summary by Method ---
-    payments_today_query = Payment.query.filter(Payment.date.between(start_of_day, end_of_day))
+    payments_today_query = db.session.query(
+        Payment.method, func.sum(Payment.amount_paid), func.sum(Payment.amount_ves_equivalent), func.sum(Payment.amount_usd_equivalent)
+    ).filter(Payment.date.between(start_of_day, end_of_day))
     if active_store_id and active_store_id != 'all':
         payments_today_query = payments_today_query.join(Order).filter(Order.store_id == active_store_id)
-    payments_today = payments_today_query.all()
-    
+    payments_by_method_today = payments_today_query.group_by(Payment.method).all()
+
     payments_summary = {
         'efectivo_ves': {'amount': 0.0},
         'efectivo_usd': {'amount': 0.0, 'amount_ves_equivalent': 0.0},
@@ -5856,15 +6408,14 @@ def print_daily_closing_report():
         'total_ves': 0.0,
         'total_usd': 0.0
     }
-    for payment in payments_today:
-        payments_summary['total_ves'] += payment.amount_ves_equivalent
-        payments_summary['total_usd'] += payment.amount_usd_equivalent
-        if payment.method in ['efectivo_ves', 'efectivo_usd', 'transferencia', 'punto_de_venta']:
-            if payment.method == 'efectivo_usd':
-                payments_summary[payment.method]['amount'] += payment.amount_paid
-                payments_summary[payment.method]['amount_ves_equivalent'] += payment.amount_ves_equivalent
-            else:
-                payments_summary[payment.method]['amount'] += payment.amount_ves_equivalent # Usar el equivalente en VES para métodos en VES
+    for method, amount_paid, amount_ves, amount_usd in payments_by_method_today:
+        payments_summary['total_ves'] += amount_ves or 0.0
+        payments_summary['total_usd'] += amount_usd or 0.0
+        if method == 'efectivo_usd':
+            payments_summary[method]['amount'] += amount_paid or 0.0
+            payments_summary[method]['amount_ves_equivalent'] += amount_ves or 0.0
+        elif method in ['efectivo_ves', 'transferencia', 'punto_de_venta']:
+            payments_summary[method]['amount'] += amount_ves or 0.0 # Usar el equivalente en VES para métodos en VES
 
     # --- 3. Cash Box Movements ---
     cash_boxes_query = CashBox.query
@@ -5880,31 +6431,34 @@ def print_daily_closing_report():
             'final_balance_ves': box.balance_ves, 'final_balance_usd': box.balance_usd
         }
 
+    # Ingresos por pagos y movimientos manuales del día, agregados por caja y moneda en dos consultas;
+    # se reparten con el mapa id → nombre de las cajas ya cargadas (sin cargar p.cash_box por fila).
+    cash_box_names = {box.id: box.name for box in cash_boxes}
+
     # Payments into cash boxes
-    cash_payments_query = Payment.query.filter(Payment.date.between(start_of_day, end_of_day), Payment.cash_box_id.isnot(None))
+    cash_payments_query = db.session.query(
+        Payment.cash_box_id, Payment.currency_paid, func.sum(Payment.amount_paid)
+    ).filter(Payment.date.between(start_of_day, end_of_day), Payment.cash_box_id.isnot(None))
     if active_store_id and active_store_id != 'all':
         cash_payments_query = cash_payments_query.join(Order).filter(Order.store_id == active_store_id)
-    cash_payments = cash_payments_query.all()
-
-    for p in cash_payments:
-        if p.cash_box:
-            if p.currency_paid == 'VES': cash_box_movements[p.cash_box.name]['income_ves'] += p.amount_paid
-            elif p.currency_paid == 'USD': cash_box_movements[p.cash_box.name]['income_usd'] += p.amount_paid
-
-    # Manual movements for cash boxes
-    manual_cash_movements_query = ManualFinancialMovement.query.filter(ManualFinancialMovement.date.between(start_of_day, end_of_day), ManualFinancialMovement.cash_box_id.isnot(None))
+    for box_id, currency, amount in cash_payments_query.group_by(Payment.cash_box_id, Payment.currency_paid):
+        if box_id in cash_box_names and currency in ('VES', 'USD'):
+            cash_box_movements[cash_box_names[box_id]][f'income_{currency.lower()}'] += amount or 0.0
+
+    # Manual movements for cash boxes (los egresos solo cuentan si están aprobados)
+    manual_cash_movements_query = db.session.query(
+        ManualFinancialMovement.cash_box_id, ManualFinancialMovement.currency,
+        func.sum(case((ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.amount), else_=0)),
+        func.sum(case((and_(ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.status == 'Aprobado'), ManualFinancialMovement.amount), else_=0))
+    ).filter(ManualFinancialMovement.date.between(start_of_day, end_of_day), ManualFinancialMovement.cash_box_id.isnot(None))
     if active_store_id and active_store_id != 'all':
         manual_cash_movements_query = manual_cash_movements_query.join(CashBox).filter(CashBox.store_id == active_store_id)
-    manual_cash_movements = manual_cash_movements_query.all()
-    for m in manual_cash_movements:
-        if m.cash_box:
-            if m.currency == 'VES':
-                if m.movement_type == 'Ingreso': cash_box_movements[m.cash_box.name]['income_ves'] += m.amount
-                elif m.movement_type == 'Egreso' and m.status == 'Aprobado': cash_box_movements[m.cash_box.name]['expense_ves'] += m.amount
-            elif m.currency == 'USD':
-                if m.movement_type == 'Ingreso': cash_box_movements[m.cash_box.name]['income_usd'] += m.amount
-                elif m.movement_type == 'Egreso' and m.status == 'Aprobado': cash_box_movements[m.cash_box.name]['expense_usd'] += m.amount
-    
+    for box_id, currency, income, expense in manual_cash_movements_query.group_by(ManualFinancialMovement.cash_box_id, ManualFinancialMovement.currency):
+        if box_id in cash_box_names and currency in ('VES', 'USD'):
+            box_movements = cash_box_movements[cash_box_names[box_id]]
+            box_movements[f'income_{currency.lower()}'] += float(income or 0.0)
+            box_movements[f'expense_{currency.lower()}'] += float(expense or 0.0)
+
     for box_name, data in cash_box_movements.items():
         data['initial_balance_ves'] = data['final_balance_ves'] - data['income_ves'] + data['expense_ves']
         data['initial_balance_usd'] = data['final_balance_usd'] - data['income_usd'] + data['expense_usd']
@@ -5916,24 +6470,28 @@ def print_daily_closing_report():
     for bank in banks:
         bank_movements[bank.name] = {'income_ves': 0.0, 'expense_ves': 0.0, 'initial_balance_ves': 0.0, 'final_balance_ves': bank.balance}
 
-    bank_payments_query = Payment.query.filter(Payment.date.between(start_of_day, end_of_day), or_(Payment.bank_id.isnot(None), Payment.pos_id.isnot(None)))
+    # Solo columnas agregadas por banco: los pagos por punto de venta se asignan al banco del POS
+    bank_names = {bank.id: bank.name for bank in banks}
+    payment_bank_id = func.coalesce(Payment.bank_id, PointOfSale.bank_id)
+    bank_payments_query = db.session.query(payment_bank_id, func.sum(Payment.amount_ves_equivalent)).outerjoin(
+        PointOfSale, Payment.pos_id == PointOfSale.id
+    ).filter(Payment.date.between(start_of_day, end_of_day), or_(Payment.bank_id.isnot(None), Payment.pos_id.isnot(None)))
     if active_store_id and active_store_id != 'all':
-        bank_payments_query = bank_payments_query.join(Order).filter(Order.store_id == active_store_id)
-    bank_payments = bank_payments_query.all()
-
-    for p in bank_payments:
-        target_bank = p.bank or (p.pos.bank if p.pos else None)
-        if target_bank and target_bank.name in bank_movements: bank_movements[target_bank.name]['income_ves'] += p.amount_ves_equivalent
+        bank_payments_query = bank_payments_query.join(Order, Payment.order_id == Order.id).filter(Order.store_id == active_store_id)
+    for bank_id, amount in bank_payments_query.group_by(payment_bank_id):
+        if bank_id in bank_names: bank_movements[bank_names[bank_id]]['income_ves'] += amount or 0.0
+
+    # No se puede filtrar por sucursal aquí porque los bancos son globales (los egresos solo cuentan si están aprobados)
+    manual_bank_movements_query = db.session.query(
+        ManualFinancialMovement.bank_id,
+        func.sum(case((ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.amount), else_=0)),
+        func.sum(case((and_(ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.status == 'Aprobado'), ManualFinancialMovement.amount), else_=0))
+    ).filter(ManualFinancialMovement.date.between(start_of_day, end_of_day), ManualFinancialMovement.bank_id.isnot(None), ManualFinancialMovement.currency == 'VES')
+    for bank_id, income, expense in manual_bank_movements_query.group_by(ManualFinancialMovement.bank_id):
+        if bank_id in bank_names:
+            bank_movements[bank_names[bank_id]]['income_ves'] += float(income or 0.0)
+            bank_movements[bank_names[bank_id]]['expense_ves'] += float(expense or 0.0)
 
-    manual_bank_movements_query = ManualFinancialMovement.query.filter(ManualFinancialMovement.date.between(start_of_day, end_of_day), ManualFinancialMovement.bank_id.isnot(None))
-    # No se puede filtrar por sucursal aquí porque los bancos son globales
-    manual_bank_movements = manual_bank_movements_query.all()
-
-    for m in manual_bank_movements:
-        if m.bank and m.currency == 'VES':
-            if m.movement_type == 'Ingreso': bank_movements[m.bank.name]['income_ves'] += m.amount
-            elif m.movement_type == 'Egreso' and m.status == 'Aprobado': bank_movements[m.bank.name]['expense_ves'] += m.amount
-    
     for bank_name, data in bank_movements.items():
         data['initial_balance_ves'] = data['final_balance_ves'] - data['income_ves'] + data['expense_ves']
 
@@ -5969,7 +6527,7 @@ def print_daily_closing_report_pdf():
     currency_symbol = "$"
 
     # --- Reutilizar la lógica de cálculo del reporte de ticket para consistencia ---
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     
     logo_path = None
     if company_info and company_info.logo_filename:
@@ -6013,10 +6571,11 @@ def print_daily_closing_report_pdf():
         sales_summary['total']['amount_usd'] += order.total_amount_usd
 
     # --- Collections from past sales (credits/reservations) ---
-    collections_today_query = Payment.query.options(
-        joinedload(Payment.order).joinedload(Order.client),
-        joinedload(Payment.order).joinedload(Order.items).joinedload(OrderItem.product)
-    ).join(Order).filter(
+    # La orden ya viene en el JOIN filtrado; contains_eager la toma de ahí en vez de unirla otra vez
+    collections_today_query = Payment.query.join(Payment.order).options(
+        contains_eager(Payment.order).joinedload(Order.client),
+        contains_eager(Payment.order).joinedload(Order.items).joinedload(OrderItem.product)
+    ).filter(
         Payment.date.between(start_dt, end_dt),
         Order.date_created < start_dt,  # Key: payments today for orders from the past
         Order.order_type.in_(['credit', 'reservation'])
@@ -6044,15 +6603,18 @@ def print_daily_closing_report_pdf():
     bank_balances = []
     for bank in banks:
         inflows_query = db.session.query(func.sum(Payment.amount_ves_equivalent)).join(Order).filter(or_(Payment.bank_id == bank.id, Payment.pos.has(bank_id=bank.id)), Payment.date.between(start_dt, end_dt))
-        manual_inflows_query = db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.bank_id == bank.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.currency == 'VES', ManualFinancialMovement.status == 'Aprobado')
-        manual_outflows_query = db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.bank_id == bank.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.status == 'Aprobado', ManualFinancialMovement.currency == 'VES')
+        # Ingresos y egresos manuales en un solo recorrido con SUM(CASE ...)
+        manual_inflows, manual_outflows = db.session.query(
+            func.sum(case((ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.amount), else_=0)),
+            func.sum(case((ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.amount), else_=0))
+        ).filter(ManualFinancialMovement.bank_id == bank.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.currency == 'VES', ManualFinancialMovement.status == 'Aprobado').one()
         
         if active_store_id and active_store_id != 'all':
             inflows_query = inflows_query.filter(Order.store_id == active_store_id)
             # Movimientos manuales no se pueden filtrar por sucursal si son de banco
 
-        inflows_ves = (inflows_query.scalar() or 0.0) + (manual_inflows_query.scalar() or 0.0)
-        outflows_ves = manual_outflows_query.scalar() or 0.0
+        inflows_ves = (inflows_query.scalar() or 0.0) + (manual_inflows or 0.0)
+        outflows_ves = manual_outflows or 0.0
         final_balance_ves = bank.balance
         initial_balance_ves = final_balance_ves - inflows_ves + outflows_ves
         bank_balances.append({'name': bank.name, 'initial_balance_ves': initial_balance_ves, 'inflows_ves': inflows_ves, 'outflows_ves': outflows_ves, 'final_balance_ves': final_balance_ves})
@@ -6070,13 +6632,22 @@ def print_daily_closing_report_pdf():
             inflows_ves_payments = inflows_ves_payments.filter(Order.store_id == active_store_id)
             inflows_usd_payments = inflows_usd_payments.filter(Order.store_id == active_store_id)
 
-        inflows_ves = (inflows_ves_payments.scalar() or 0.0) + (db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.currency == 'VES', ManualFinancialMovement.status == 'Aprobado').scalar() or 0.0)
-        outflows_ves = db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.status == 'Aprobado', ManualFinancialMovement.currency == 'VES').scalar() or 0.0
+        # Ingresos y egresos manuales de ambas monedas en una sola consulta agrupada por moneda
+        manual_totals = {
+            currency: (float(inflow or 0.0), float(outflow or 0.0))
+            for currency, inflow, outflow in db.session.query(
+                ManualFinancialMovement.currency,
+                func.sum(case((ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.amount), else_=0)),
+                func.sum(case((ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.amount), else_=0))
+            ).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.status == 'Aprobado').group_by(ManualFinancialMovement.currency)
+        }
+        manual_inflows_ves, outflows_ves = manual_totals.get('VES', (0.0, 0.0))
+        inflows_ves = (inflows_ves_payments.scalar() or 0.0) + manual_inflows_ves
         final_balance_ves = box.balance_ves
         initial_balance_ves = final_balance_ves - inflows_ves + outflows_ves
 
-        inflows_usd = (inflows_usd_payments.scalar() or 0.0) + (db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Ingreso', ManualFinancialMovement.currency == 'USD', ManualFinancialMovement.status == 'Aprobado').scalar() or 0.0)
-        outflows_usd = db.session.query(func.sum(ManualFinancialMovement.amount)).filter(ManualFinancialMovement.cash_box_id == box.id, ManualFinancialMovement.date.between(start_dt, end_dt), ManualFinancialMovement.movement_type == 'Egreso', ManualFinancialMovement.status == 'Aprobado', ManualFinancialMovement.currency == 'USD').scalar() or 0.0
+        manual_inflows_usd, outflows_usd = manual_totals.get('USD', (0.0, 0.0))
+        inflows_usd = (inflows_usd_payments.scalar() or 0.0) + manual_inflows_usd
         final_balance_usd = box.balance_usd
         initial_balance_usd = final_balance_usd - inflows_usd + outflows_usd
 
@@ -6129,10 +6700,7 @@ def print_daily_closing_report_pdf():
     }
     html_string = render_template('pdf/reporte_diario_pdf.html', **context)
 
-    if eventlet:
-        pdf_file = eventlet.tpool.execute(HTML(string=html_string, base_url=request.base_url).write_pdf)
-    else:
-        pdf_file = HTML(string=html_string, base_url=request.base_url).write_pdf()
+    pdf_file = html_to_pdf(html_string)
 
     response = make_response(pdf_file)
     response.headers['Content-Type'] = 'application/pdf'
@@ -6290,8 +6858,8 @@ def warehouse_transfer():
                     "items": [{"product_id": m.product_id, "quantity": m.quantity, "comment": m.comment or ""} for m in movements]
                 }
 
-    products = Product.query.order_by(Product.name).all()
-    return render_template('almacenes/traslados.html', title='Traslado entre Almacenes', warehouses=warehouses, products=products, transfer_to_duplicate_data=transfer_to_duplicate_data)
+    # Los productos se buscan por API (search_products_for_transfer); la plantilla no necesita la lista completa.
+    return render_template('almacenes/traslados.html', title='Traslado entre Almacenes', warehouses=warehouses, transfer_to_duplicate_data=transfer_to_duplicate_data)
 
 @routes_blueprint.route('/almacenes/traslados/<int:transfer_id>')
 @login_required
@@ -6346,7 +6914,7 @@ def print_transfer_report(transfer_id):
     to_warehouse_id = int(movements[0].description.split()[-1])
     to_warehouse = Warehouse.query.get(to_warehouse_id)
     generation_date = get_current_time_ve().strftime('%d/%m/%Y %H:%M:%S')
-    company_info = CompanyInfo.query.first()
+    company_info = get_company_info()
     logo_path = None
     if company_info and company_info.logo_filename:
         # Construir la ruta absoluta y convertirla a una URI de archivo compatible
@@ -6364,10 +6932,7 @@ def print_transfer_report(transfer_id):
                                   total_cost_usd=total_cost_usd,
                                   logo_path=logo_path)
     
-    if eventlet:
-        pdf_file = eventlet.tpool.execute(HTML(string=html_string, base_url=request.base_url).write_pdf)
-    else:
-        pdf_file = HTML(string=html_string, base_url=request.base_url).write_pdf()
+    pdf_file = html_to_pdf(html_string)
     return Response(pdf_file, mimetype='application/pdf', headers={'Content-Disposition': f'inline; filename=reporte_traslado_{transfer.id}.pdf'})
 
 @routes_blueprint.route('/almacenes/traslados/historial')
@@ -6679,7 +7244,7 @@ def marketing_provider_detail_view(provider_id):
     exchanges = Payment.query.filter(
         Payment.method.in_(['cruce_de_cuentas', 'intercambio_comercial']),
         Payment.reference == str(provider.id)
-    ).options(joinedload(Payment.order)).all()
+    ).all()
 
     # 3. Combine and sort all movements for display
     all_movements = []
@@ -6694,7 +7259,7 @@ def marketing_provider_detail_view(provider_id):
         })
 
     for exchange in exchanges:
-        order_id_str = f" en N.E. #{exchange.order.id:09d}" if exchange.order else ""
+        order_id_str = f" en N.E. #{exchange.order_id:09d}" if exchange.order_id is not None else ""
         all_movements.append({
             'date': exchange.date,
             'description': f"Uso de saldo por intercambio comercial{order_id_str}",
@@ -6847,15 +7412,9 @@ def api_client_credit_info(client_id):
 def new_credit_note():
     from decimal import Decimal
     """Página para crear una nota de crédito (saldo a favor) para un cliente."""
-    clients = Client.query.order_by(Client.name).all()
-    banks = Bank.query.order_by(Bank.name).all()
-    points_of_sale = PointOfSale.query.order_by(PointOfSale.name).all()
-    
-    active_store_id = session.get('active_store_id')
-    cash_boxes_query = CashBox.query.order_by(CashBox.name)
-    if active_store_id and active_store_id != 'all':
-        cash_boxes_query = cash_boxes_query.filter(CashBox.store_id == active_store_id)
-    cash_boxes = cash_boxes_query.all()
+    banks = get_bank_options()
+    points_of_sale = get_pos_options()
+    cash_boxes = active_store_cash_box_options()
 
     preselected_client_id = request.args.get('client_id', type=int)
 
@@ -6868,7 +7427,7 @@ def new_credit_note():
                 raise ValueError("Debe seleccionar un cliente y agregar un método de pago.")
 
             client = Client.query.get_or_404(client_id)
-            payment_info = json.loads(payment_data_json)[0] # Solo se permite un pago para la nota de crédito
+            payment_info = orjson.loads(payment_data_json)[0] # Solo se permite un pago para la nota de crédito
 
             payment_date = get_current_time_ve()
             if payment_info.get('date'):
@@ -6935,15 +7494,12 @@ def new_credit_note():
             db.session.rollback()
             flash(f'Error al crear la nota de crédito: {e}', 'danger')
 
-    return render_template('finanzas/nueva_nota_credito.html', title='Nueva Nota de Crédito', clients=clients, banks=banks, points_of_sale=points_of_sale, cash_boxes=cash_boxes, preselected_client_id=preselected_client_id)
+    return render_template('finanzas/nueva_nota_credito.html', title='Nueva Nota de Crédito', banks=banks, points_of_sale=points_of_sale, cash_boxes=cash_boxes, preselected_client_id=preselected_client_id)
 
 @routes_blueprint.route('/finanzas/nota-debito/nueva', methods=['GET', 'POST'])
 @login_required
 def new_debit_note():
     
-
-    clients = Client.query.order_by(Client.name).all()
-    
     if request.method == 'POST':
         try:
             client_id = request.form.get('client_id', type=int)
@@ -7007,7 +7563,7 @@ def new_debit_note():
             db.session.rollback()
             flash(f'Error al crear nota de débito: {e}', 'danger')
 
-    return render_template('finanzas/nueva_nota_debito.html', title='Nueva Nota de Débito', clients=clients)
+    return render_template('finanzas/nueva_nota_debito.html', title='Nueva Nota de Débito')
 
 @routes_blueprint.route('/configuracion/usuarios', methods=['GET'])
 @login_required
@@ -7372,7 +7928,7 @@ def return_order():
             elif action == 'intercambio':
                 # 1. Obtener datos del formulario
                 new_items_json = request.form.get('exchange_new_items_data')
-                new_items_data = json.loads(new_items_json) if new_items_json else []
+                new_items_data = orjson.loads(new_items_json) if new_items_json else []
                 payment_method = request.form.get('exchange_payment_method')
                 return_reason = request.form.get('return_reason', 'Intercambio/Devolución')
                 no_refund = request.form.get('no_refund') == 'on'